@@ -9,13 +9,16 @@ In particular it supplies the name of the logged-in user and the
 the simulation that this user is currently working on.
 """
 
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 from typing import Annotated
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import jwt
 from passlib.context import CryptContext
-from sqlalchemy import Boolean, Column, Integer, String
+from sqlalchemy import Boolean, Column, Integer, String, select
 from sqlalchemy.orm import Session
 from ..database import Base, get_db
 from ..models import Simulation
@@ -27,6 +30,7 @@ from ..reporting.caplog import logger
 SECRET_KEY = settings.secret_key
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 3000
+ADMIN_USERNAME = "admin"  # the user who owns the templates (see /action/reset)
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
@@ -72,12 +76,70 @@ class usPair:
         self.user=user
         self.simulation=simulation
 
+class TokenCache:
+    """
+    Tokens that have already been verified, each with the id of the user
+    it identifies, so that get_current_user_and_simulation() need not
+    decode the token and look up the username on every request.
+
+    An entry is kept for at most 'seconds', and never beyond the expiry
+    of the token itself. Once there are more than max_entries, the least
+    recently used are discarded.
+
+    Only the user id is kept. The user's current simulation is read
+    afresh on every request, in the same query as the user, so cloning
+    or deleting a simulation cannot leave a stale entry behind. Logging
+    in or out discards the user's entries (see forget_user).
+    """
+
+    def __init__(self, max_entries:int, seconds:float):
+        self.max_entries = max_entries
+        self.seconds = seconds
+        self.entries:OrderedDict[str, tuple[int, float]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, token:str)->int|None:
+        """The id of the user identified by token, or None if it is not known."""
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None:
+                return None
+            user_id, expires = entry
+            if expires <= time.time():
+                del self.entries[token]
+                return None
+            self.entries.move_to_end(token)
+            return user_id
+
+    def put(self, token:str, user_id:int, token_expires:float|None):
+        expires = time.time() + self.seconds
+        if token_expires is not None:
+            expires = min(expires, token_expires)
+        with self.lock:
+            self.entries[token] = (user_id, expires)
+            self.entries.move_to_end(token)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def forget_user(self, user_id:int):
+        """Discard every token of this user."""
+        with self.lock:
+            for token in [token for token, entry in self.entries.items() if entry[0] == user_id]:
+                del self.entries[token]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+token_cache = TokenCache(settings.token_cache_size, settings.token_cache_seconds)
+
 async def get_current_user_and_simulation(
     token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)
 ) -> usPair:
     """
     Returns the currently logged-in user corresponding to the token in
-    the request header, and the simulation this user is working on.
+    the request header, and the simulation this user is working on,
+    which is the one named by User.current_simulation.
 
     Returns (None,None) and raises an exception if the user is not
     authenticated, or does not exist on the database
@@ -85,22 +147,42 @@ async def get_current_user_and_simulation(
     Returns (User,None) if the user is OK but has no current simulation
 
     Cannot return (None, Simulation)
+
+    Tokens already verified are remembered in token_cache, in which case
+    the only work done is a single query for the user and simulation.
     """
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-    except Exception as error:
-        logger.error(f"No meaningful token {token}. Client is probably not logged in")
-        return usPair(None,None)
-    if username is None:
-        logger.error("Token contained no username. Client did not tell us anything meaningful")
-        return usPair(None,None)
-    user = get_user_from_username(username=username, db=db)
-    if user is None:
-        logger.error(f"Token was authenticated but {username} was not found in the database")
+    user_id = token_cache.get(token)
+    if user_id is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            username = payload.get("sub")
+        except Exception as error:
+            logger.error(f"No meaningful token {token}. Client is probably not logged in")
+            return usPair(None,None)
+        if username is None:
+            logger.error("Token contained no username. Client did not tell us anything meaningful")
+            return usPair(None,None)
+        user = get_user_from_username(username=username, db=db)
+        if user is None:
+            logger.error(f"Token was authenticated but {username} was not found in the database")
+            return usPair(None,None)
+        token_cache.put(token, user.id, payload.get("exp"))
+        user_id = user.id
+    return get_user_and_current_simulation(user_id, db)
+
+def get_user_and_current_simulation(user_id: int, db: Session) -> usPair:
+    """Looks up the user with this id and its current simulation, in one query.
+    The simulation is None if the user has no current simulation, or if it
+    does not belong to the user."""
+    row = db.execute(
+        select(User, Simulation)
+        .outerjoin(Simulation, (Simulation.id == User.current_simulation) & (Simulation.user_id == User.id))
+        .where(User.id == user_id)
+    ).first()
+    if row is None:
+        token_cache.forget_user(user_id)
         return usPair(None,None)
-    simulation = db.query(Simulation).where(Simulation.user_id == user.id).first()
-    return usPair(user,simulation) # if there is no such simulation, this returns (user,None), as specified
+    return usPair(row[0],row[1])
 
 def get_user_from_username(username: str, db: Session) -> User:
     """Looks up username in the database. 
@@ -142,6 +224,22 @@ def get_current_simulation(
         return None
     return u.simulation
 
+def is_admin(user:User)->bool:
+    """True for a superuser, or the user who owns the templates."""
+    return bool(user.is_superuser) or user.username == ADMIN_USERNAME
+
+def get_admin_user(u:usPair=Depends(get_current_user_and_simulation))->User:
+    """Use in endpoints restricted to the admin user.
+
+    Replies 401 if the request is not from a logged-in user, and 403 if
+    that user is not the admin (see is_admin()).
+    """
+    if u.user is None:
+        raise credentials_exception
+    if not is_admin(u.user):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only the admin user may do this")
+    return u.user
+
 def add_superuser(db: Session = Depends(get_db)):
     """Creates the admin user.
     TODO complete this. Does it hash the password?
@@ -0,0 +1,138 @@
+"""Conditional GET, and a cache of responses, for the endpoints which
+read the objects of the current simulation.
+
+The objects of a simulation only change when something calls
+Simulation.changed(), which increments its version: the action handlers,
+cloning, restoring a checkpoint and so on. So the pair (simulation id,
+version) identifies the state of everything in it, and serves as the
+ETag of any response derived from that state. Simulation ids are never
+reused (see Simulation.__table_args__), so a deleted simulation's ETags
+cannot match a later one.
+
+If the client sends back the ETag it was given in If-None-Match, and the
+version has not changed since, the reply is 304 Not Modified, before the
+handler runs. The only database access is then the lookup of the user
+and simulation that every protected endpoint does anyway.
+
+For clients that do not send If-None-Match, or whose version is out of
+date, response_cache holds the serialised body of recent responses,
+keyed by (endpoint, simulation id, version). It is bounded by
+settings.response_cache_bytes, discarding the least recently used
+responses first. Entries for older versions can never be hit again; the
+action handlers call response_cache.invalidate() to free them at once.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Callable
+from fastapi import Depends, HTTPException, Request, Response, status
+from .authorization.auth import get_current_simulation
+from .config import settings
+from .models import Simulation
+
+def simulation_etag(simulation:Simulation)->str:
+    return f'"{simulation.id}-{simulation.version or 0}"'
+
+def etag_headers(simulation:Simulation)->dict[str, str]:
+    return {"ETag": simulation_etag(simulation), "Cache-Control": "private, no-cache"}
+
+def etag_matches(if_none_match:str|None, etag:str)->bool:
+    """True if the If-None-Match header lists etag (weak or strong) or is '*'."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in [tag.removeprefix("W/") for tag in tags]
+
+def get_current_simulation_if_modified(
+    request:Request,
+    response:Response,
+    simulation:Simulation=Depends(get_current_simulation),
+)->Simulation:
+    """Use instead of get_current_simulation in read-only endpoints.
+
+    Replies 304 Not Modified if the client already has the current version
+    of the simulation. Otherwise adds its ETag to the response and returns
+    the simulation (or None, as get_current_simulation does).
+    """
+    if simulation is None:
+        return None
+    headers = etag_headers(simulation)
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        raise HTTPException(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return simulation
+
+class ResponseCache:
+    """Serialised responses, keyed by (endpoint, simulation id, version),
+    with least-recently-used eviction once their total size exceeds
+    max_bytes. Safe to use from the threads that run the endpoints."""
+
+    def __init__(self, max_bytes:int):
+        self.max_bytes = max_bytes
+        self.entries:OrderedDict[tuple[str, int, int], bytes] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, endpoint:str, simulation:Simulation, build:Callable[[], bytes])->bytes:
+        """The cached body for this endpoint and version of simulation.
+        If there is none, call build() to make it, and keep the result."""
+        key = (endpoint, simulation.id, simulation.version or 0)
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return body
+            self.misses += 1
+        body = build()
+        self._store(key, body)
+        return body
+
+    def _store(self, key:tuple[str, int, int], body:bytes):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, simulation_id:int):
+        """Discard every response for this simulation."""
+        with self.lock:
+            for key in [key for key in self.entries if key[1] == simulation_id]:
+                self.size -= len(self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def statistics(self)->dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+            }
+
+response_cache = ResponseCache(settings.response_cache_bytes)
+
+def cached_response(endpoint:str, simulation:Simulation, build:Callable[[], bytes])->Response:
+    """A JSON response with the body for this endpoint and version of
+    simulation, from response_cache or else from build(), with its ETag."""
+    return Response(
+        content=response_cache.get(endpoint, simulation, build),
+        media_type="application/json",
+        headers=etag_headers(simulation),
+    )
@@ -17,6 +17,15 @@ class Settings(BaseSettings):
     algorithm: str
     access_token_expire_minutes: int
     sqlalchemy_database_url: str
+    trace_level: int = 5  # the most detailed trace level recorded, unless a simulation sets its own
+    trace_buffer_size: int = 1000  # trace entries held in memory before they are written
+    trace_immediate: bool = False  # write and commit every trace entry at once (for debugging)
+    token_cache_size: int = 1000  # verified tokens remembered by get_current_user_and_simulation
+    token_cache_seconds: float = 60  # how long a verified token is remembered
+    response_cache_bytes: int = 64 * 1024 * 1024  # memory used by cached responses (see caching.py); 0 disables the cache
+    max_run_periods: int = 1000  # the most periods that one request to /action/run or /simulations/sweep may ask for
+    max_sweep_runs: int = 1000  # the most combinations of parameters that one sweep may run
+    sweep_workers: int|None = None  # worker processes shared by all sweeps; None means one per CPU, 1 runs sweeps in-process
 
     class Config:
         env_file = ".env"
@@ -4,6 +4,7 @@ from .database import Base, engine
 from .routers import (
     actions,
     commodity,
+    history,
     industry,
     login,
     simulation,
@@ -20,6 +21,7 @@ interface = FastAPI()
 interface.include_router(actions.router)
 interface.include_router(login.router)
 interface.include_router(commodity.router)
+interface.include_router(history.router)
 interface.include_router(industry.router)
 interface.include_router(simulation.router)
 interface.include_router(socialClass.router)
@@ -3,9 +3,9 @@ the system, except for the User model which is in authorization.py.
 """
 
 import typing
-from sqlalchemy import Column, ForeignKey, Integer, String, Float
+from sqlalchemy import Column, ForeignKey, Integer, LargeBinary, String, Float, UniqueConstraint, event
 from sqlalchemy.orm import relationship, Session
-from .database import Base
+from .database import Base, SessionLocal
 
 Industry_stock = typing.NewType("Industry_stock", None)
 Class_stock = typing.NewType("Class_stock", None)
@@ -42,12 +42,24 @@ class Simulation(Base):
     currency_symbol = Column(String)
     quantity_symbol = Column(String)
     melt = Column(Float)
+    engine = Column(String, default="ORM")  # "ORM" or "NUMPY": which implementation of the circuit to use
+    trace_level = Column(Integer, nullable=True)  # the most detailed trace level recorded; if null, use settings.trace_level
+    version = Column(Integer, default=0)  # incremented whenever an action changes the state of the simulation
     user_id = Column(
         Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False
     )
     # TODO not sure if this is used any more
     owner = relationship("User")  # See part 77 of the tutorial. Not used at present
 
+    # Never reuse the id of a deleted simulation, so (id, version) always
+    # identifies one state of one simulation (see caching.py)
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    def changed(self):
+        """Record that the state of the simulation has changed, so that
+        anything derived from an earlier version is out of date."""
+        self.version = (self.version or 0) + 1
+
 class Commodity(Base):
     """
     The commodity object refers to a type of tradeable good, for example
@@ -159,7 +171,7 @@ class Industry(Base):
         """
         Helper method yields the (unique) Simulation this industry belongs to.
         """
-        return db.get_one(Simulation, self.simulation_id)
+        return simulation_context(db, self.simulation_id).simulation
 
     def sales_stock(self, db: Session)->Industry_stock:
         """Helper method yields the Sales Stock of this industry."""
@@ -191,7 +203,7 @@ class SocialClass(Base):
     successor_id = Column(Integer, nullable=True)  # Helper column to use when cloning
 
     def simulation(self, session)->Simulation:
-        return session.get_one(Simulation, self.simulation_id)
+        return simulation_context(session, self.simulation_id).simulation
 
     def sales_stock(self, session):
         """Helper method yields the Sales Class_stock of this class."""
@@ -251,7 +263,7 @@ class Industry_stock(Base):
         Returns zero for Money and Sales Stocks.
         """
         if self.usage_type == "Production":
-            industry = db.query(Industry).where(Industry.id == self.industry_id).first()
+            industry = self.industry(db)
             return round(industry.output_scale * self.requirement,4)
         else:
             return 0.0
@@ -266,20 +278,19 @@ class Industry_stock(Base):
         Returns zero for non-productive Stocks.
         """
         if self.usage_type == "Production":
-            commodity = db.query(Commodity).where(Commodity.id == self.commodity_id).first()
-            return self.annual_flow_rate(db) * commodity.turnover_time
+            return self.annual_flow_rate(db) * self.commodity(db).turnover_time
         else:
             return 0.0
 
     def industry(self, db: Session)->Industry:
         """Returns the  Industry to which this stock belongs."""
-        return db.get_one(Industry, self.industry_id)
+        return simulation_context(db, self.simulation_id).industries[self.industry_id]
 
     def commodity(self, db: Session)->Commodity:
-        return db.get_one(Commodity, self.commodity_id)
+        return simulation_context(db, self.simulation_id).commodities[self.commodity_id]
 
     def simulation(self, session)->Simulation:
-        return session.get_one(Simulation, self.simulation_id)
+        return simulation_context(session, self.simulation_id).simulation
 
     def unit_cost(self, db: Session)->float:
         """Money price of using this Stock to make one unit of output
@@ -293,7 +304,7 @@ class Industry_stock(Base):
 
     def owner(self, db:Session)->Industry: 
         """Really just for diagnostic purposes """
-        return db.get_one(Industry, self.industry_id)
+        return self.industry(db)
     
     def change_size(self,amount:float,db:Session)->bool:
         """Change the size of this Industry_stock by 'amount'.
@@ -308,9 +319,10 @@ class Industry_stock(Base):
         Do NOT use this in production or consumption, which can change
         unit values and prices.
         """
+        commodity = self.commodity(db)
         self.size += amount
-        self.price=self.size*self.commodity(db).unit_value
-        self.value=self.size*self.commodity(db).unit_price
+        self.price=self.size*commodity.unit_value
+        self.value=self.size*commodity.unit_price
 
 class Class_stock(Base):
     """Stocks are produced, consumed, and traded in a
@@ -354,22 +366,22 @@ class Class_stock(Base):
 
     def social_class(self, db: Session)->SocialClass:
         """Returns the Class which owns this Class_stock."""
-        return db.get_one(SocialClass, self.class_id)
+        return simulation_context(db, self.simulation_id).classes[self.class_id]
 
     def commodity(self, db: Session)->Commodity:
         """Returns the Commodity that this Class_stock consists of."""
-        return db.get_one(Commodity, self.commodity_id)
+        return simulation_context(db, self.simulation_id).commodities[self.commodity_id]
 
     def simulation(self, session)->Simulation:
         """Return the Simulation that this Class_stock is part of"""
-        return session.get_one(Simulation, self.simulation_id)
+        return simulation_context(session, self.simulation_id).simulation
     
     def annual_flow_rate(self, db: Session) -> float:
         """The annual rate at which this Class_stock is consumed.
         Returns zero for Money and Sales Stocks.
         """
         if self.usage_type == "Consumption":
-            social_class:SocialClass = db.query(SocialClass).where(SocialClass.id == self.class_id).first()
+            social_class:SocialClass = self.social_class(db)
             return social_class.population * social_class.consumption_ratio
         else:
             return 0.0
@@ -389,13 +401,13 @@ class Class_stock(Base):
         whilst too little money has results which we wish to investigate.
         """
         if self.usage_type == "Consumption":
-            return self.annual_flow_rate(db) * self.commodity().turnover_time
+            return self.annual_flow_rate(db) * self.commodity(db).turnover_time
         else:
             return 0.0
 
     def owner(self, session)->SocialClass: 
         """Really just for diagnostic purposes """
-        return session.get_one(SocialClass, self.class_id)
+        return self.social_class(session)
 
     def change_size(self,amount:float,db:Session)->bool:
         """Change the size of this Class_stock by 'amount'.
@@ -410,9 +422,10 @@ class Class_stock(Base):
         Do NOT use this in production or consumption, which can change
         unit values and prices.
         """
+        commodity = self.commodity(db)
         self.size += amount
-        self.price=self.size*self.commodity(db).unit_value
-        self.value=self.size*self.commodity(db).unit_price
+        self.price=self.size*commodity.unit_value
+        self.value=self.size*commodity.unit_price
 
 class Trace(Base):
     """
@@ -430,6 +443,40 @@ class Trace(Base):
     level = Column(Integer)
     message = Column(String)
 
+class History(Base):
+    """
+    History records the state of a simulation at the end of each period,
+    in compact form: the main magnitudes of its commodities, industries
+    and classes, each packed into a single binary array. One History
+    object is written for each (simulation_id, time_stamp).
+
+    'checkpoint' holds, in the same way, every field that the circuit
+    changes, including those of the stocks, whose ids are in
+    industry_stock_ids and class_stock_ids. It is used to restore the
+    simulation to this time stamp.
+
+    The packing and unpacking is done by simulation/history.py, which
+    also defines which fields are recorded.
+    """
+
+    __tablename__ = "history"
+    id = Column(Integer, primary_key=True, nullable=False)
+    simulation_id = Column(
+        Integer, ForeignKey("simulations.id", ondelete="CASCADE"), nullable=False
+    )
+    time_stamp = Column(Integer, nullable=False)
+    commodity_ids = Column(LargeBinary)
+    commodities = Column(LargeBinary)
+    industry_ids = Column(LargeBinary)
+    industries = Column(LargeBinary)
+    class_ids = Column(LargeBinary)
+    classes = Column(LargeBinary)
+    industry_stock_ids = Column(LargeBinary)
+    class_stock_ids = Column(LargeBinary)
+    checkpoint = Column(LargeBinary)
+
+    __table_args__ = (UniqueConstraint("simulation_id", "time_stamp"),)
+
 class Buyer(Base):
     """The Buyer class is initialized when a simulation is created,
     that is, when a user clones a template.
@@ -479,7 +526,7 @@ class Buyer(Base):
 
     def commodity(self, session)->Commodity:
         """Returns the Commodity which this buyer wants to get for this stock."""
-        return session.get_one(Commodity, self.commodity_id)
+        return simulation_context(session, self.simulation_id).commodities[self.commodity_id]
 
     def owner_name(self, session):  # Really just for diagnostic convenience
         if self.owner_type == "Industry":
@@ -535,7 +582,7 @@ class Seller(Base):
 
     def commodity(self, session):
         """Returns the Commodity which this seller is offering."""
-        return session.get_one(Commodity, self.commodity_id)
+        return simulation_context(session, self.simulation_id).commodities[self.commodity_id]
 
     def owner_name(self, session):  # Really just for diagnostic convenience
         if self.owner_type == "Industry":
@@ -549,52 +596,86 @@ class Seller(Base):
         else:
             return session.get_one(SocialClass, self.sales_stock(session).class_id).id
 
-"""Helper functions which serve as workarounds for dealing with pydantic limitations."""
+"""Helper functions which serve as workarounds for dealing with pydantic limitations.
+
+They look the stock up in the index of the simulation's context (see
+SimulationContext) rather than querying the database."""
 
 def get_industry_sales_stock(industry, session)->Industry_stock:
     """Workaround because pydantic won't accept this query in a built-in function."""
-    return (
-        session.query(Industry_stock)
-        .filter(
-            Industry_stock.industry_id == industry.id,
-            Industry_stock.usage_type == "Sales",
-            Industry_stock.simulation_id == industry.simulation_id,
-        )
-        .first()
-    )
+    return simulation_context(session, industry.simulation_id).owned_stock("Industry", industry.id, "Sales")
 
 def get_industry_money_stock(industry, session)->Industry_stock:
     """workaround because pydantic won't accept this query in a built-in function."""
-    return (
-        session.query(Industry_stock)
-        .filter(
-            Industry_stock.industry_id == industry.id,
-            Industry_stock.usage_type == "Money",
-            Industry_stock.simulation_id == industry.simulation_id,
-        )
-        .first()
-    )
+    return simulation_context(session, industry.simulation_id).owned_stock("Industry", industry.id, "Money")
 
 def get_class_sales_stock(social_class, session)->Class_stock:
     """Workaround because pydantic won't accept this query in a built-in function."""
-    return (
-        session.query(Class_stock)
-        .filter(
-            Class_stock.class_id == social_class.id,
-            Class_stock.usage_type == "Sales",
-            Class_stock.simulation_id == social_class.simulation_id,
-        )
-        .first()
-    )
+    return simulation_context(session, social_class.simulation_id).owned_stock("Class", social_class.id, "Sales")
 
 def get_class_money_stock(social_class, session)->Class_stock:
     """Workaround because pydantic won't accept this query in a built-in function."""    
-    return (
-        session.query(Class_stock)
-        .filter(
-            Class_stock.class_id == social_class.id,
-            Class_stock.usage_type == "Money",
-            Class_stock.simulation_id == social_class.simulation_id,
-        )
-        .first()
-    )
+    return simulation_context(session, social_class.simulation_id).owned_stock("Class", social_class.id, "Money")
+
+class SimulationContext:
+    """The objects that the stocks of one simulation refer to, loaded
+    once for each action.
+
+    The helper methods of the models (Industry_stock.industry(),
+    Class_stock.commodity(), Industry_stock.flow_per_period() and so on)
+    find the simulation, industries, classes and commodities here,
+    instead of querying the database every time they are called.
+
+    It also indexes the stocks of the simulation by owner_type ("Industry"
+    or "Class"), owner id and usage_type, so that the sales and money
+    stocks of an owner can be found without a query.
+
+    A context is created by simulation_context() the first time it is
+    needed, and kept in the session until the session commits or rolls
+    back, which is the end of the action. Actions do not create or
+    delete any of these objects, so the dictionaries stay complete
+    while the context exists. Code that does create or delete them, such
+    as cloning or deleting a simulation, calls forget_simulation_context().
+    """
+
+    def __init__(self, session:Session, simulation_id:int):
+        self.simulation:Simulation = session.get_one(Simulation, simulation_id)
+        self.industries:dict[int, Industry] = {
+            industry.id: industry
+            for industry in session.query(Industry).where(Industry.simulation_id == simulation_id)
+        }
+        self.classes:dict[int, SocialClass] = {
+            social_class.id: social_class
+            for social_class in session.query(SocialClass).where(SocialClass.simulation_id == simulation_id)
+        }
+        self.commodities:dict[int, Commodity] = {
+            commodity.id: commodity
+            for commodity in session.query(Commodity).where(Commodity.simulation_id == simulation_id)
+        }
+        self.stocks:dict[tuple[str, int, str], Industry_stock|Class_stock] = {}
+        for stock in session.query(Industry_stock).where(Industry_stock.simulation_id == simulation_id).order_by(Industry_stock.id):
+            self.stocks.setdefault(("Industry", stock.industry_id, stock.usage_type), stock)
+        for stock in session.query(Class_stock).where(Class_stock.simulation_id == simulation_id).order_by(Class_stock.id):
+            self.stocks.setdefault(("Class", stock.class_id, stock.usage_type), stock)
+
+    def owned_stock(self, owner_type:str, owner_id:int, usage_type:str)->Industry_stock|Class_stock|None:
+        """The first stock with this usage_type owned by this owner, or None if there is none.
+        owner_type is "Industry" or "Class"."""
+        return self.stocks.get((owner_type, owner_id, usage_type))
+
+def simulation_context(session:Session, simulation_id:int)->SimulationContext:
+    """The context of the simulation in this session, creating it if necessary."""
+    contexts = session.info.setdefault("simulation_contexts", {})
+    if simulation_id not in contexts:
+        contexts[simulation_id] = SimulationContext(session, simulation_id)
+    return contexts[simulation_id]
+
+def forget_simulation_context(session:Session, simulation_id:int):
+    """Discard the context of this simulation, because objects have been added to or removed from it."""
+    session.info.get("simulation_contexts", {}).pop(simulation_id, None)
+
+@event.listens_for(SessionLocal, "after_commit")
+@event.listens_for(SessionLocal, "after_rollback")
+def forget_simulation_contexts(session:Session):
+    """The action is over, so its contexts may no longer be complete."""
+    session.info.pop("simulation_contexts", None)
@@ -12,24 +12,25 @@ in sequence.
 TODO prevent the user implementing an action by entering its URL.
 """
 
-from fastapi import Depends, APIRouter
+from fastapi import Depends, APIRouter, HTTPException, Query, status
 from sqlalchemy.orm import Session
-
-from app.simulation.consumption import consume
+from typing import List
 
 from ..simulation.logging import report
 from ..simulation.reload import reload_table
+from ..simulation.clone import forget_templates
+from ..caching import response_cache
+from ..config import settings
 from ..database import get_db
-from ..simulation.demand import (
-    class_demand,
-    commodity_demand,
-    initialise_demand,
-    industry_demand,
+from ..simulation.circuit import (
+    consume_stage,
+    demand_stage,
+    invest_stage,
+    produce_stage,
+    run_circuits,
+    supply_stage,
+    trade_stage,
 )
-from ..simulation.supply import initialise_supply, industry_supply, class_supply
-from ..simulation.trade import buy_and_sell, constrain_demand
-from ..simulation.production import produce
-from ..simulation.invest import invest
 from ..authorization.auth import User, get_current_user_and_simulation, usPair
 from ..models import (
     Class_stock,
@@ -39,8 +40,9 @@ from ..models import (
     Industry,
     Commodity,
     Trace,
+    History,
 )
-from ..simulation.utils import calculate_current_capitals, recalculate_commodity_totals, revalue_stocks, revalue_commodities
+from ..schemas import PeriodSummary
 
 router = APIRouter(prefix="/action", tags=["Actions"])
 
@@ -59,13 +61,10 @@ def demandHandler(
     if u.user is None or u.simulation is None or u.simulation.state=="TEMPLATE": 
         return None
     
-    initialise_demand(db, u.simulation)
-    industry_demand(db, u.simulation) # tell industries to register their demand with their stocks.
-    class_demand(db, u.simulation)  # tell classes to register their demand with their stocks.
-    commodity_demand(db, u.simulation)  # tell the commodities to tot up the demand from all stocks of them.
-    db.add(u.simulation)
-    u.simulation.state = "SUPPLY" # set the next state in the circuit, obliging the user to do this next.
+    demand_stage(db, u.simulation)
+    u.simulation.changed()
     db.commit()
+    response_cache.invalidate(u.simulation.id)
     return "Demand initialised"
 
 @router.get("/supply")
@@ -82,13 +81,10 @@ def supplyHandler(
     """
     if u.user is None or u.simulation is None or u.simulation.state=="TEMPLATE": 
         return None
-    initialise_supply(db, u.simulation)
-    industry_supply(db, u.simulation)  # tell industries to register their supply
-    class_supply(db, u.simulation)  # tell classes to register their supply 
-    # tell the commodities to tot up supply from all stocks of them (note supply was set directly)
-    db.add(u.simulation)
-    u.simulation.state = "TRADE"
+    supply_stage(db, u.simulation)
+    u.simulation.changed()
     db.commit()
+    response_cache.invalidate(u.simulation.id)
     return "Supply initialised"
 
 @router.get("/trade")
@@ -109,29 +105,10 @@ def tradeHandler(
     if u.user is None or u.simulation is None or u.simulation.state=="TEMPLATE": 
         return None
 
-    constrain_demand(db, u.simulation)
-    buy_and_sell(db, u.simulation)
-    db.add(u.simulation)
-    u.simulation.state = "CONSUME"
+    trade_stage(db, u.simulation)
+    u.simulation.changed()
     db.commit()
-
-# Reset commodity demand from stock demands
-        
-    commodity_demand(db,u.simulation)
-
-# Reset commodity supply from industry and class supplies
-# TODO there may be some duplication in the code for supply
-
-    initialise_supply(db, u.simulation)
-    industry_supply(db, u.simulation)  # tell industries to register their supply
-    class_supply(db, u.simulation)  # tell classes to register their supply 
-
-    # TODO I don't think it's necessary to also to revalue, but check.
-    # It should not be necessary, because trade only involves a change of ownership.
-    # If it is necessary, we should probably implement the line below.
-
-    # revalue_stocks(db,u.simulation) 
-
+    response_cache.invalidate(u.simulation.id)
     return "Trading complete"
 
 @router.get("/produce")
@@ -171,18 +148,10 @@ def produceHandler(
     if u.user is None or u.simulation is None or u.simulation.state=="TEMPLATE": 
         return None
 
-    produce(db, u.simulation)
-    db.add(u.simulation)
-    u.simulation.state = "CONSUME"
+    produce_stage(db, u.simulation)
+    u.simulation.changed()
     db.commit()
-
-# Recalculate commodity totals (but do not revalue or reprice)
-    
-    recalculate_commodity_totals(db,u.simulation)
-
-# Recalculate current capital and profit
-
-    calculate_current_capitals(db,u.simulation)
+    response_cache.invalidate(u.simulation.id)
     return "Production complete"
 
 @router.get("/consume")
@@ -203,15 +172,10 @@ def consumeHandler(
     if u.user is None or u.simulation is None or u.simulation.state=="TEMPLATE": 
         return None
 
-    consume(db, u.simulation)
-    db.add(u.simulation)
-    u.simulation.state = "INVEST"
+    consume_stage(db, u.simulation)
+    u.simulation.changed()
     db.commit()
-    recalculate_commodity_totals()
-    revalue_commodities(db,u.simulation)
-    # Then recalculate the price and value of every stock
-    revalue_stocks(db, u.simulation)
-    calculate_current_capitals(db,u.simulation)
+    response_cache.invalidate(u.simulation.id)
     return "Consumption complete"
 
 @router.get("/invest")
@@ -238,10 +202,47 @@ def investHandler(
 
     Therefore does not check u except to decide whether or not to go ahead. 
     """
-    report(1,u.simulation.id,"INVESTING", db)
-    invest(u.simulation,db)
+    if u.user is None or u.simulation is None or u.simulation.state=="TEMPLATE": 
+        return None
+
+    invest_stage(db, u.simulation)
+    u.simulation.changed()
+    db.commit()
+    response_cache.invalidate(u.simulation.id)
     return "Investment decision-making complete"
 
+@router.get("/run", response_model=List[PeriodSummary])
+def runHandler(
+    periods: int = Query(default=1, ge=1, le=settings.max_run_periods),
+    db: Session = Depends(get_db),
+    u: usPair = Depends(get_current_user_and_simulation),
+):
+    """Runs 'periods' complete circuits (demand, supply, trade, produce,
+    consume, invest) in one request and one transaction.
+    periods may not exceed settings.max_run_periods.
+
+    The simulation must be at the start of the circuit (state DEMAND);
+    otherwise replies 409, naming the state it is in.
+    Returns a summary of each period rather than the trace.
+
+    Assumes that get_current_user() has handled any errors. 
+
+    Therefore does not check u except to decide whether or not to go ahead. 
+    """
+    if u.user is None or u.simulation is None: 
+        return []
+    if u.simulation.state!="DEMAND":
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Simulation {u.simulation.id} is in state {u.simulation.state}, but a run must start in state DEMAND",
+        )
+
+    summaries = run_circuits(db, u.simulation, periods)
+    u.simulation.changed()
+    db.commit()
+    response_cache.invalidate(u.simulation.id)
+    return summaries
+
 @router.get("/reset")
 def get_json(db: Session = Depends(get_db)):
     """
@@ -258,6 +259,9 @@ def get_json(db: Session = Depends(get_db)):
     reload_table(db, Class_stock, "static/class_stocks.json", True, 1)
     reload_table(db, Industry_stock, "static/industry_stocks.json", True, 1)
     reload_table(db, Trace, "Trace table: no reload required", False, 1)
+    reload_table(db, History, "History table: no reload required", False, 1)
+    forget_templates()
+    response_cache.clear()
 
     # Reset all users to default status
     for user in db.query(User).all():
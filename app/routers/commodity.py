@@ -1,17 +1,21 @@
-from fastapi import Cookie, Depends, APIRouter
+import numpy as np
+from fastapi import Cookie, Depends, APIRouter, HTTPException, Query, status
 from sqlalchemy.orm import Session
 from typing import List
 from ..authorization.auth import get_current_simulation
+from ..caching import cached_response, get_current_simulation_if_modified
 from ..database import get_db
 from ..models import Commodity, Simulation
-from ..schemas import CommodityBase
+from ..schemas import CommodityBase, UnitValueCheck
+from ..serialisation import dump_rows
+from ..simulation.values import solve_unit_values
 
 router = APIRouter(prefix="/commodities", tags=["Commodity"])
 
 @router.get("/", response_model=List[CommodityBase])
 def get_commodities(
     db: Session = Depends(get_db),
-    simulation: Simulation = Depends(get_current_simulation),
+    simulation: Simulation = Depends(get_current_simulation_if_modified),
 ):
     """Get all commodities in the simulation of the logged-in user
     In the special case of the admin user, the initial batch of simulations all have id=1
@@ -19,8 +23,42 @@ def get_commodities(
     """
     if simulation == None:
         return []
-    commodities = db.query(Commodity).where(Commodity.simulation_id == simulation.id)
-    return commodities
+    return cached_response("commodities", simulation, lambda: dump_rows(
+        db, Commodity, CommodityBase, Commodity.simulation_id == simulation.id
+    ))
+
+@router.get("/unit_values", response_model=List[UnitValueCheck])
+def get_unit_values(
+    method: str = Query(default="auto", pattern="^(auto|dense|sparse)$"),
+    db: Session = Depends(get_db),
+    simulation: Simulation = Depends(get_current_simulation),
+):
+    """Compare the unit value of each commodity in the simulation of the
+    logged-in user with the value calculated directly from the
+    input-output structure (see simulation/values.py).
+    solved_unit_value is null for commodities that no industry produces.
+
+    This only reads the simulation: it writes no trace and does not change
+    its version. Replies 422 if the unit values cannot be solved for, as
+    when the economy is not productive.
+    """
+    if simulation == None:
+        return []
+    try:
+        solved = solve_unit_values(db, simulation, method)
+    except (ValueError, np.linalg.LinAlgError) as error:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"Cannot solve for unit values: {error}")
+    result = []
+    for commodity in db.query(Commodity).where(Commodity.simulation_id == simulation.id).order_by(Commodity.id):
+        solved_unit_value = solved.get(commodity.id)
+        result.append({
+            "id": commodity.id,
+            "name": commodity.name,
+            "unit_value": commodity.unit_value,
+            "solved_unit_value": solved_unit_value,
+            "difference": None if solved_unit_value is None else commodity.unit_value - solved_unit_value,
+        })
+    return result
 
 @router.get("/{id}")
 def get_commodity(id: str, db: Session = Depends(get_db)):
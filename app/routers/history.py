@@ -0,0 +1,35 @@
+from fastapi import Depends, APIRouter, HTTPException, Query, status
+from sqlalchemy.orm import Session
+from ..authorization.auth import get_current_simulation
+from ..database import get_db
+from ..models import Simulation
+from ..schemas import HistorySeries
+from ..simulation.history import time_series
+
+router = APIRouter(prefix="/history", tags=["History"])
+
+@router.get("/{group}", response_model=HistorySeries|None)
+def get_history(
+    group: str,
+    fields: str = Query(default="", description="Comma-separated fields; all recorded fields if empty"),
+    start: int|None = None,
+    end: int|None = None,
+    stride: int = Query(default=1, ge=1),
+    bucket: int = Query(default=1, ge=1),
+    db: Session = Depends(get_db),
+    simulation: Simulation = Depends(get_current_simulation),
+):
+    """Time series of the commodities, industries or classes of the
+    simulation of the logged-in user, between time stamps start and end.
+
+    For long runs, use stride to take every n'th period, or bucket to
+    average n consecutive periods, eg /history/industries?fields=profit_rate&bucket=100
+    """
+    if simulation == None:
+        return None
+    try:
+        return time_series(
+            db, simulation.id, group, [field for field in fields.split(",") if field], start, end, stride, bucket
+        )
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(error))
@@ -1,11 +1,12 @@
 from fastapi import status, Depends, APIRouter
 from sqlalchemy.orm import Session
 
-from ..authorization.auth import get_current_simulation
+from ..caching import cached_response, get_current_simulation_if_modified
 from typing import List
 from ..database import get_db
 from ..models import Simulation, Industry
 from ..schemas import IndustryBase
+from ..serialisation import dump_rows
 
 router = APIRouter(prefix="/industries", tags=["Industry"])
 
@@ -14,14 +15,15 @@ router = APIRouter(prefix="/industries", tags=["Industry"])
 @router.get("/", response_model=List[IndustryBase])
 def get_Industries(
     session: Session = Depends(get_db),
-    simulation: Simulation = Depends(get_current_simulation),
+    simulation: Simulation = Depends(get_current_simulation_if_modified),
 ):
     """Get all Industries"""
     # TODO  this should (1) allow the admin user to see all items (2) allow the admin user to filter by user
     if simulation == None:
         return []
-    Industries = session.query(Industry).where(Industry.simulation_id == simulation.id)
-    return Industries
+    return cached_response("industries", simulation, lambda: dump_rows(
+        session, Industry, IndustryBase, Industry.simulation_id == simulation.id
+    ))
 
 
 # get one Industry
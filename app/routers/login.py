@@ -7,7 +7,7 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import  OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 
-from app.authorization.auth import ACCESS_TOKEN_EXPIRE_MINUTES, User, authenticate_user, create_access_token, get_current_user_and_simulation, usPair
+from app.authorization.auth import ACCESS_TOKEN_EXPIRE_MINUTES, User, authenticate_user, create_access_token, get_current_user_and_simulation, token_cache, usPair
 from ..database import get_db
 from ..simulation.logging import report
 from ..schemas import AuthDetails, ServerMessage, Token, UserBase
@@ -38,6 +38,7 @@ async def login_for_access_token(
     db.add(user)
     user.is_logged_in = True
     db.commit()
+    token_cache.forget_user(user.id)
     return Token(access_token=access_token, token_type="bearer")
 
 @router.get("/logout",response_model=ServerMessage)
@@ -57,6 +58,7 @@ async def logout(u:usPair  = Depends(get_current_user_and_simulation), db: Sessi
     db.add(u.user)
     u.user.is_logged_in = False
     db.commit()
+    token_cache.forget_user(u.user.id)
     return {"message":f"{u.user.username} logged out","statusCode":status.HTTP_100_CONTINUE}
 
 @router.post("/register")
@@ -80,6 +82,7 @@ async def register_new_user(
     try:
         if db.query(User).where(User.username == username).first() is not None:
             report(1,1,f"User  {username} tried to register, but the name is taken",db,)
+            db.commit()
             return {"message":f"{username} is already registered","statusCode":status.HTTP_409_CONFLICT}
         report(1,1,f"User {username} will now be added",db,)
         new_user = User(username, password) # the User class will hash this password
@@ -87,7 +90,9 @@ async def register_new_user(
         db.commit()
         return {"message":f"{username} registered","statusCode":status.HTTP_200_OK}
     except Exception as error:
+        db.rollback() # the session may be unusable after the error
         report(1, 1, f"Error trying to register user {username}: {error}", db)
+        db.commit() # the trace
         return {"message":f"Error {error} trying to register {username} ","statusCode":status.HTTP_400_BAD_REQUEST}
 
 @router.get("/{username}",response_model=UserBase)
@@ -1,12 +1,16 @@
-from fastapi import  status, Depends, APIRouter
+from fastapi import  status, Depends, APIRouter, HTTPException, Path
 from sqlalchemy.orm import Session
 from typing import List
-from app.authorization.auth import get_current_user_and_simulation, get_current_simulation
+from app.authorization.auth import get_admin_user, get_current_user_and_simulation, get_current_simulation
 from app.simulation.logging import report
+from ..caching import response_cache
 from ..database import  get_db
-from ..models import Simulation, Commodity,Industry,SocialClass,Trace
+from ..models import Simulation, Commodity,Industry,SocialClass,Trace,History,Industry_stock,Class_stock, forget_simulation_context
 from ..authorization.auth import User, usPair
-from ..schemas import  SimulationBase
+from ..schemas import  SimulationBase, SimulationSnapshot, SweepRequest, SweepRow
+from ..simulation.checkpoint import fork, restore
+from ..simulation.sweep import sweep
+from ..simulation.values import forget_unit_values
 
 router=APIRouter(prefix="/simulations",tags=['Simulation'])
 
@@ -52,6 +56,28 @@ def get_simulations(db: Session = Depends (get_db),u:usPair=Depends(get_current_
     simulations=db.query(Simulation).where(Simulation.user_id==u.user.id)
     return simulations
 
+@router.get("/snapshot",response_model=SimulationSnapshot|None)
+def get_snapshot(db: Session = Depends (get_db),u:usPair=Depends(get_current_user_and_simulation)):
+    """Everything the dashboard needs to draw the current simulation, in one
+    request: the simulation and its version, the user's other simulations,
+    and the commodities, industries, classes and stocks of this simulation.
+    This replaces separate calls to /simulations/mine, /commodities,
+    /industries, /classes, /stocks/industry and /stocks/class.
+    """
+    if u.user is None or u.simulation is None or u.simulation.state=="TEMPLATE": 
+        return None
+    id=u.simulation.id
+    return {
+        "version":u.simulation.version or 0,
+        "simulation":u.simulation,
+        "simulations":db.query(Simulation).where(Simulation.user_id==u.user.id).all(),
+        "commodities":db.query(Commodity).where(Commodity.simulation_id==id).all(),
+        "industries":db.query(Industry).where(Industry.simulation_id==id).all(),
+        "classes":db.query(SocialClass).where(SocialClass.simulation_id==id).all(),
+        "industry_stocks":db.query(Industry_stock).where(Industry_stock.simulation_id==id).all(),
+        "class_stocks":db.query(Class_stock).where(Class_stock.simulation_id==id).all(),
+    }
+
 @router.get("/delete/{id}")
 def delete_simulation(id:str,db: Session=Depends(get_db),u:usPair=Depends(get_current_user_and_simulation)):    
     """
@@ -81,5 +107,101 @@ def delete_simulation(id:str,db: Session=Depends(get_db),u:usPair=Depends(get_cu
     for trace in traceQuery:
         db.delete(trace)
 
+    db.query(History).where(History.simulation_id==int(id)).delete(synchronize_session=False)
+
+    # The user's current simulation becomes their most recent remaining one, if any
+    if u.user.current_simulation==u.simulation.id:
+        remaining=db.query(Simulation.id).where(Simulation.user_id==u.user.id,Simulation.id!=u.simulation.id).order_by(Simulation.id.desc()).first()
+        db.add(u.user)
+        u.user.current_simulation=0 if remaining is None else remaining[0]
+
+    forget_simulation_context(db, int(id))
+    forget_unit_values(int(id))
     db.commit()
+    response_cache.invalidate(int(id))
     return f"Simulation {id} deleted"
+
+@router.get("/engine/{engine}")
+def set_engine(engine:str,db: Session=Depends(get_db),u:usPair=Depends(get_current_user_and_simulation)):
+    """Choose the implementation of the circuit used by the current simulation.
+    "ORM" works through the database objects one at a time.
+    "NUMPY" loads the whole simulation into arrays (see simulation/engine.py).
+    """
+    if u.user is None or u.simulation is None or u.simulation.state=="TEMPLATE": 
+        return None
+    if engine.upper() not in ("ORM","NUMPY"):
+        return f"Unknown engine {engine}"
+    db.add(u.simulation)
+    u.simulation.engine=engine.upper()
+    db.commit()
+    return f"Simulation {u.simulation.id} will use the {u.simulation.engine} engine"
+
+@router.get("/trace_level/{level}")
+def set_trace_level(level:int=Path(ge=1,le=5),db: Session=Depends(get_db),u:usPair=Depends(get_current_user_and_simulation)):
+    """Set the most detailed level of trace (1-5) recorded for the current simulation.
+    Messages at more detailed levels cost almost nothing, since they are never formatted.
+    """
+    if u.user is None or u.simulation is None or u.simulation.state=="TEMPLATE": 
+        return None
+    db.add(u.simulation)
+    u.simulation.trace_level=level
+    db.commit()
+    return f"Simulation {u.simulation.id} will record trace up to level {level}"
+
+@router.post("/sweep",response_model=List[SweepRow])
+def sweep_template(request:SweepRequest,db: Session=Depends(get_db),u:usPair=Depends(get_current_user_and_simulation)):
+    """Run every combination of the parameters in request.parameters on a
+    template, in memory, and return one row per run per period.
+    See simulation/sweep.py for the parameters that can be varied.
+    If request.save is set, each run is also kept as a new simulation of
+    the logged-in user.
+    """
+    if u.user is None:
+        return []
+    template=db.query(Simulation).filter(Simulation.id==request.template_id,Simulation.state=="TEMPLATE").first()
+    if template is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"There is no template with id {request.template_id}")
+    try:
+        table=sweep(db,template,request.parameters,request.periods,u.user,request.save)
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(error))
+    db.commit()
+    return table
+
+@router.get("/restore/{time_stamp}")
+def restore_simulation(time_stamp:int,db: Session=Depends(get_db),u:usPair=Depends(get_current_user_and_simulation)):
+    """Put the current simulation back into the state it was in at time_stamp.
+    Its history after that time is discarded.
+    """
+    if u.user is None or u.simulation is None or u.simulation.state=="TEMPLATE": 
+        return None
+    try:
+        restore(db,u.simulation,time_stamp)
+        u.simulation.changed()
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(error))
+    db.commit()
+    response_cache.invalidate(u.simulation.id)
+    return f"Simulation {u.simulation.id} restored to time stamp {time_stamp}"
+
+@router.get("/fork/{time_stamp}")
+def fork_simulation(time_stamp:int,db: Session=Depends(get_db),u:usPair=Depends(get_current_user_and_simulation)):
+    """Create a new simulation in the state the current simulation was in at
+    time_stamp, and make it the current simulation. The original is not changed.
+    """
+    if u.user is None or u.simulation is None or u.simulation.state=="TEMPLATE": 
+        return None
+    try:
+        new_simulation=fork(db,u.simulation,time_stamp,u.user)
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(error))
+    db.commit()
+    return {"message":f"Simulation {new_simulation.id} forked from simulation {u.simulation.id} at time stamp {time_stamp}","simulation":new_simulation.id}
+
+@router.get("/cache")
+def get_cache_statistics(admin:User=Depends(get_admin_user)):
+    """Hits, misses, evictions and size of the cache of responses to the
+    read endpoints (see caching.py), for sizing settings.response_cache_bytes.
+    Only available to the admin user.
+    """
+    return response_cache.statistics()
@@ -1,24 +1,26 @@
 from fastapi import   Depends, APIRouter
 from sqlalchemy.orm import Session
-from ..authorization.auth import get_current_simulation
+from ..caching import cached_response, get_current_simulation_if_modified
 from typing import List
 from ..database import  get_db
 from ..models import SocialClass,Simulation
 from ..schemas import SocialClassBase
+from ..serialisation import dump_rows
 
 router=APIRouter(prefix="/classes",tags=['Class'])
 
 # get all socialClasses
 @router.get("/",response_model=List[SocialClassBase])
-def get_socialClasses(db: Session = Depends (get_db),simulation:Simulation=Depends(get_current_simulation)):
+def get_socialClasses(db: Session = Depends (get_db),simulation:Simulation=Depends(get_current_simulation_if_modified)):
     """
     API Endpoint which provides all social classes
     TODO should allow the admin user to see all items and filter by user
     """
     if (simulation==None):
         return []
-    socialClasses=db.query(SocialClass).where(SocialClass.simulation_id==simulation.id)
-    return socialClasses
+    return cached_response("classes",simulation,lambda: dump_rows(
+        db,SocialClass,SocialClassBase,SocialClass.simulation_id==simulation.id
+    ))
 
 # get one Social Class
 #TODO restrict to current simulation
@@ -1,23 +1,26 @@
 from fastapi import Depends, APIRouter
 from sqlalchemy.orm import Session
-from ..authorization.auth import get_current_simulation
+from ..caching import cached_response, get_current_simulation_if_modified
 from typing import List
 from ..database import get_db
 from ..models import Class_stock, Industry_stock, Simulation
 from ..schemas import Class_stock_base, Industry_stock_base
+from ..serialisation import dump_rows
 
 router = APIRouter(prefix="/stocks", tags=["Stocks"])
 
 @router.get("/industry", response_model=List[Industry_stock_base])
 def find_industry_stocks(
     db: Session = Depends(get_db),
-    simulation: Simulation = Depends(get_current_simulation),
+    simulation: Simulation = Depends(get_current_simulation_if_modified),
 ):
     """Get all industry stocks in one simulation.
     Return empty list if simulation is None."""
     if simulation == None:
         return []
-    return db.query(Industry_stock).filter(Industry_stock.simulation_id == simulation.id)
+    return cached_response("industry_stocks", simulation, lambda: dump_rows(
+        db, Industry_stock, Industry_stock_base, Industry_stock.simulation_id == simulation.id
+    ))
 
 @router.get("/industry/{id}")
 def get_stock(id: str, db: Session = Depends(get_db)):
@@ -27,13 +30,15 @@ def get_stock(id: str, db: Session = Depends(get_db)):
 @router.get("/class", response_model=List[Class_stock_base])
 def find_class_stocks(
     db: Session = Depends(get_db),
-    simulation: Simulation = Depends(get_current_simulation),
+    simulation: Simulation = Depends(get_current_simulation_if_modified),
 ):
     """Get all class stocks in one simulation.
     Return empty list if simulation is None"""
     if simulation == None:
         return []
-    return db.query(Class_stock).filter(Class_stock.simulation_id == simulation.id)
+    return cached_response("class_stocks", simulation, lambda: dump_rows(
+        db, Class_stock, Class_stock_base, Class_stock.simulation_id == simulation.id
+    ))
 
 @router.get("/class/{id}")
 def get_stock(id: str, db: Session = Depends(get_db)):
@@ -1,10 +1,11 @@
 from fastapi import  Depends, APIRouter
 from sqlalchemy.orm import Session
 from typing import List
-from ..authorization.auth import get_current_simulation
+from ..caching import cached_response, get_current_simulation_if_modified
 from ..database import  get_db
 from ..models import Simulation,Trace
 from ..schemas import TraceOut
+from ..serialisation import dump_rows
 
 
 router=APIRouter(
@@ -14,8 +15,7 @@ router=APIRouter(
 
 # get all trace records
 @router.get("/",response_model=List[TraceOut])
-def get_trace(db: Session = Depends (get_db),simulation:Simulation=Depends(get_current_simulation)):
+def get_trace(db: Session = Depends (get_db),simulation:Simulation=Depends(get_current_simulation_if_modified)):
     if (simulation==None):
         return []
-    trace=db.query(Trace).where(Trace.simulation_id==simulation.id)
-    return trace
+    return cached_response("trace",simulation,lambda: dump_rows(db,Trace,TraceOut,Trace.simulation_id==simulation.id))
@@ -1,15 +1,14 @@
 """This module provides the endpoints for users management.
-TODO clone function and endpoints should probably be in a separate module."""
+The cloning itself is done in simulation/clone.py."""
 
-from fastapi import APIRouter, Depends
+import numpy as np
+from fastapi import APIRouter, Depends, HTTPException, status
 from typing import List
 from app.authorization.auth import get_current_user_and_simulation, usPair, User
 from app.database import get_db
 from app.schemas import UserBase
-from app.simulation.logging import report
-from app.simulation.reload import initialise_buyers_and_sellers
-from app.simulation.utils import calculate_current_capitals, calculate_initial_capitals, clone_model, revalue_commodities, revalue_stocks
-from ..models import Class_stock, Commodity, Industry, Industry_stock, SocialClass, Simulation
+from app.simulation.clone import clone_from_snapshot
+from ..models import Simulation
 
 from sqlalchemy.orm import Session
 
@@ -32,169 +31,30 @@ def get_user(username: str, db: Session = Depends(get_db)):
 @router.get("/clone/{id}")
 def create_simulation_from_template(
     id: str,
+    solve_values: bool = False,
     db: Session = Depends(get_db),
     u:usPair = Depends(get_current_user_and_simulation),
 )->dict:
     """Create a complete clone of the template defined by 'id'.
     Rename the current user to be the user who requested this.
+    With ?solve_values=true, calculate unit values from the input-output
+    structure of the template instead of copying them; if they cannot be
+    solved for, reply 422 and create nothing.
     Return a dictionary with two items:
         message: a description of what was done
         simulation: the id of the new simulation
     """
-    template = db.query(Simulation).filter(Simulation.id == int(id)).first()
-    new_simulation:Simulation = clone_model(template, db)
-    if new_simulation is None:
-        print("Illegal call to clone. Quitting without doing anything")
-        return
-    report(1,1,
-        f"Create new simulation for {u.user.username} from template {template.name} with id {new_simulation.id}",db,)
-
-# we commit twice, because we want to get the autogenerated id. There's probably a better way
-
-    db.add(new_simulation)
-    new_simulation.user_id = u.user.id
-    new_simulation.username = u.user.username
-    db.add(new_simulation)
-    db.add(u.user)
-
-# Set the initial state to be the start point of the simulation
-
-    new_simulation.state = "DEMAND"  
-    u.user.current_simulation = (
-        new_simulation.id
-    )  # when we create a new simulation, this is (initially) the current simulation
-    db.commit()  # TODO reduce number of commits?
-
-# Clone all commodities in this simulation
-
-    commodities = db.query(Commodity).filter(Commodity.simulation_id == template.id)
-    for commodity in commodities:
-        report(2,1,f"Cloning commodity {commodity.name}",db,)
-        new_commodity:Commodity = clone_model(commodity, db)
-
-# we commit twice, because we want to get the autogenerated id. There's probably a better way
-
-        db.add(new_commodity)
-
-# seems to be transient after it is committed, which is a bit weird. So bring it out again, because we will modify it by adding successor_id
-
-        db.add(commodity) 
-        new_commodity.simulation_id = new_simulation.id
-        new_commodity.username = u.user.username
-        commodity.successor_id = new_commodity.id
-        db.commit()
-
-# Clone all industries in this simulation
-
-    industries = db.query(Industry).filter(Industry.simulation_id == template.id)
-    for industry in industries:
-        report(2,1,f"Cloning industry {industry.name}",db,)
-        new_industry:Industry = clone_model(industry, db)
-
-# we commit twice, because we want to get the autogenerated id. There's probably a better way
-
-        db.add(new_industry)
-
-# seems to be transient after we committed it, which is a bit weird - so bring it out again, because we're going to modify it
-
-        db.add(industry)
-        new_industry.simulation_id = new_simulation.id
-        new_industry.username = u.user.username
-        industry.successor_id = new_industry.id
-        db.commit()
-
-# Clone all classes in this simulation
-
-    classes = db.query(SocialClass).filter(SocialClass.simulation_id == template.id)
-    for socialClass in classes:
-        report(
-            2,
-            1,
-            f"Cloning class {socialClass.name}",
-            db,
-        )
-        new_class:SocialClass = clone_model(socialClass, db)
-        db.add(
-            new_class
-        )  # we commit twice, because we want to get the autogenerated id. There's probably a better way
-        db.add(
-            socialClass  # seems to be transient after we committed it, which is a bit weird - so bring it out again, because we're going to modify it
-        )
-        new_class.simulation_id = new_simulation.id
-        new_class.username = u.user.username
-        socialClass.successor_id = new_class.id
-        db.commit()
-
-    # Clone all industry stocks in this simulation
-    stocks = db.query(Industry_stock).filter(Industry_stock.simulation_id == template.id)
-    for stock in stocks:
-        report(3,1,
-            f"Cloning industry stock {stock.name} with id {stock.id}, industry id {stock.industry(db).id} , and commodity  {stock.commodity(db).name} [id {stock.commodity(db).id}]",
-            db,
-        )
-        old_industry:Industry = stock.industry(db)
-        old_commodity:Commodity = stock.commodity(db)
-        successor_commodity_id = old_commodity.successor_id
-        successor_id = old_industry.successor_id
-        new_industry_stock:Industry_stock = clone_model(stock, db)
-        db.add(new_industry_stock)  # we commit twice, because we want to get the autogenerated id. There's probably a better way
-        new_industry_stock.simulation_id = new_simulation.id
-        # This stock now has to be connected with its owner and commodity objects in the new simulation
-        new_industry_stock.industry_id = successor_id
-        new_industry_stock.username = u.user.username
-        new_industry_stock.commodity_id = successor_commodity_id
-        new_industry_stock.commodity_name=new_industry_stock.commodity(db).name+"(sim "+str(new_industry_stock.commodity(db).simulation_id)+")"
-        new_industry_stock.industry_name=new_industry_stock.industry(db).name+"(sim "+str(new_industry_stock.industry(db).simulation_id)+")"
-        
-        # For diagnostic purposes, leave the name as it was. 
-        # This allows us to track the origin of the cloned stock
-        # to replace by a new name, uncomment the 6 lines below:        
-        # new_industry_stock.name = (
-        #     new_industry_stock.industry(db).name+ "."
-        #     + new_industry_stock.commodity(db).name+ "."
-        #     + new_industry_stock.usage_type+ "."
-        #     + str(new_industry_stock.simulation_id)
-        # )
-
-        db.commit()
-
-    # Clone all class stocks in this simulation
-    stocks = db.query(Class_stock).filter(Class_stock.simulation_id == template.id)
-    for stock in stocks:
-        report(3,1,
-            f"Cloning class stock {stock.name} with id {stock.id}, class id {stock.social_class(db).id} , and commodity  {stock.commodity(db).name} [id {stock.commodity(db).id}]",
-            db,
-        )
-        old_class:SocialClass = stock.social_class(db)
-        old_commodity:Commodity = stock.commodity(db)
-        successor_commodity_id = old_commodity.successor_id
-        successor_id = old_class.successor_id
-        new_class_stock:Class_stock = clone_model(stock, db)
-        db.add(new_class_stock)  # we commit twice, because we want to get the autogenerated id. There's probably a better way
-        new_class_stock.simulation_id = new_simulation.id
-        # This stock now has to be connected with its owner and commodity objects in the new simulation
-        new_class_stock.class_id = successor_id
-        new_class_stock.username = u.user.username
-        new_class_stock.commodity_id = successor_commodity_id
-        new_class_stock.commodity_name=new_class_stock.commodity(db).name+"(sim "+str(new_class_stock.commodity(db).simulation_id)+")"
-        new_class_stock.class_name=new_class_stock.social_class(db).name+"(sim "+str(new_class_stock.social_class(db).simulation_id)+")"
-
-        # For diagnostic purposes, leave the name as it was. 
-        # This allows us to track the origin of the cloned stock
-        # to replace by a new name, uncomment the 6 lines below:        
-        # new_class_stock.name = (
-        #     new_class_stock.social_class(db).name+ "."
-        #     + new_class_stock.commodity(db).name+ "."
-        #     + new_class_stock.usage_type+ "."
-        #     + str(new_class_stock.simulation_id)
-        # )
-        db.commit()
-
-    initialise_buyers_and_sellers(db, new_simulation.id)
-    revalue_commodities(db,new_simulation)
-    revalue_stocks(db,new_simulation)
-    calculate_initial_capitals(db,new_simulation)
-    calculate_current_capitals(db,new_simulation)
+    if u.user is None:
+        return None
+    template = db.query(Simulation).filter(Simulation.id == int(id), Simulation.state == "TEMPLATE").first()
+    if template is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"There is no template with id {id}")
+    try:
+        new_simulation:Simulation = clone_from_snapshot(db, template, u.user, solve_values)
+    except (ValueError, np.linalg.LinAlgError) as error:
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"Cannot solve for unit values: {error}")
+    db.commit()
     result = {
         "message": f"Cloned Template with id {id} into simulation with id {new_simulation.id}",
         "simulation": new_simulation.id,
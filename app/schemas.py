@@ -1,5 +1,5 @@
 import http
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 class AuthDetails(BaseModel):
     username: str
@@ -33,6 +33,9 @@ class SimulationBase(BaseModel):
     currency_symbol: str
     quantity_symbol: str
     melt: float
+    engine: str
+    trace_level: int|None = None
+    version: int|None = None
     owner: UserBase
 
     class Config:
@@ -143,3 +146,51 @@ class SellerBase(BaseModel):
     money_stock_id: int
     commodity_id: int
 
+
+class PeriodSummary(BaseModel):
+    period: int
+    total_value: float
+    total_price: float
+    profit: float
+    profit_rate: float
+
+class UnitValueCheck(BaseModel):
+    id: int
+    name: str
+    unit_value: float
+    solved_unit_value: float|None
+    difference: float|None
+
+class SweepRequest(BaseModel):
+    template_id: int
+    parameters: dict[str, list[float]]
+    periods: int = Field(default=1, ge=1)
+    save: bool = False
+
+class SweepRow(BaseModel):
+    run: int
+    parameters: dict[str, float]
+    period: int
+    total_value: float
+    total_price: float
+    profit: float
+    profit_rate: float
+
+class HistorySeries(BaseModel):
+    simulation_id: int
+    group: str
+    time_stamp: list[int]
+    id: list[int]
+    name: list[str]
+    series: dict[str, list[list[float]]]
+
+class SimulationSnapshot(BaseModel):
+    """Everything the dashboard shows for the current simulation."""
+    version: int
+    simulation: SimulationBase
+    simulations: list[SimulationBase]
+    commodities: list[CommodityBase]
+    industries: list[IndustryBase]
+    classes: list[SocialClassBase]
+    industry_stocks: list[Industry_stock_base]
+    class_stocks: list[Class_stock_base]
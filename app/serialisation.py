@@ -0,0 +1,44 @@
+"""Fast JSON for the endpoints that return every object of one kind in a
+simulation (stocks, commodities, industries, classes, trace).
+
+FastAPI would build an ORM object for every row, validate it into the
+pydantic schema given as response_model, and then encode the result.
+dump_rows() instead selects just the columns named in the schema, as
+plain tuples, and encodes them with orjson. The JSON has the same fields,
+in the same order, as the schema would produce, and the objects are in
+order of their primary key. Float fields are cast to REAL in the query,
+since SQLite would otherwise return whole numbers as integers.
+
+Because nothing is validated, a NULL in a column whose schema field is
+not Optional is replaced in the query by the empty value of its type
+(0, 0.0, "" or false), so that the JSON still conforms to the schema.
+pydantic would instead have rejected the whole response.
+
+The schema remains the response_model of the endpoint, so the API
+documentation is unchanged.
+"""
+
+import orjson
+from pydantic import BaseModel
+from sqlalchemy import Float, cast, func, literal, select
+from sqlalchemy.orm import Session
+
+EMPTY_VALUES = {int: 0, float: 0.0, str: "", bool: False}  # what NULL becomes in fields that are not Optional
+
+def schema_columns(model, schema:type[BaseModel])->list:
+    """The columns of model that make up schema, labelled with the field names."""
+    columns = []
+    for name, field in schema.model_fields.items():
+        column = getattr(model, name)
+        if field.annotation is float:
+            column = cast(column, Float)
+        if field.annotation in EMPTY_VALUES:
+            column = func.coalesce(column, literal(EMPTY_VALUES[field.annotation]))
+        columns.append(column.label(name))
+    return columns
+
+def dump_rows(db:Session, model, schema:type[BaseModel], *criteria)->bytes:
+    """The JSON list of every object of model satisfying criteria, in the form given by schema."""
+    names = list(schema.model_fields)
+    rows = db.execute(select(*schema_columns(model, schema)).where(*criteria).order_by(*model.__table__.primary_key.columns))
+    return orjson.dumps([dict(zip(names, row)) for row in rows])
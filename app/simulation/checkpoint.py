@@ -0,0 +1,99 @@
+"""Putting a simulation back into the state it was in at an earlier time
+stamp, from the checkpoint held in its History (see history.py).
+
+restore() rewinds the simulation itself, with one bulk update per
+table, and discards its history after that time stamp. fork() instead
+creates a new simulation in that state, leaving the original alone, so
+that a different course can be followed from there.
+
+Neither reads or replays the periods in between, so the time taken does
+not depend on how far back the checkpoint is.
+"""
+
+import numpy as np
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+from ..authorization.auth import User
+from ..models import Class_stock, Commodity, History, Industry, Industry_stock, Simulation, SocialClass, forget_simulation_context
+from .clone import copy_objects, new_simulation_from
+from .engine import CLASS_FIELDS, COMMODITY_FIELDS, INDUSTRY_FIELDS, STOCK_FIELDS, _bulk_update
+from .history import record_history, unpack_checkpoint
+from .logging import report
+from .reload import initialise_buyers_and_sellers
+from .values import forget_unit_values
+
+CHECKPOINT_TABLES = [
+    ("commodities", Commodity, COMMODITY_FIELDS),
+    ("industries", Industry, INDUSTRY_FIELDS),
+    ("classes", SocialClass, CLASS_FIELDS),
+    ("industry_stocks", Industry_stock, STOCK_FIELDS),
+    ("class_stocks", Class_stock, STOCK_FIELDS),
+]
+
+def find_checkpoint(db:Session, simulation:Simulation, time_stamp:int)->dict[str, dict[str, np.ndarray]]:
+    """The checkpoint of simulation at time_stamp (see history.unpack_checkpoint).
+
+    Raises ValueError if none was recorded.
+    """
+    history = db.execute(
+        select(History).where(History.simulation_id == simulation.id, History.time_stamp == time_stamp)
+    ).scalar_one_or_none()
+    if history is None:
+        raise ValueError(f"Simulation {simulation.id} has no record of time stamp {time_stamp}")
+    return unpack_checkpoint(history)
+
+def _write_checkpoint(db:Session, checkpoint:dict[str, dict[str, np.ndarray]], ids:dict[str, np.ndarray]|None=None):
+    """Write every field of the checkpoint, one bulk update per table.
+    If ids is given, the objects written are ids[name] instead of those
+    recorded in the checkpoint, position for position."""
+    for name, model, fields in CHECKPOINT_TABLES:
+        columns = checkpoint[name]
+        _bulk_update(db, model, columns["id"] if ids is None else ids[name], columns, fields)
+
+def restore(db:Session, simulation:Simulation, time_stamp:int):
+    """Put simulation back into the state it was in at time_stamp, ready to
+    start the next circuit, and discard its history after that time.
+
+    Raises ValueError if there is no checkpoint for time_stamp. Does not commit.
+    """
+    checkpoint = find_checkpoint(db, simulation, time_stamp)
+    report(1, simulation.id, f"RESTORING THE SIMULATION TO TIME STAMP {time_stamp}", db)
+    _write_checkpoint(db, checkpoint)
+    db.execute(delete(History).where(History.simulation_id == simulation.id, History.time_stamp > time_stamp))
+    db.add(simulation)
+    simulation.state = "DEMAND"
+    simulation.time_stamp = time_stamp
+    forget_simulation_context(db, simulation.id)
+    forget_unit_values(simulation.id)
+
+def fork(db:Session, simulation:Simulation, time_stamp:int, user:User)->Simulation:
+    """Create a new simulation for user, in the state that simulation was in
+    at time_stamp, and make it the user's current simulation.
+
+    The objects are copied as clone_simulation() copies them, and the
+    checkpoint is then written over them. The new simulation's history
+    starts at time_stamp.
+
+    Raises ValueError if there is no checkpoint for time_stamp. Does not commit.
+    """
+    checkpoint = find_checkpoint(db, simulation, time_stamp)
+    new_simulation = new_simulation_from(db, simulation, user)
+    report(1, new_simulation.id,
+        f"Create new simulation for {user.username} from simulation {simulation.id} at time stamp {time_stamp}", db)
+    copy_objects(db, simulation, new_simulation, user.username)
+
+    # Objects are copied in id order, so the n'th object of the original
+    # corresponds to the n'th object of the copy.
+    ids = {}
+    for name, model, fields in CHECKPOINT_TABLES:
+        original = db.execute(select(model.id).where(model.simulation_id == simulation.id).order_by(model.id)).scalars().all()
+        copied = db.execute(select(model.id).where(model.simulation_id == new_simulation.id).order_by(model.id)).scalars().all()
+        successor = dict(zip(original, copied))
+        ids[name] = np.array([successor[id] for id in checkpoint[name]["id"].tolist()], dtype=int)
+    _write_checkpoint(db, checkpoint, ids)
+
+    new_simulation.time_stamp = time_stamp
+    forget_simulation_context(db, new_simulation.id)
+    initialise_buyers_and_sellers(db, new_simulation.id)
+    record_history(db, new_simulation)
+    return new_simulation
@@ -0,0 +1,197 @@
+"""The circuit of capital as a sequence of stages.
+
+Each stage function carries out one action on one simulation and moves
+the simulation on to the next state of the circuit. They are called by
+the handlers in routers/actions.py, one stage per request, and by
+run_circuits(), which takes a simulation through any number of
+complete circuits.
+
+None of these functions commit. The caller decides where the
+transaction ends, so that a single action, or a run of many periods,
+is one transaction.
+"""
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from ..models import Commodity, Industry, Simulation
+from .consumption import consume
+from .demand import class_demand, commodity_demand, initialise_demand, industry_demand
+from .engine import SimulationArrays, run_stage
+from .history import history_row, record_history, save_history
+from .invest import invest
+from .logging import report
+from .production import produce
+from .supply import calculate_supply
+from .trade import buy_and_sell, constrain_demand
+from .utils import calculate_current_capitals, recalculate_commodity_totals, revalue_commodities, revalue_stocks
+from .values import forget_unit_values
+
+def demand_stage(db:Session, simulation:Simulation):
+    """Set demand for every stock and commodity."""
+    if simulation.engine=="NUMPY":
+        run_stage(db, simulation, "demand")
+    else:
+        initialise_demand(db, simulation)
+        industry_demand(db, simulation) # tell industries to register their demand with their stocks.
+        class_demand(db, simulation)  # tell classes to register their demand with their stocks.
+        commodity_demand(db, simulation)  # tell the commodities to tot up the demand from all stocks of them.
+    db.add(simulation)
+    simulation.state = "SUPPLY" # set the next state in the circuit, obliging the user to do this next.
+
+def supply_stage(db:Session, simulation:Simulation):
+    """Set the supply of every commodity from the sales stocks of it."""
+    if simulation.engine=="NUMPY":
+        run_stage(db, simulation, "supply")
+    else:
+        calculate_supply(db, simulation)
+    db.add(simulation)
+    simulation.state = "TRADE"
+
+def trade_stage(db:Session, simulation:Simulation):
+    """Allocate supply, conduct trade, then recalculate demand and supply."""
+    db.add(simulation)
+    simulation.state = "CONSUME"
+    if simulation.engine=="NUMPY":
+        run_stage(db, simulation, "trade") # includes the recalculation of demand and supply below
+        return
+
+    constrain_demand(db, simulation)
+    buy_and_sell(db, simulation)
+
+# Reset commodity demand from stock demands
+
+    commodity_demand(db,simulation)
+
+# Reset commodity supply from industry and class supplies
+
+    calculate_supply(db, simulation)
+
+    # TODO I don't think it's necessary to also to revalue, but check.
+    # It should not be necessary, because trade only involves a change of ownership.
+    # If it is necessary, we should probably implement the line below.
+
+    # revalue_stocks(db,simulation)
+
+def produce_stage(db:Session, simulation:Simulation):
+    """Tell every industry to produce, then recalculate commodity totals,
+    current capitals and profits (see produceHandler)."""
+    db.add(simulation)
+    simulation.state = "CONSUME"
+    if simulation.engine=="NUMPY":
+        run_stage(db, simulation, "produce") # includes the recalculations below
+        return
+
+    produce(db, simulation)
+
+# Recalculate commodity totals (but do not revalue or reprice)
+
+    recalculate_commodity_totals(db,simulation)
+
+# Recalculate current capital and profit
+
+    calculate_current_capitals(db,simulation)
+
+def consume_stage(db:Session, simulation:Simulation):
+    """Tell every social class to consume and reproduce, then recalculate
+    unit values and prices and revalue every stock."""
+    db.add(simulation)
+    simulation.state = "INVEST"
+    if simulation.engine=="NUMPY":
+        run_stage(db, simulation, "consume") # includes the revaluations below
+        return
+
+    consume(db, simulation)
+    recalculate_commodity_totals(db,simulation)
+    revalue_commodities(db,simulation)
+    # Then recalculate the price and value of every stock
+    revalue_stocks(db, simulation)
+    calculate_current_capitals(db,simulation)
+
+def invest_stage(db:Session, simulation:Simulation):
+    """Tell every industry to decide its output scale for the next circuit.
+    This completes the circuit, so move on to the next period and record
+    the state of the simulation in its history."""
+    arrays = None
+    if simulation.engine=="NUMPY":
+        arrays = run_stage(db, simulation, "invest")
+    else:
+        report(1,simulation.id,"INVESTING", db)
+        invest(simulation,db)
+    forget_unit_values(simulation.id) # output scales have changed
+    db.add(simulation)
+    simulation.state = "DEMAND"
+    simulation.time_stamp = (simulation.time_stamp or 0) + 1
+    record_history(db, simulation, arrays)
+
+CIRCUIT = [
+    demand_stage,
+    supply_stage,
+    trade_stage,
+    produce_stage,
+    consume_stage,
+    invest_stage,
+]
+
+def summarise(db:Session, simulation:Simulation, period:int)->dict:
+    """A compact description of the state of the simulation at the end
+    of a period: totals over all commodities and all industries."""
+    db.flush()
+    total_value, total_price = db.execute(
+        select(func.sum(Commodity.total_value), func.sum(Commodity.total_price))
+        .where(Commodity.simulation_id == simulation.id)
+    ).one()
+    profit, initial_capital = db.execute(
+        select(func.sum(Industry.profit), func.sum(Industry.initial_capital))
+        .where(Industry.simulation_id == simulation.id)
+    ).one()
+    return period_summary(period, total_value, total_price, profit, initial_capital)
+
+def period_summary(period:int, total_value:float, total_price:float, profit:float, initial_capital:float)->dict:
+    profit = profit or 0.0
+    return {
+        "period": period,
+        "total_value": float(total_value or 0.0),
+        "total_price": float(total_price or 0.0),
+        "profit": float(profit),
+        "profit_rate": float(profit/initial_capital) if initial_capital else 0.0,
+    }
+
+def run_circuits(db:Session, simulation:Simulation, periods:int)->list[dict]:
+    """Take the simulation through 'periods' complete circuits, starting
+    from the DEMAND state, and return a summary of each period.
+
+    With the NUMPY engine, the simulation is loaded once, every period is
+    calculated in memory, and the result is written back once at the end,
+    together with the history of every period in one bulk insert.
+    """
+    report(1, simulation.id, f"RUNNING {periods} PERIODS", db)
+    if simulation.engine!="NUMPY":
+        summaries = []
+        for period in range(1, periods+1):
+            for stage in CIRCUIT:
+                stage(db, simulation)
+            summaries.append(summarise(db, simulation, period))
+        return summaries
+
+    arrays = SimulationArrays.load(db, simulation)
+    summaries = []
+    history = []
+    time_stamp = simulation.time_stamp or 0
+    for period in range(1, periods+1):
+        arrays.circuit()
+        time_stamp += 1
+        history.append(history_row(arrays, time_stamp))
+        summaries.append(period_summary(
+            period,
+            arrays.commodity["total_value"].sum(),
+            arrays.commodity["total_price"].sum(),
+            arrays.industry["profit"].sum(),
+            arrays.industry["initial_capital"].sum(),
+        ))
+    arrays.flush(db)
+    forget_unit_values(simulation.id) # output scales have changed
+    save_history(db, history)
+    db.add(simulation)
+    simulation.state = "DEMAND"
+    simulation.time_stamp = time_stamp
+    return summaries
@@ -0,0 +1,254 @@
+"""Functions which create a new simulation by cloning a template or
+another simulation.
+
+clone_from_snapshot() builds the new simulation from a copy of the
+template held in memory (see TemplateSnapshot), using one bulk insert
+per table. Templates do not change, so the snapshot is made once.
+
+clone_simulation() copies a simulation that may have changed since it
+was created, such as a running simulation that is being forked, with a
+single INSERT ... SELECT statement per table (see copy_objects()).
+
+Both work in one transaction and leave the new simulation ready to run,
+with its buyers and sellers initialised and its stocks and capitals
+valued, but do not commit. That is left to the caller.
+benchmarks/clone.py compares them with the original implementation,
+which copied and committed one object at a time.
+"""
+
+from sqlalchemy import insert, literal, select, update
+from sqlalchemy.orm import Session
+from ..authorization.auth import User
+from ..models import Class_stock, Commodity, Industry, Industry_stock, SocialClass, Simulation, forget_simulation_context
+from .logging import report
+from .reload import initialise_buyers_and_sellers
+from .utils import calculate_current_capitals, calculate_initial_capitals, recalculate_commodity_totals, revalue_commodities, revalue_stocks
+from .history import record_history
+from .values import apply_unit_values
+
+class TemplateSnapshot:
+    """A copy of the objects of one template, held in memory.
+
+    Each object is a dictionary of its column values, without its id,
+    simulation_id, username or successor_id. Objects are listed in id
+    order. In the stocks, industry_id, class_id and commodity_id are
+    replaced by the position of the owner or commodity in these lists,
+    so that the snapshot does not depend on the ids in the database.
+
+    Templates do not change between resets, so one snapshot per
+    template is kept (see template_snapshot()) until /action/reset
+    calls forget_templates().
+    """
+
+    def __init__(self, db:Session, template:Simulation):
+        self.commodities, commodity_index = _snapshot_rows(db, Commodity, template.id)
+        self.industries, industry_index = _snapshot_rows(db, Industry, template.id)
+        self.classes, class_index = _snapshot_rows(db, SocialClass, template.id)
+        self.industry_stocks = _snapshot_stocks(db, Industry_stock, "industry_id", industry_index, commodity_index, template.id)
+        self.class_stocks = _snapshot_stocks(db, Class_stock, "class_id", class_index, commodity_index, template.id)
+
+    def materialise(self, db:Session, simulation_id:int, username:str):
+        """Create the objects of this snapshot in the given simulation, one bulk insert per table."""
+        owned = {"simulation_id": simulation_id, "username": username}
+        suffix = f"(sim {simulation_id})"
+        commodity_ids = _insert_returning_ids(db, Commodity, [{**row, **owned} for row in self.commodities])
+        industry_ids = _insert_returning_ids(db, Industry, [{**row, **owned} for row in self.industries])
+        class_ids = _insert_returning_ids(db, SocialClass, [{**row, **owned} for row in self.classes])
+        _insert(db, Industry_stock, [
+            {
+                **row, **owned,
+                "industry_id": industry_ids[row["industry_id"]],
+                "commodity_id": commodity_ids[row["commodity_id"]],
+                "industry_name": self.industries[row["industry_id"]]["name"] + suffix,
+                "commodity_name": self.commodities[row["commodity_id"]]["name"] + suffix,
+            }
+            for row in self.industry_stocks
+        ])
+        _insert(db, Class_stock, [
+            {
+                **row, **owned,
+                "class_id": class_ids[row["class_id"]],
+                "commodity_id": commodity_ids[row["commodity_id"]],
+                "class_name": self.classes[row["class_id"]]["name"] + suffix,
+                "commodity_name": self.commodities[row["commodity_id"]]["name"] + suffix,
+            }
+            for row in self.class_stocks
+        ])
+
+_snapshots:dict[int, TemplateSnapshot] = {}
+
+def template_snapshot(db:Session, template:Simulation)->TemplateSnapshot:
+    """The snapshot of template, made the first time it is asked for.
+
+    Only templates are kept. Any other simulation changes as it runs, so
+    a fresh snapshot of it is made every time.
+    """
+    if template.state != "TEMPLATE":
+        return TemplateSnapshot(db, template)
+    if template.id not in _snapshots:
+        _snapshots[template.id] = TemplateSnapshot(db, template)
+    return _snapshots[template.id]
+
+def forget_templates():
+    """Discard all template snapshots, because the templates have been reloaded.
+
+    Each worker process has its own snapshots, so this only affects the
+    process which handled the reset. Since a reset reloads the same
+    fixtures, the snapshots held by other processes remain correct unless
+    the fixtures themselves have been changed.
+    """
+    _snapshots.clear()
+
+def clone_from_snapshot(db:Session, template:Simulation, user:User, solve_values:bool=False, make_current:bool=True)->Simulation:
+    """Create a new simulation for user from the snapshot of template, and,
+    unless make_current is False, make it the user's current simulation.
+
+    Apart from the first clone of each template, which makes the snapshot,
+    this does not read the template's objects at all.
+
+    If solve_values is set, unit values are calculated from the input-output
+    structure (see initialise_clone).
+    """
+    snapshot = template_snapshot(db, template)
+    new_simulation = new_simulation_from(db, template, user, make_current)
+    report(1,1,
+        f"Create new simulation for {user.username} from template {template.name} with id {new_simulation.id}",db,)
+    snapshot.materialise(db, new_simulation.id, user.username)
+    initialise_clone(db, new_simulation, solve_values)
+    return new_simulation
+
+def clone_simulation(db:Session, source:Simulation, user:User, make_current:bool=True)->Simulation:
+    """Create a new simulation for user, copied from source, and, unless
+    make_current is False, make it the user's current simulation.
+    The source itself is not modified."""
+    new_simulation = new_simulation_from(db, source, user, make_current)
+    report(1,1,
+        f"Create new simulation for {user.username} from simulation {source.name} with id {new_simulation.id}",db,)
+    copy_objects(db, source, new_simulation, user.username)
+    initialise_clone(db, new_simulation)
+    return new_simulation
+
+def copy_objects(db:Session, source:Simulation, new_simulation:Simulation, username:str):
+    """Copy every object of source into new_simulation, in id order.
+
+    Each table is copied by one INSERT ... SELECT. While copying, the new
+    commodities, industries and classes record the id of the object they
+    were copied from in successor_id. The stocks are then copied with a
+    join on this column, which maps the ids of their owners and
+    commodities to those of the new objects, leaving out stocks whose
+    owner or commodity is not in source. Finally successor_id is cleared.
+    """
+    for model in (Commodity, Industry, SocialClass):
+        _copy_rows(db, model, source.id, new_simulation.id, username)
+    _copy_stocks(db, Industry_stock, Industry, Industry_stock.industry_id, "industry_name", source.id, new_simulation.id, username)
+    _copy_stocks(db, Class_stock, SocialClass, Class_stock.class_id, "class_name", source.id, new_simulation.id, username)
+    for model in (Commodity, Industry, SocialClass):
+        db.execute(update(model).where(model.simulation_id == new_simulation.id).values(successor_id=None))
+
+def _copy_rows(db:Session, model, source_id:int, simulation_id:int, username:str):
+    """Copy every Commodity, Industry or SocialClass of source into the
+    new simulation, setting successor_id to the id of the original."""
+    columns = _copied_columns(model, "simulation_id", "username", "successor_id")
+    source = (
+        select(*[getattr(model, c) for c in columns], literal(simulation_id), literal(username), model.id)
+        .where(model.simulation_id == source_id)
+        .order_by(model.id)
+    )
+    db.execute(insert(model).from_select([*columns, "simulation_id", "username", "successor_id"], source))
+
+def _copy_stocks(db:Session, stock_model, owner_model, owner_id, owner_name:str, source_id:int, simulation_id:int, username:str):
+    """Copy every stock of source into the new simulation, connecting
+    each copy with the copies of its owner and its commodity.
+
+    owner_id is the column of stock_model which refers to owner_model, and
+    owner_name the column holding the owner's name for diagnostic purposes.
+    """
+    columns = _copied_columns(stock_model, "simulation_id", "username", owner_id.key, "commodity_id", owner_name, "commodity_name")
+    suffix = f"(sim {simulation_id})"
+    source = (
+        select(
+            *[getattr(stock_model, c) for c in columns],
+            literal(simulation_id),
+            literal(username),
+            owner_model.id,
+            Commodity.id,
+            owner_model.name + suffix,
+            Commodity.name + suffix,
+        )
+        .join(owner_model, (owner_model.successor_id == owner_id) & (owner_model.simulation_id == simulation_id))
+        .join(Commodity, (Commodity.successor_id == stock_model.commodity_id) & (Commodity.simulation_id == simulation_id))
+        .where(stock_model.simulation_id == source_id)
+        .order_by(stock_model.id)
+    )
+    db.execute(insert(stock_model).from_select(
+        [*columns, "simulation_id", "username", owner_id.key, "commodity_id", owner_name, "commodity_name"], source
+    ))
+
+def _snapshot_rows(db:Session, model, template_id:int)->tuple[list[dict], dict[int, int]]:
+    """The objects of model in the template, as dictionaries, and the position of each id in the list."""
+    columns = _copied_columns(model, "simulation_id", "username", "successor_id")
+    rows = db.execute(
+        select(model.id, *[getattr(model, c) for c in columns]).where(model.simulation_id == template_id).order_by(model.id)
+    ).all()
+    return [dict(zip(columns, row[1:])) for row in rows], {row[0]: i for i, row in enumerate(rows)}
+
+def _snapshot_stocks(db:Session, model, owner_id:str, owner_index:dict[int, int], commodity_index:dict[int, int], template_id:int)->list[dict]:
+    """The stocks of the template, with owner and commodity ids replaced by positions.
+
+    Stocks whose owner or commodity is not in the template are left out.
+    """
+    rows, _ = _snapshot_rows(db, model, template_id)
+    return [
+        {**row, owner_id: owner_index[row[owner_id]], "commodity_id": commodity_index[row["commodity_id"]]}
+        for row in rows
+        if row[owner_id] in owner_index and row["commodity_id"] in commodity_index
+    ]
+
+def _insert_returning_ids(db:Session, model, rows:list[dict])->list[int]:
+    """Insert rows in one statement and return their new ids, in the same order."""
+    if not rows:
+        return []
+    return db.execute(insert(model).returning(model.id, sort_by_parameter_order=True), rows).scalars().all()
+
+def _insert(db:Session, model, rows:list[dict]):
+    if rows:
+        db.execute(insert(model), rows)
+
+def new_simulation_from(db:Session, template:Simulation, user:User, make_current:bool=True)->Simulation:
+    """Create the Simulation object for a clone of template and, unless
+    make_current is False, make it the current simulation of user.
+    Flushes, to obtain its id."""
+    new_simulation = Simulation(**{name: getattr(template, name) for name in _copied_columns(Simulation)})
+    new_simulation.user_id = user.id
+    new_simulation.username = user.username
+    new_simulation.state = "DEMAND"  # the start point of the simulation
+    new_simulation.changed()
+    db.add(new_simulation)
+    db.flush()
+    if make_current:
+        db.add(user)
+        user.current_simulation = new_simulation.id
+    return new_simulation
+
+def _copied_columns(model, *excluded:str)->list[str]:
+    """The names of the columns of model to be copied, leaving out the primary key and the excluded columns."""
+    return [c.name for c in model.__table__.columns if c.name != "id" and c.name not in excluded]
+
+def initialise_clone(db:Session, new_simulation:Simulation, solve_values:bool=False):
+    """Create the buyers and sellers of a newly-cloned simulation, and value its stocks and capitals.
+
+    If solve_values is set, the unit values of produced commodities are
+    calculated from the input-output structure (see simulation/values.py)
+    rather than taken from the template, and commodity totals follow.
+    """
+    forget_simulation_context(db, new_simulation.id) # in case one was made before all its objects existed
+    initialise_buyers_and_sellers(db, new_simulation.id)
+    revalue_commodities(db,new_simulation)
+    if solve_values:
+        apply_unit_values(db,new_simulation)
+    revalue_stocks(db,new_simulation)
+    if solve_values:
+        recalculate_commodity_totals(db,new_simulation)
+    calculate_initial_capitals(db,new_simulation)
+    calculate_current_capitals(db,new_simulation)
+    record_history(db,new_simulation)
@@ -14,100 +14,83 @@ The sequence is:
     stocks, and every social class to calculate consumer demand.
     
     Finally, tell every commodity to add up demand from stocks of it.
+
+Each of these steps is carried out by a few statements over the whole
+simulation, rather than object by object. Demand is rounded in Python
+rather than by SQL ROUND, which rounds ties such as 479.23875 the other
+way, so that the results are the same as those of flow_per_period().
 """
 
-from .. import models
+from sqlalchemy import func, select, union_all, update
+from sqlalchemy.orm import Session
 from ..models import Class_stock, Commodity,Industry, Industry_stock,SocialClass, Simulation
 from .logging import report
-from sqlalchemy.orm import Session
 
 def initialise_demand(db: Session,simulation: Simulation):
     """Set demand to zero for all commodities and stocks, prior to
     recalculating total demand."""
 
     report(1,simulation.id, "INITIALISING DEMAND FOR COMMODITIES AND STOCKS",db)
-
-#TODO the next six lines duplicate code in commodity_demand()
-    cquery = db.query(Commodity).where(Commodity.simulation_id==simulation.id) 
-    for c in cquery:
-        report(2,simulation.id,f"Initialising demand for commodity {c.name}",db)
-        db.add(c)
-        c.demand=0
-
-    squery = db.query(Industry_stock).where(Industry_stock.simulation_id==simulation.id)
-    for s in squery:
-        report(2,simulation.id,f"Initialising demand for industry stock {s.name}",db)
-        db.add(s)
-        s.demand=0
-    squery = db.query(Class_stock).where(Class_stock.simulation_id==simulation.id)
-    for s in squery:
-        report(2,simulation.id,f"Initialising demand for class stock {s.name}",db)
-        db.add(s)
-        s.demand=0
-    db.commit()
+    db.flush()
+    for model in (Commodity, Industry_stock, Class_stock):
+        db.execute(update(model).where(model.simulation_id==simulation.id).values(demand=0))
 
 def industry_demand(db:Session,simulation:Simulation):
-    """Tell each industry to set demand for each of its productive stocks."""
-    query=db.query(Industry).where(Industry.simulation_id==simulation.id)
+    """Set demand for every productive stock of every industry to the
+    amount it uses up in one period (see Industry_stock.flow_per_period)."""
     report(1,simulation.id, "CALCULATING DEMAND FROM INDUSTRIES",db)
-    for industry in query:
-        report(2, simulation.id,f"Industry {industry.name} will set demand for all its productive stocks",db)
-        db.add(industry)
-        query=db.query(Industry_stock).filter(Industry_stock.industry_id==industry.id,Industry_stock.usage_type=="Production")
-        for stock in query:
-            db.add(stock)
-            commodity=stock.commodity(db)
-            demand=round(stock.flow_per_period(db),4)
-            stock.demand+=demand
-            report(3,simulation.id,f'Demand for {stock.name} of {commodity.name} has been increased by {demand} to {stock.demand}',db)
-    db.commit()
+    db.flush()
+    stocks=db.execute(
+        select(Industry_stock.id, Industry_stock.demand, Industry.output_scale, Industry_stock.requirement)
+        .join(Industry, Industry.id==Industry_stock.industry_id)
+        .where(Industry_stock.simulation_id==simulation.id, Industry_stock.usage_type=="Production")
+    ).all()
+    rows=[
+        {"id": id, "demand": demand+round(round(output_scale*requirement,4)/simulation.periods_per_year,4)}
+        for id, demand, output_scale, requirement in stocks
+    ]
+    if rows:
+        db.execute(update(Industry_stock), rows)
 
 def class_demand(db:Session,simulation:Simulation):
-    """Tell each class to set demand for each of its consumption stocks."""
+    """Set demand for every consumption stock of every class to the amount
+    it consumes in one period (see Class_stock.flow_per_period)."""
 
     report(1,simulation.id, "CALCULATING DEMAND FROM SOCIAL CLASSES",db)
-    query=db.query(SocialClass).where(SocialClass.simulation_id==simulation.id)
-    for socialClass in query:
-        report(2, simulation.id,f"Asking class {socialClass.name} to set demand for all its consumption stocks",db)
-        db.add(socialClass)
-        query=db.query(Class_stock).filter(Class_stock.class_id==socialClass.id,Class_stock.usage_type=="Consumption")
-        for stock in query:
-            db.add(stock)
-            commodity=stock.commodity(db)
-            demand=round(stock.flow_per_period(db),4) # TODO consider using fraction types
-            stock.demand+=demand
-            report(3,simulation.id,f'Demand for {stock.name} of {commodity.name} has been increased by {demand} to {stock.demand}',db)
-    db.commit()
+    db.flush()
+    stocks=db.execute(
+        select(Class_stock.id, Class_stock.demand, SocialClass.population, SocialClass.consumption_ratio)
+        .join(SocialClass, SocialClass.id==Class_stock.class_id)
+        .where(Class_stock.simulation_id==simulation.id, Class_stock.usage_type=="Consumption")
+    ).all()
+    rows=[
+        {"id": id, "demand": demand+round(population*consumption_ratio/simulation.periods_per_year,4)} # TODO consider using fraction types
+        for id, demand, population, consumption_ratio in stocks
+    ]
+    if rows:
+        db.execute(update(Class_stock), rows)
 
 def commodity_demand(db:Session,simulation:Simulation):
-    """For each commodity, add up the total demand by asking all its stocks what they need.
+    """For each commodity, add up the total demand from the productive stocks
+    of industries and all the stocks of classes.
     Do this separately from the stocks as a kind of check - could be done at the same time.
     """
     report(1,simulation.id,"ADDING UP DEMAND FOR COMMODITIES",db)
-    query=db.query(models.Commodity).where(Commodity.simulation_id==simulation.id)
-    for commodity in query:
-       
-# Demand from Industry Stocks
-
-        db.add(commodity)
-        report(2,simulation.id, f'Calculating total demand for {commodity.name} from Industries',db)
-        commodity.demand=0 #TODO this duplicates some of the code in initialize_demand()
-        squery=db.query(Industry_stock).filter(Industry_stock.commodity_id==commodity.id,Industry_stock.usage_type=="Production")
-        for stock in squery:
-            industry:Industry=stock.industry(db)
-            report(3,simulation.id,f'Demand for {commodity.name} from {stock.name} with owner ({industry.name}) is {stock.demand}',db)
-            commodity.demand+=stock.demand
-        report (2,simulation.id, f'Total demand for {commodity.name} is now {commodity.demand}',db)
-
-# Demand from Class Stocks
-
-        report(2,simulation.id, f'Calculating total demand for {commodity.name} from Classes',db)
-        squery=db.query(Class_stock).filter(Class_stock.commodity_id==commodity.id)
-        for stock in squery:
-            social_class:SocialClass=stock.social_class(db)
-            report(3,simulation.id,f'Demand for {commodity.name} from {stock.name} with owner ({social_class.name}) is {stock.demand}',db)
-            commodity.demand+=stock.demand
-        report (2,simulation.id, f'Total demand for {commodity.name} is now {commodity.demand}',db)
-
-    db.commit()
-
+    db.flush()
+    stocks=union_all(
+        select(Industry_stock.commodity_id, Industry_stock.demand)
+        .where(Industry_stock.simulation_id==simulation.id, Industry_stock.usage_type=="Production"),
+        select(Class_stock.commodity_id, Class_stock.demand)
+        .where(Class_stock.simulation_id==simulation.id),
+    ).subquery()
+    totals=dict(
+        db.execute(select(stocks.c.commodity_id, func.sum(stocks.c.demand)).group_by(stocks.c.commodity_id)).all()
+    )
+    commodities=db.execute(select(Commodity.id, Commodity.name).where(Commodity.simulation_id==simulation.id)).all()
+    rows=[]
+    for commodity_id, name in commodities:
+        demand=totals.get(commodity_id) or 0
+        report(2,simulation.id,lambda: f'Total demand for {name} is now {demand}',db)
+        rows.append({"id": commodity_id, "demand": demand})
+    if rows:
+        db.execute(update(Commodity), rows)
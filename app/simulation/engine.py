@@ -0,0 +1,426 @@
+"""An in-memory, vectorised implementation of the circuit.
+
+The functions in demand.py, supply.py, trade.py, production.py and
+consumption.py walk the ORM objects one at a time and query the
+database for every stock. This module instead loads one simulation's
+commodities, industries, classes and stocks into NumPy arrays, performs
+the same calculations as array operations, and writes the results back
+in one bulk update per table.
+
+A simulation uses this engine if its 'engine' field is "NUMPY". The
+action handlers otherwise use the ORM functions.
+
+Industry_stocks and Class_stocks are held in a single set of arrays.
+Industry_stocks come first, followed by Class_stocks, each in id order.
+'is_class' says which is which and 'owner' holds the index (not the id)
+of the owning Industry or SocialClass.
+"""
+
+import numpy as np
+from sqlalchemy import null, select, update
+from sqlalchemy.orm import Session
+from ..models import Class_stock, Commodity, Industry, Industry_stock, Simulation, SocialClass
+from .invest import PROPERTIED_CLASS
+from .logging import report
+
+COMMODITY_FIELDS = ["size", "total_value", "total_price", "unit_value", "unit_price", "demand", "supply", "allocation_ratio"]
+INDUSTRY_FIELDS = ["output_scale", "output_growth_rate", "initial_capital", "current_capital", "profit", "profit_rate"]
+CLASS_FIELDS = ["population", "consumption_ratio"]
+STOCK_FIELDS = ["size", "value", "price", "demand"]
+
+def _column(rows, position)->np.ndarray:
+    """Extract one column of query results as a float array, treating None as zero."""
+    return np.array([0.0 if row[position] is None else row[position] for row in rows], dtype=float)
+
+class SimulationArrays:
+    """The state of one simulation, held as NumPy arrays.
+
+    Use SimulationArrays.load() to create it, call the stage methods in
+    the order of the circuit, then call flush() to write the results
+    back to the database. The object holds no reference to the session,
+    so it can be copied or sent to another process.
+    """
+
+    def __init__(self):
+        self.simulation_id:int = 0
+        self.periods_per_year:float = 1.0
+        self.commodity:dict[str, np.ndarray] = {}
+        self.industry:dict[str, np.ndarray] = {}
+        self.social_class:dict[str, np.ndarray] = {}
+        self.stock:dict[str, np.ndarray] = {}
+
+    @classmethod
+    def load(cls, db:Session, simulation:Simulation)->"SimulationArrays":
+        """Read every object of the simulation in one query per table.
+
+        Stocks whose owner or commodity is not in the simulation (as in
+        some of the templates) are left out, as they are when a template
+        is cloned (see clone.TemplateSnapshot).
+        """
+        arrays = cls()
+        arrays.simulation_id = simulation.id
+        arrays.periods_per_year = simulation.periods_per_year
+
+        rows = db.execute(
+            select(Commodity.id, Commodity.name, Commodity.usage, Commodity.origin, *[getattr(Commodity, f) for f in COMMODITY_FIELDS])
+            .where(Commodity.simulation_id == simulation.id)
+            .order_by(Commodity.id)
+        ).all()
+        arrays.commodity_id = np.array([row[0] for row in rows], dtype=int)
+        arrays.commodity_name = np.array([row[1] for row in rows], dtype=object)
+        arrays.commodity_usage = np.array([(row[2] or "").strip() for row in rows], dtype=object)
+        arrays.commodity_origin = np.array([(row[3] or "").strip().upper() for row in rows], dtype=object)
+        arrays.commodity = {f: _column(rows, 4 + i) for i, f in enumerate(COMMODITY_FIELDS)}
+
+        rows = db.execute(
+            select(Industry.id, *[getattr(Industry, f) for f in INDUSTRY_FIELDS])
+            .where(Industry.simulation_id == simulation.id)
+            .order_by(Industry.id)
+        ).all()
+        arrays.industry_id = np.array([row[0] for row in rows], dtype=int)
+        arrays.industry = {f: _column(rows, 1 + i) for i, f in enumerate(INDUSTRY_FIELDS)}
+
+        rows = db.execute(
+            select(SocialClass.id, SocialClass.name, *[getattr(SocialClass, f) for f in CLASS_FIELDS])
+            .where(SocialClass.simulation_id == simulation.id)
+            .order_by(SocialClass.id)
+        ).all()
+        arrays.class_id = np.array([row[0] for row in rows], dtype=int)
+        arrays.class_name = np.array([row[1] for row in rows], dtype=object)
+        arrays.social_class = {f: _column(rows, 2 + i) for i, f in enumerate(CLASS_FIELDS)}
+
+        istocks = db.execute(
+            select(Industry_stock.id, Industry_stock.industry_id, Industry_stock.commodity_id, Industry_stock.usage_type,
+                   Industry_stock.requirement, *[getattr(Industry_stock, f) for f in STOCK_FIELDS])
+            .where(Industry_stock.simulation_id == simulation.id)
+            .order_by(Industry_stock.id)
+        ).all()
+        cstocks = db.execute(
+            select(Class_stock.id, Class_stock.class_id, Class_stock.commodity_id, Class_stock.usage_type,
+                   null(), *[getattr(Class_stock, f) for f in STOCK_FIELDS])
+            .where(Class_stock.simulation_id == simulation.id)
+            .order_by(Class_stock.id)
+        ).all()
+        commodity_index = {id: i for i, id in enumerate(arrays.commodity_id)}
+        industry_index = {id: i for i, id in enumerate(arrays.industry_id)}
+        class_index = {id: i for i, id in enumerate(arrays.class_id)}
+        istocks = [row for row in istocks if row[1] in industry_index and row[2] in commodity_index]
+        cstocks = [row for row in cstocks if row[1] in class_index and row[2] in commodity_index]
+        rows = istocks + cstocks
+        arrays.stock_id = np.array([row[0] for row in rows], dtype=int)
+        arrays.is_class = np.array([False] * len(istocks) + [True] * len(cstocks), dtype=bool)
+        arrays.owner = np.array(
+            [industry_index[row[1]] for row in istocks] + [class_index[row[1]] for row in cstocks], dtype=int
+        )
+        arrays.stock_commodity = np.array([commodity_index[row[2]] for row in rows], dtype=int)
+        arrays.usage_type = np.array([row[3] for row in rows], dtype=object)
+        arrays.requirement = _column(rows, 4)
+        arrays.stock = {f: _column(rows, 5 + i) for i, f in enumerate(STOCK_FIELDS)}
+        arrays._index_owners()
+        return arrays
+
+    def _index_owners(self):
+        """Find the Sales and Money stock of every owner.
+
+        As with get_industry_sales_stock() and its siblings, if an owner
+        has more than one such stock, the first one is used.
+        """
+        self.industry_sales = np.full(len(self.industry_id), -1, dtype=int)
+        self.industry_money = np.full(len(self.industry_id), -1, dtype=int)
+        self.class_sales = np.full(len(self.class_id), -1, dtype=int)
+        self.class_money = np.full(len(self.class_id), -1, dtype=int)
+        for i in range(len(self.stock_id) - 1, -1, -1):
+            match (bool(self.is_class[i]), self.usage_type[i]):
+                case (False, "Sales"):
+                    self.industry_sales[self.owner[i]] = i
+                case (False, "Money"):
+                    self.industry_money[self.owner[i]] = i
+                case (True, "Sales"):
+                    self.class_sales[self.owner[i]] = i
+                case (True, "Money"):
+                    self.class_money[self.owner[i]] = i
+
+    def _productive(self)->np.ndarray:
+        return ~self.is_class & (self.usage_type == "Production")
+
+    def _consuming(self)->np.ndarray:
+        return self.is_class & (self.usage_type == "Consumption")
+
+    def _money_of(self, stocks:np.ndarray)->np.ndarray:
+        """The money stock of the owner of each of the given stocks."""
+        money = np.empty(len(stocks), dtype=int)
+        is_class = self.is_class[stocks]
+        money[is_class] = self.class_money[self.owner[stocks[is_class]]]
+        money[~is_class] = self.industry_money[self.owner[stocks[~is_class]]]
+        return money
+
+    def _stock_sum(self, values:np.ndarray, mask:np.ndarray)->np.ndarray:
+        """Add up values over the stocks selected by mask, for each commodity."""
+        return np.bincount(self.stock_commodity[mask], weights=values[mask], minlength=len(self.commodity_id))
+
+    def flow_per_period(self)->np.ndarray:
+        """The amount of each stock used up in one period.
+
+        Same rules as Industry_stock.flow_per_period() and
+        Class_stock.flow_per_period(). Zero for all other stocks.
+        """
+        flow = np.zeros(len(self.stock_id))
+        productive = self._productive()
+        annual = np.round(self.industry["output_scale"][self.owner[productive]] * self.requirement[productive], 4)
+        flow[productive] = np.round(annual / self.periods_per_year, 4)
+        consuming = self._consuming()
+        owners = self.owner[consuming]
+        flow[consuming] = self.social_class["population"][owners] * self.social_class["consumption_ratio"][owners] / self.periods_per_year
+        return flow
+
+    def _change_size(self, stocks:np.ndarray, amount:np.ndarray):
+        """Vectorised equivalent of Industry_stock.change_size().
+
+        np.add.at is used so that repeated stocks accumulate."""
+        np.add.at(self.stock["size"], stocks, amount)
+        self._reprice(stocks)
+
+    def _reprice(self, stocks:np.ndarray):
+        """Reset price and value from size, exactly as change_size() does."""
+        commodities = self.stock_commodity[stocks]
+        self.stock["price"][stocks] = self.stock["size"][stocks] * self.commodity["unit_value"][commodities]
+        self.stock["value"][stocks] = self.stock["size"][stocks] * self.commodity["unit_price"][commodities]
+
+    def demand(self):
+        """Equivalent of initialise_demand, industry_demand, class_demand and commodity_demand."""
+        flow = np.round(self.flow_per_period(), 4)
+        self.stock["demand"][:] = 0
+        demanding = self._productive() | self._consuming()
+        self.stock["demand"][demanding] = flow[demanding]
+        self.commodity_demand()
+
+    def commodity_demand(self):
+        """Add up demand for each commodity from the stocks of it."""
+        counted = self._productive() | self.is_class
+        self.commodity["demand"] = self._stock_sum(self.stock["demand"], counted)
+
+    def supply(self):
+        """Equivalent of supply.calculate_supply()."""
+        self.commodity["supply"] = self._stock_sum(self.stock["size"], self.usage_type == "Sales")
+
+    def constrain_demand(self):
+        """Equivalent of trade.constrain_demand."""
+        tradeable = np.isin(self.commodity_usage, ["PRODUCTIVE", "CONSUMPTION"])
+        supply = self.commodity["supply"]
+        demand = self.commodity["demand"]
+        ratio = self.commodity["allocation_ratio"]
+        ratio[tradeable & (supply == 0)] = 0
+        ratio[tradeable & (supply != 0) & (demand <= supply)] = 1
+        constrained = tradeable & (supply != 0) & (demand > supply)
+        ratio[constrained] = supply[constrained] / demand[constrained]
+        demand[constrained] *= ratio[constrained]
+        constrained_stocks = constrained[self.stock_commodity]
+        self.stock["demand"][constrained_stocks] *= ratio[self.stock_commodity[constrained_stocks]]
+
+    def buy_and_sell(self):
+        """Equivalent of trade.buy_and_sell.
+
+        In the ORM version, every buyer of a commodity purchases its entire
+        demand from the first seller of that commodity, so later sellers of
+        the same commodity transfer nothing. Buyers are all stocks other
+        than Money and Sales stocks.
+        """
+        sellers = np.concatenate([self.industry_sales[self.industry_sales >= 0], self.class_sales[self.class_sales >= 0]])
+        sellers = sellers[np.argsort(sellers, kind="stable")]
+        first_seller = np.full(len(self.commodity_id), -1, dtype=int)
+        for s in sellers[::-1]:
+            first_seller[self.stock_commodity[s]] = s
+
+        buyers = np.flatnonzero(
+            ~np.isin(self.usage_type, ["Money", "Sales"]) & (first_seller[self.stock_commodity] >= 0)
+        )
+        commodities = self.stock_commodity[buyers]
+        amount = self.stock["demand"][buyers].copy()
+        seller = first_seller[commodities]
+
+        # Transfer the goods
+        self._change_size(buyers, amount)
+        self.stock["demand"][buyers] -= amount
+        self._change_size(seller, -amount)
+
+        # Pay for the goods, unless the trade is internal to the owner
+        buyer_money = self._money_of(buyers)
+        seller_money = self._money_of(seller)
+        paying = buyer_money != seller_money
+        payment = amount[paying] * self.commodity["unit_price"][commodities[paying]]
+        self._change_size(seller_money[paying], payment)
+        self._change_size(buyer_money[paying], -payment)
+
+        # Later sellers of a traded commodity are still revalued by change_size()
+        traded = np.zeros(len(self.commodity_id), dtype=bool)
+        traded[commodities] = True
+        self._reprice(sellers[traded[self.stock_commodity[sellers]]])
+
+    def trade(self):
+        """Equivalent of the calculations in tradeHandler."""
+        self.constrain_demand()
+        self.buy_and_sell()
+        self.commodity_demand()
+        self.supply()
+
+    def produce(self):
+        """Equivalent of production.produce, followed by recalculation of
+        commodity totals and current capitals, as in produceHandler."""
+        productive = np.flatnonzero(self._productive())
+        flow = self.flow_per_period()[productive]
+        commodities = self.stock_commodity[productive]
+        owners = self.owner[productive]
+        sales = self.industry_sales[owners]
+        if np.any(sales < 0):  # as in production.produce; -1 would otherwise index the last stock
+            industry_id = self.industry_id[owners[sales < 0][0]]
+            raise Exception(
+                f"INDUSTRY with id {industry_id} and simulation id {self.simulation_id} HAS NO SALES STOCK"
+            )
+        sales_commodity = self.stock_commodity[sales]
+        labour = self.commodity_origin[commodities] == "SOCIAL"  # see production.is_socially_produced
+
+        # Labour Power adds its magnitude; other stocks transfer their value
+        contribution = np.where(labour, flow, flow * self.commodity["unit_value"][sales_commodity])
+        self.stock["size"][productive] -= flow
+        self.stock["value"][productive] -= np.where(labour, flow * self.commodity["unit_value"][commodities], contribution)
+        self.stock["price"][productive] -= flow * self.commodity["unit_price"][commodities]
+
+        np.add.at(self.stock["value"], sales, contribution)
+        producing = np.unique(owners)
+        self.stock["size"][self.industry_sales[producing]] = self.industry["output_scale"][producing] / self.periods_per_year
+        all_sales = self.industry_sales[self.industry_sales >= 0]
+        self.stock["price"][all_sales] = self.stock["value"][all_sales]
+
+        self.recalculate_commodity_totals()
+        self.calculate_current_capitals()
+
+    def consume(self):
+        """Equivalent of consumption.consume followed by the revaluations
+        carried out by consumeHandler."""
+        consuming = np.flatnonzero(self._consuming())
+        flow = self.flow_per_period()[consuming]
+        commodities = self.stock_commodity[consuming]
+        self.stock["size"][consuming] -= flow
+        self.stock["price"][consuming] -= flow * self.commodity["unit_price"][commodities]
+        self.stock["value"][consuming] -= flow * self.commodity["unit_value"][commodities]
+
+        # Classes replenish their sales stock in proportion to their number
+        selling = np.flatnonzero(self.class_sales >= 0)
+        self.stock["size"][self.class_sales[selling]] = self.social_class["population"][selling]
+
+        self.recalculate_commodity_totals()
+        self.revalue_commodities()
+        self.revalue_stocks()
+        self.calculate_current_capitals()
+
+    def invest(self):
+        """Equivalent of invest.invest.
+
+        As in the ORM version (see invest.propertied_class), the class
+        called PROPERTIED_CLASS, or failing that the first class, receives
+        revenue from every industry.
+        """
+        industries = np.arange(len(self.industry_id))
+        named = np.flatnonzero(self.class_name == PROPERTIED_CLASS)
+        capitalists = named[0] if len(named) else 0
+        revenue = self.social_class["consumption_ratio"][capitalists] * self.industry["profit"]
+        self._change_size(np.full(len(industries), self.class_money[capitalists]), revenue)
+        self._change_size(self.industry_money[industries], -revenue)
+
+        productive = self._productive()
+        unit_cost = np.bincount(
+            self.owner[productive],
+            weights=self.requirement[productive] * self.commodity["unit_price"][self.stock_commodity[productive]],
+            minlength=len(industries),
+        )
+        scale = self.industry["output_scale"]
+        cost = unit_cost * scale
+        spare = self.stock["size"][self.industry_money] - cost
+        # an industry with no costs is limited only by its output_growth_rate
+        monetarily_potential_growth = np.full(len(industries), np.inf)
+        costly = cost > 0
+        monetarily_potential_growth[costly] = spare[costly] / unit_cost[costly] / cost[costly]
+        growth = self.industry["output_growth_rate"]
+        self.industry["output_scale"] = np.where(
+            monetarily_potential_growth > growth, scale * (1 + growth), scale * (1 + monetarily_potential_growth)
+        )
+
+    def circuit(self):
+        """One complete circuit, from demand to investment."""
+        self.demand()
+        self.supply()
+        self.trade()
+        self.produce()
+        self.consume()
+        self.invest()
+
+    def recalculate_commodity_totals(self):
+        """Equivalent of utils.recalculate_commodity_totals."""
+        every = np.ones(len(self.stock_id), dtype=bool)
+        self.commodity["total_value"] = self._stock_sum(self.stock["value"], every)
+        self.commodity["total_price"] = self._stock_sum(self.stock["price"], every)
+        self.commodity["size"] = self._stock_sum(self.stock["size"], every)
+
+    def revalue_commodities(self):
+        """Equivalent of utils.revalue_commodities."""
+        present = self.commodity["size"] > 0
+        unit = self.commodity["total_price"][present] / self.commodity["size"][present]
+        self.commodity["unit_price"][present] = unit
+        self.commodity["unit_value"][present] = unit
+
+    def revalue_stocks(self):
+        """Equivalent of utils.revalue_stocks."""
+        self.stock["value"] = self.stock["size"] * self.commodity["unit_value"][self.stock_commodity]
+        self.stock["price"] = self.stock["size"] * self.commodity["unit_price"][self.stock_commodity]
+
+    def calculate_capitals(self)->np.ndarray:
+        """Sum of the prices of all the stocks of each industry."""
+        industry_stocks = ~self.is_class
+        return np.bincount(
+            self.owner[industry_stocks], weights=self.stock["price"][industry_stocks], minlength=len(self.industry_id)
+        )
+
+    def calculate_initial_capitals(self):
+        """Equivalent of utils.calculate_initial_capitals."""
+        self.industry["initial_capital"] = self.calculate_capitals()
+
+    def calculate_current_capitals(self):
+        """Equivalent of utils.calculate_current_capitals."""
+        self.industry["current_capital"] = self.calculate_capitals()
+        self.industry["profit"] = self.industry["current_capital"] - self.industry["initial_capital"]
+        # as in the ORM version, the profit rate of an industry with no initial capital is zero
+        self.industry["profit_rate"] = np.zeros(len(self.industry_id))
+        has_capital = self.industry["initial_capital"] != 0
+        self.industry["profit_rate"][has_capital] = self.industry["profit"][has_capital] / self.industry["initial_capital"][has_capital]
+
+    def flush(self, db:Session):
+        """Write the results back to the database, one bulk update per table.
+
+        Does not commit; that is left to the caller.
+        """
+        _bulk_update(db, Commodity, self.commodity_id, self.commodity, COMMODITY_FIELDS)
+        _bulk_update(db, Industry, self.industry_id, self.industry, INDUSTRY_FIELDS)
+        industry_stocks = ~self.is_class
+        _bulk_update(db, Industry_stock, self.stock_id[industry_stocks],
+                     {f: self.stock[f][industry_stocks] for f in STOCK_FIELDS}, STOCK_FIELDS)
+        _bulk_update(db, Class_stock, self.stock_id[self.is_class],
+                     {f: self.stock[f][self.is_class] for f in STOCK_FIELDS}, STOCK_FIELDS)
+
+def _bulk_update(db:Session, model, ids:np.ndarray, columns:dict[str, np.ndarray], fields:list[str]):
+    """Issue a single executemany UPDATE of the given fields, keyed by primary key."""
+    if len(ids) == 0:
+        return
+    values = [columns[f].tolist() for f in fields]
+    rows = [dict(zip(["id", *fields], row)) for row in zip(ids.tolist(), *values)]
+    db.execute(update(model), rows)
+
+def run_stage(db:Session, simulation:Simulation, stage:str):
+    """Load the simulation, run one stage of the circuit on it and write
+    the results back. 'stage' is the name of one of the stage methods of
+    SimulationArrays, for example 'demand'. Returns the arrays, which
+    hold the state of the simulation after the stage."""
+    report(1, simulation.id, f"{stage.upper()} (NUMPY ENGINE)", db)
+    arrays = SimulationArrays.load(db, simulation)
+    getattr(arrays, stage)()
+    arrays.flush(db)
+    return arrays
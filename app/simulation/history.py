@@ -0,0 +1,276 @@
+"""A compact history of each simulation, one snapshot per period.
+
+At the end of every circuit (see circuit.invest_stage and
+circuit.run_circuits), and when a simulation is created, the main
+magnitudes of its commodities, industries and classes are written to
+the History table. Each group is packed into one binary array of
+little-endian float64, laid out field by field, so a snapshot is a
+single row however large the simulation is.
+
+Each snapshot also holds a checkpoint: every field that the circuit
+changes, of every commodity, industry, class and stock, so that the
+simulation can be put back in the state it was in at that time stamp
+(see simulation/checkpoint.py). The checkpoint is only read when this
+is done.
+
+Snapshots are written with an insert-or-replace on (simulation_id,
+time_stamp). When the simulation is not already held in a
+SimulationArrays, load_snapshot() reads just the columns a snapshot
+needs.
+
+time_series() reads these back as one series per field and object, for
+charts. It only reads the columns of the group asked for, and can thin
+out long histories either by taking every n'th period (stride), in which
+case only those snapshots are read from the database, or by averaging
+consecutive periods (bucket).
+"""
+
+import numpy as np
+from sqlalchemy import delete, func, insert, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from ..models import Class_stock, Commodity, History, Industry, Industry_stock, Simulation, SocialClass
+from .engine import CLASS_FIELDS, COMMODITY_FIELDS, INDUSTRY_FIELDS, STOCK_FIELDS, SimulationArrays, _column
+
+COMMODITY_HISTORY_FIELDS = ["size", "total_value", "total_price", "unit_value", "unit_price", "demand", "supply"]
+INDUSTRY_HISTORY_FIELDS = ["output_scale", "initial_capital", "current_capital", "profit", "profit_rate"]
+CLASS_HISTORY_FIELDS = ["population", "money"]
+
+def _pack(columns:list[np.ndarray])->bytes:
+    """One row per field, one column per object."""
+    if not columns or len(columns[0]) == 0:
+        return b""
+    return np.vstack(columns).astype("<f8").tobytes()
+
+def _unpack(data:bytes, fields:list[str], count:int)->dict[str, np.ndarray]:
+    values = np.frombuffer(data or b"", dtype="<f8").reshape(len(fields), count)
+    return dict(zip(fields, values))
+
+def history_row(arrays:SimulationArrays, time_stamp:int)->dict:
+    """The History row describing the simulation held in arrays."""
+    money = np.zeros(len(arrays.class_id))
+    has_money = arrays.class_money >= 0
+    money[has_money] = arrays.stock["size"][arrays.class_money[has_money]]
+    classes = {**arrays.social_class, "money": money}
+    return {
+        "simulation_id": arrays.simulation_id,
+        "time_stamp": time_stamp,
+        "commodity_ids": arrays.commodity_id.astype("<i8").tobytes(),
+        "commodities": _pack([arrays.commodity[f] for f in COMMODITY_HISTORY_FIELDS]),
+        "industry_ids": arrays.industry_id.astype("<i8").tobytes(),
+        "industries": _pack([arrays.industry[f] for f in INDUSTRY_HISTORY_FIELDS]),
+        "class_ids": arrays.class_id.astype("<i8").tobytes(),
+        "classes": _pack([classes[f] for f in CLASS_HISTORY_FIELDS]),
+        "industry_stock_ids": arrays.stock_id[~arrays.is_class].astype("<i8").tobytes(),
+        "class_stock_ids": arrays.stock_id[arrays.is_class].astype("<i8").tobytes(),
+        "checkpoint": b"".join([
+            _pack([arrays.commodity[f] for f in COMMODITY_FIELDS]),
+            _pack([arrays.industry[f] for f in INDUSTRY_FIELDS]),
+            _pack([arrays.social_class[f] for f in CLASS_FIELDS]),
+            _pack([arrays.stock[f] for f in STOCK_FIELDS]),
+        ]),
+    }
+
+UPSERT_DIALECTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+def save_history(db:Session, rows:list[dict]):
+    """Write snapshots in one bulk insert, replacing any already recorded
+    for the same simulation and time stamp."""
+    if not rows:
+        return
+    upsert = UPSERT_DIALECTS.get(db.get_bind().dialect.name)
+    if upsert is None:
+        keys = [(row["simulation_id"], row["time_stamp"]) for row in rows]
+        db.execute(delete(History).where(tuple_(History.simulation_id, History.time_stamp).in_(keys)))
+        db.execute(insert(History), rows)
+        return
+    statement = upsert(History)
+    replaced = [name for name in rows[0] if name not in ("simulation_id", "time_stamp")]
+    db.execute(
+        statement.on_conflict_do_update(
+            index_elements=[History.simulation_id, History.time_stamp],
+            set_={name: statement.excluded[name] for name in replaced},
+        ),
+        rows,
+    )
+
+def _snapshot_stocks(db:Session, model, owner_model, owner_id, simulation_id:int)->list:
+    """id, owner id, commodity id, whether it is a Money stock, and STOCK_FIELDS,
+    of the stocks whose owner and commodity are in the simulation."""
+    return db.execute(
+        select(model.id, owner_id, model.commodity_id, model.usage_type == "Money", *[getattr(model, f) for f in STOCK_FIELDS])
+        .join(owner_model, (owner_model.id == owner_id) & (owner_model.simulation_id == simulation_id))
+        .join(Commodity, (Commodity.id == model.commodity_id) & (Commodity.simulation_id == simulation_id))
+        .where(model.simulation_id == simulation_id)
+        .order_by(model.id)
+    ).all()
+
+def load_snapshot(db:Session, simulation:Simulation)->SimulationArrays:
+    """Read just what history_row() needs: the ids and checkpoint fields of
+    every object, and which stock holds the money of each class. The
+    result holds the same objects, in the same order, as SimulationArrays.load()
+    would give, but can only be used to record history."""
+    arrays = SimulationArrays()
+    arrays.simulation_id = simulation.id
+    for model, fields, ids, columns in (
+        (Commodity, COMMODITY_FIELDS, "commodity_id", "commodity"),
+        (Industry, INDUSTRY_FIELDS, "industry_id", "industry"),
+        (SocialClass, CLASS_FIELDS, "class_id", "social_class"),
+    ):
+        rows = db.execute(
+            select(model.id, *[getattr(model, f) for f in fields]).where(model.simulation_id == simulation.id).order_by(model.id)
+        ).all()
+        setattr(arrays, ids, np.array([row[0] for row in rows], dtype=int))
+        setattr(arrays, columns, {f: _column(rows, 1 + i) for i, f in enumerate(fields)})
+
+    istocks = _snapshot_stocks(db, Industry_stock, Industry, Industry_stock.industry_id, simulation.id)
+    cstocks = _snapshot_stocks(db, Class_stock, SocialClass, Class_stock.class_id, simulation.id)
+    rows = istocks + cstocks
+    arrays.stock_id = np.array([row[0] for row in rows], dtype=int)
+    arrays.is_class = np.array([False] * len(istocks) + [True] * len(cstocks), dtype=bool)
+    arrays.stock = {f: _column(rows, 4 + i) for i, f in enumerate(STOCK_FIELDS)}
+    # as in SimulationArrays._index_owners, the first Money stock of each class
+    class_index = {id: i for i, id in enumerate(arrays.class_id.tolist())}
+    arrays.class_money = np.full(len(arrays.class_id), -1, dtype=int)
+    for i in range(len(cstocks) - 1, -1, -1):
+        if cstocks[i][3]:
+            arrays.class_money[class_index[cstocks[i][1]]] = len(istocks) + i
+    return arrays
+
+def record_history(db:Session, simulation:Simulation, arrays:SimulationArrays|None=None):
+    """Record the current state of the simulation, at its current time stamp.
+    If the simulation is already loaded into arrays, pass them in to
+    avoid reading it again."""
+    if arrays is None:
+        db.flush()
+        arrays = load_snapshot(db, simulation)
+    save_history(db, [history_row(arrays, simulation.time_stamp or 0)])
+
+def unpack_history(history:History)->dict[str, dict[str, np.ndarray]]:
+    """The contents of one snapshot: for each of 'commodities', 'industries'
+    and 'classes', the ids of the objects under "id" and one array per field."""
+    result = {}
+    for name, ids, data, fields in (
+        ("commodities", history.commodity_ids, history.commodities, COMMODITY_HISTORY_FIELDS),
+        ("industries", history.industry_ids, history.industries, INDUSTRY_HISTORY_FIELDS),
+        ("classes", history.class_ids, history.classes, CLASS_HISTORY_FIELDS),
+    ):
+        id_array = np.frombuffer(ids or b"", dtype="<i8")
+        result[name] = {"id": id_array, **_unpack(data, fields, len(id_array))}
+    return result
+
+def unpack_checkpoint(history:History)->dict[str, dict[str, np.ndarray]]:
+    """The checkpoint of one snapshot: for each of 'commodities', 'industries',
+    'classes', 'industry_stocks' and 'class_stocks', the ids of the objects
+    under "id" and one array per field (see the field lists in engine.py).
+
+    Raises ValueError if the snapshot has no checkpoint, which is the case
+    for snapshots recorded before checkpoints were introduced.
+    """
+    if history.checkpoint is None:
+        raise ValueError(f"Time stamp {history.time_stamp} of simulation {history.simulation_id} has no checkpoint")
+    ids = {
+        name: np.frombuffer(data or b"", dtype="<i8")
+        for name, data in (
+            ("commodities", history.commodity_ids),
+            ("industries", history.industry_ids),
+            ("classes", history.class_ids),
+            ("industry_stocks", history.industry_stock_ids),
+            ("class_stocks", history.class_stock_ids),
+        )
+    }
+    stock_count = len(ids["industry_stocks"]) + len(ids["class_stocks"])
+    result = {}
+    offset = 0
+    for name, fields, count in (
+        ("commodities", COMMODITY_FIELDS, len(ids["commodities"])),
+        ("industries", INDUSTRY_FIELDS, len(ids["industries"])),
+        ("classes", CLASS_FIELDS, len(ids["classes"])),
+        ("stocks", STOCK_FIELDS, stock_count),
+    ):
+        size = 8 * len(fields) * count
+        result[name] = _unpack(history.checkpoint[offset:offset+size], fields, count)
+        offset += size
+    stocks = result.pop("stocks")
+    industry_stocks = len(ids["industry_stocks"])
+    result["industry_stocks"] = {f: values[:industry_stocks] for f, values in stocks.items()}
+    result["class_stocks"] = {f: values[industry_stocks:] for f, values in stocks.items()}
+    return {name: {"id": ids[name], **columns} for name, columns in result.items()}
+
+HISTORY_GROUPS = {
+    "commodities": (Commodity, History.commodity_ids, History.commodities, COMMODITY_HISTORY_FIELDS),
+    "industries": (Industry, History.industry_ids, History.industries, INDUSTRY_HISTORY_FIELDS),
+    "classes": (SocialClass, History.class_ids, History.classes, CLASS_HISTORY_FIELDS),
+}
+
+def time_series(
+    db:Session,
+    simulation_id:int,
+    group:str,
+    fields:list[str],
+    start:int|None=None,
+    end:int|None=None,
+    stride:int=1,
+    bucket:int=1,
+)->dict:
+    """Column-oriented series of the given fields of one group ('commodities',
+    'industries' or 'classes') of a simulation, from time stamp start to
+    end inclusive (either may be None, meaning no limit).
+
+    stride > 1 keeps only every stride'th snapshot, counting from the first;
+    the others are not read. bucket > 1 then replaces each run of 'bucket' consecutive snapshots by
+    their average, labelled with the time stamp of the first of them.
+
+    Returns a dictionary with "time_stamp", the "id" and "name" of each
+    object, and "series", in which series[field][i] is the list of values
+    of that field for the i'th object, one per time stamp.
+
+    Raises ValueError for an unknown group or field.
+    """
+    if group not in HISTORY_GROUPS:
+        raise ValueError(f"Unknown group {group}. Groups are {', '.join(HISTORY_GROUPS)}")
+    model, ids_column, data_column, recorded = HISTORY_GROUPS[group]
+    unknown = [field for field in fields if field not in recorded]
+    if unknown:
+        raise ValueError(f"Unknown field {', '.join(unknown)}. Fields of {group} are {', '.join(recorded)}")
+    fields = fields or recorded
+
+    query = select(History.time_stamp, data_column.label("data")).where(History.simulation_id == simulation_id)
+    if start is not None:
+        query = query.where(History.time_stamp >= start)
+    if end is not None:
+        query = query.where(History.time_stamp <= end)
+    if stride > 1:
+        # number the snapshots in the database, and read only every stride'th
+        numbered = query.add_columns(func.row_number().over(order_by=History.time_stamp).label("number")).subquery()
+        query = select(numbered.c.time_stamp, numbered.c.data).where((numbered.c.number - 1) % stride == 0)
+        rows = db.execute(query.order_by(numbered.c.time_stamp)).all()
+    else:
+        rows = db.execute(query.order_by(History.time_stamp)).all()
+
+    ids = np.zeros(0, dtype="<i8")
+    if rows:  # the objects are those of the last snapshot read
+        last = db.execute(select(ids_column).where(History.simulation_id == simulation_id, History.time_stamp == rows[-1][0])).scalar()
+        ids = np.frombuffer(last or b"", dtype="<i8")
+    time_stamps = np.array([row[0] for row in rows], dtype=int)
+    positions = [recorded.index(field) for field in fields]
+    # values[t, f, i]: field f of object i at the t'th time stamp
+    values = np.zeros((len(rows), len(fields), len(ids)))
+    for t, row in enumerate(rows):
+        values[t] = np.frombuffer(row[1] or b"", dtype="<f8").reshape(len(recorded), len(ids))[positions]
+
+    if bucket > 1 and len(rows) > 0:
+        starts = np.arange(0, len(rows), bucket)
+        counts = np.diff(np.append(starts, len(rows)))
+        values = np.add.reduceat(values, starts, axis=0) / counts[:, None, None]
+        time_stamps = time_stamps[starts]
+
+    names = dict(db.execute(select(model.id, model.name).where(model.id.in_(ids.tolist()))).all())
+    return {
+        "simulation_id": simulation_id,
+        "group": group,
+        "time_stamp": time_stamps.tolist(),
+        "id": ids.tolist(),
+        "name": [names.get(id, "") for id in ids.tolist()],
+        "series": {field: values[:, f, :].T.tolist() for f, field in enumerate(fields)},
+    }
@@ -1,25 +1,53 @@
 from fastapi import Depends
 
-from app.database import get_db
-from ..models import Trace
+from app.database import SessionLocal, get_db
+from ..config import settings
+from ..models import Simulation, Trace
 from colorama import Fore, Back, Style
 import logging
 
 FORMAT = "%(levelname)s:%(message)s"
 logging.basicConfig(format=FORMAT, level=logging.DEBUG)
+from sqlalchemy import event, insert, select
 from sqlalchemy.orm import Session
 
 # Logs both to the console and
 # As the simulation proceeds, create entries in the 'Trace' file which can be accesed via an endpoint
 
-def report(level, simulation_id, message, db: Session):
+TRACE_BUFFER = "trace_buffer"  # key of the list of unwritten entries in Session.info
+TRACE_LEVELS = "trace_levels"  # key of the trace level of each simulation in Session.info
+
+def report(level, simulation_id, message, db: Session, *args):
     """
     Prints a message on the terminal (or other output if designated) AND
     exports it to the Trace database which makes it available to the user
 
     the parameter simulation_id ensures that it reaches the correct user
     TODO obtain simulation and db via the authentication process
+
+    The entry is not written at once. It is held in a buffer belonging
+    to the session and written, with all the other buffered entries, in
+    a single insert when the session commits, or when the buffer holds
+    settings.trace_buffer_size entries. It is therefore part of the
+    caller's transaction.
+
+    If settings.trace_immediate is set, every entry is written and
+    committed as soon as it is reported, which is slow but helps when
+    debugging.
+
+    Messages more detailed than the simulation's trace level (see
+    trace_level()) are ignored. This check comes before the message is
+    formatted, so in loops the message should be supplied either as a
+    callable which returns it, for example lambda: f"...", or as a
+    %-style format string followed by its arguments.
     """
+    if level > trace_level(simulation_id, db):
+        return
+    if callable(message):
+        message = message()
+    elif args:
+        message = message % args
+
     match level:
         case 1:
             colour = Fore.YELLOW
@@ -35,11 +63,47 @@ def report(level, simulation_id, message, db: Session):
     user_message = " " * level + f"Level {level}: {message}"
     log_message = " " * level+colour + message + Fore.WHITE
     logging.info(log_message)
-    entry = Trace(
-        simulation_id=simulation_id,
-        level=level,
-        time_stamp=1,
-        message=user_message,
-    )
-    db.add(entry)
-    db.commit()
+    entry = {
+        "simulation_id": simulation_id,
+        "level": level,
+        "time_stamp": 1,
+        "message": user_message,
+    }
+    if settings.trace_immediate:
+        db.add(Trace(**entry))
+        db.commit()
+        return
+    buffer = db.info.setdefault(TRACE_BUFFER, [])
+    buffer.append(entry)
+    if len(buffer) >= settings.trace_buffer_size:
+        flush_trace(db)
+
+def trace_level(simulation_id, db: Session)->int:
+    """The most detailed level of trace recorded for this simulation.
+
+    This is Simulation.trace_level if set, otherwise settings.trace_level.
+    It is looked up once per session.
+    """
+    levels = db.info.setdefault(TRACE_LEVELS, {})
+    if simulation_id not in levels:
+        level = db.execute(select(Simulation.trace_level).where(Simulation.id == simulation_id)).scalar()
+        levels[simulation_id] = settings.trace_level if level is None else level
+    return levels[simulation_id]
+
+def flush_trace(db: Session):
+    """Write all buffered trace entries in one insert, in the order in
+    which they were reported. Does not commit."""
+    buffer = db.info.get(TRACE_BUFFER)
+    if buffer:
+        db.info[TRACE_BUFFER] = []
+        db.execute(insert(Trace), buffer)
+
+@event.listens_for(SessionLocal, "before_commit")
+def flush_trace_before_commit(db: Session):
+    """Make sure that buffered trace entries are committed with everything else."""
+    flush_trace(db)
+
+@event.listens_for(SessionLocal, "after_rollback")
+def discard_trace_after_rollback(db: Session):
+    """Entries reported in a transaction that was rolled back are discarded with it."""
+    db.info.pop(TRACE_BUFFER, None)
@@ -1,12 +1,13 @@
 from sqlalchemy.orm import Session
 import json
-from sqlalchemy import insert
+from sqlalchemy import delete, func, insert, literal, select
 from ..models import Buyer, Class_stock, Industry_stock, Seller
-from .demand import report
+from .logging import flush_trace, report
 
 def reload_table(db: Session, baseModel, filename: str, reload: bool, simulation_id:int):
     """Initialise one table,specified by baseModel, from JSON fixture data specified by filename."""
-    report(2,simulation_id,f"Initialising table {filename}", db)
+    report(2,simulation_id,lambda: f"Initialising table {filename}", db)
+    flush_trace(db) # so that, as before, reloading the Trace table also removes these messages
     query = db.query(baseModel)
     query.delete(synchronize_session=False)
     if reload:
@@ -28,119 +29,63 @@ def initialise_buyers_and_sellers(db, simulation_id):
     The objects in this table are the id fields of the objects in the
     underlying owner and stock tables.
 
-    These references are created when a simulation is cloned.
+    These references are created when a simulation is cloned. Only the
+    buyers and sellers of this simulation are replaced. Each list is built
+    by one INSERT ... SELECT per stock table, which finds the owner's money
+    stock by joining the stock table to itself.
     """
 
 # Create seller list
 
-    report(1, simulation_id, "Creating a list of sellers for simulation {simulation_id}", db)
-    query = db.query(Seller)
-    query.delete(synchronize_session=False)
+    report(1, simulation_id, f"Creating a list of sellers for simulation {simulation_id}", db)
+    db.execute(delete(Seller).where(Seller.simulation_id == simulation_id))
+    industry_sellers = _insert_traders(db, Seller, Seller.sales_stock_id, Industry_stock, Industry_stock.industry_id, "Industry",
+        Industry_stock.usage_type == "Sales", simulation_id)
+    class_sellers = _insert_traders(db, Seller, Seller.sales_stock_id, Class_stock, Class_stock.class_id, "Class",
+        Class_stock.usage_type == "Sales", simulation_id)
+    report(2,simulation_id,f"Added {industry_sellers} industry sellers and {class_sellers} class sellers",db)
 
-# Add all Industry Sales stocks to seller list
+# Create buyer list
 
-    stock_query = db.query(Industry_stock).filter(
-        Industry_stock.simulation_id == simulation_id, Industry_stock.usage_type == "Sales"
-    )
-    for stock in stock_query:
-        owner = stock.owner(db)
-        commodity = stock.commodity(db)
-        money_stock_id = owner.money_stock(db).id
-        sales_stock_id = stock.id
-        commodity_id = commodity.id
-        report(2,simulation_id,
-            f"Adding seller {owner.name} selling {stock.name} ({commodity.name}) for money {money_stock_id}",db,
-        )
-        seller = {
-            "simulation_id": simulation_id,
-            "owner_type": "Industry",
-            "sales_stock_id": sales_stock_id,
-            "money_stock_id": money_stock_id,
-            "commodity_id": commodity_id,
-        }
-        new_seller = Seller(**seller)
-        db.add(new_seller)
+    report(1, simulation_id, f"Creating a list of buyers for simulation {simulation_id}", db)
+    db.execute(delete(Buyer).where(Buyer.simulation_id == simulation_id))
+    industry_buyers = _insert_traders(db, Buyer, Buyer.purchase_stock_id, Industry_stock, Industry_stock.industry_id, "Industry",
+        Industry_stock.usage_type.not_in(["Money", "Sales"]), simulation_id)
+    class_buyers = _insert_traders(db, Buyer, Buyer.purchase_stock_id, Class_stock, Class_stock.class_id, "Class",
+        Class_stock.usage_type.not_in(["Money", "Sales"]), simulation_id)
+    report(2,simulation_id,f"Added {industry_buyers} industry buyers and {class_buyers} class buyers",db)
 
-# Add all Class Sales stocks to seller list
+def _insert_traders(db:Session, trader_model, trader_stock_id, stock_model, owner_id, owner_type:str, usage_condition, simulation_id:int)->int:
+    """Add a buyer or seller to trader_model for every stock of stock_model that
+    satisfies usage_condition, and return how many were added.
 
-    stock_query = db.query(Class_stock).filter(
-        Class_stock.simulation_id == simulation_id, Class_stock.usage_type == "Sales"
+    trader_stock_id is the column of trader_model which refers to the stock
+    (purchase_stock_id or sales_stock_id); owner_id is the column of
+    stock_model which refers to its owner. If an owner has more than one
+    money stock, the first is used, as owner.money_stock() does.
+    """
+    money = (
+        select(owner_id.label("owner_id"), func.min(stock_model.id).label("money_stock_id"))
+        .where(stock_model.simulation_id == simulation_id, stock_model.usage_type == "Money")
+        .group_by(owner_id)
+        .subquery()
     )
-    for stock in stock_query:
-        owner = stock.owner(db)
-        commodity = stock.commodity(db)
-        money_stock_id = owner.money_stock(db).id
-        sales_stock_id = stock.id
-        commodity_id = commodity.id
-        report(2,simulation_id,
-            f"Adding seller {owner.name} selling {stock.name} ({commodity.name})for money {money_stock_id}",db,
+    traders = (
+        select(
+            literal(simulation_id),
+            literal(owner_type),
+            stock_model.id,
+            money.c.money_stock_id,
+            stock_model.commodity_id,
         )
-        seller = {
-            "simulation_id": simulation_id,
-            "owner_type": "Class",
-            "sales_stock_id": sales_stock_id,
-            "money_stock_id": money_stock_id,
-            "commodity_id": commodity_id,
-        }
-        new_seller = Seller(**seller)
-        db.add(new_seller)
-    db.commit()
-
-# Create buyer list
-
-    report(1, simulation_id, "Creating a list of buyers for simulation {simulation_id}", db)
-    query = db.query(Buyer)
-    query.delete(synchronize_session=False)
-
-# Add all productive Industry stocks to buyer list
-    
-    stock_query = db.query(Industry_stock).filter(
-        Industry_stock.simulation_id == simulation_id,
-        Industry_stock.usage_type != "Money",
-        Industry_stock.usage_type != "Sales",
+        .join(money, money.c.owner_id == owner_id)
+        .where(stock_model.simulation_id == simulation_id, usage_condition)
+        .order_by(stock_model.id)
     )
-    for stock in stock_query:
-        owner = stock.owner(db)
-        commodity = stock.commodity(db)
-        money_stock_id = owner.money_stock(db).id
-        purchase_stock_id = stock.id
-        commodity_id = commodity.id
-        report(2,simulation_id,
-            f"Adding buyer {owner.name} buying {stock.name} ({commodity.name}) using money {money_stock_id}",db,
+    result = db.execute(
+        insert(trader_model).from_select(
+            ["simulation_id", "owner_type", trader_stock_id.key, "money_stock_id", "commodity_id"],
+            traders,
         )
-        buyer = {
-            "simulation_id": simulation_id,
-            "owner_type": "Industry",
-            "purchase_stock_id": purchase_stock_id,
-            "money_stock_id": money_stock_id,
-            "commodity_id": commodity_id,
-        }
-        new_buyer = Buyer(**buyer)
-        db.add(new_buyer)
-
-# Add all consumption Class stocks to buyer list
-    
-    stock_query = db.query(Class_stock).filter(
-        Class_stock.simulation_id == simulation_id,
-        Class_stock.usage_type != "Money",
-        Class_stock.usage_type != "Sales",
     )
-    for stock in stock_query:
-        owner = stock.owner(db)
-        commodity = stock.commodity(db)
-        money_stock_id = owner.money_stock(db).id
-        purchase_stock_id = stock.id
-        commodity_id = commodity.id
-        report(2,simulation_id,
-            f"Adding buyer {owner.name} buying {stock.name} ({commodity.name}) using money {money_stock_id}",db,
-        )
-        buyer = {
-            "simulation_id": simulation_id,
-            "owner_type": "Class",
-            "purchase_stock_id": purchase_stock_id,
-            "money_stock_id": money_stock_id,
-            "commodity_id": commodity_id,
-        }
-        new_buyer = Buyer(**buyer)
-        db.add(new_buyer)
-    db.commit()
+    return result.rowcount
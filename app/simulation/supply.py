@@ -3,49 +3,37 @@
 Their purpose is to calculate the total supply for each commodity, in
 preparation for Trade.
 
-Quite simple: supply is simply the size of the Sales Stock.
+Quite simple: supply is simply the size of the Sales Stock. The supply
+of every commodity is summed over the Sales stocks of industries and
+classes by one grouped query, and written with one bulk update. The
+'Trade' action uses the same function to recalculate supply after
+trading.
 """
-from ..models import Class_stock, Commodity,Industry, Industry_stock,SocialClass
+from sqlalchemy import func, select, union_all, update
+from sqlalchemy.orm import Session
+from ..models import Class_stock, Commodity, Industry_stock, Simulation
 from .logging import report
 
-def initialise_supply(db,simulation):
-    """Set supply of every commodity to zero to prepare for the calculation."""
-    cquery = db.query(Commodity).where(Commodity.simulation_id==simulation.id)
-    for c in cquery:
-        report(1,simulation.id,f"Initialising commodity {c.name}",db)
-        db.add(c)
-        c.supply=0
-    db.commit()
+def calculate_supply(db:Session, simulation:Simulation):
+    """Set the supply of every commodity to the total size of the Sales
+    stocks of it, whether owned by industries or classes."""
 
-# Ask each industry to tell its sale commodity how much it has to sell
-def industry_supply(db,simulation):
-    """Calculate supply from every industries for each commodity it produces."""
-
-    report(1,simulation.id, "CALCULATING SUPPLY FOR INDUSTRIES",db)
-    query=db.query(Industry).where(Industry.simulation_id==simulation.id)
-    for industry in query:
-        sales_stock:Industry_stock=industry.sales_stock(db)
-        commodity:Commodity=sales_stock.commodity(db)
-        # print(f"Debugging supply by industry {industry.name} and id {industry.id}")
-        # print(f"Processing sales stock with name {sales_stock.name} and id {sales_stock.id}")
-        # print(f"The commodity of this stock is {commodity.name} and its ID is {commodity.id}")
-        db.add(commodity) # session.add(sales_stock) # not needed because we are not changing the stock
-        ns=sales_stock.size 
-        report(2,simulation.id,f'{industry.name} adds {ns:.0f} to the supply of {commodity.name}, which was previously {commodity.supply:.0f}',db)
-        commodity.supply+=ns
-    db.commit()
-
-# Ask each class to tell its sale commodity how much it has to sell
-def class_supply(db,simulation):
-    """Calculate supply from every class for each commodity it produces."""
-
-    report(1,simulation.id, "CALCULATING SUPPLY FROM SOCIAL CLASSES",db)
-    query=db.query(SocialClass).where(SocialClass.simulation_id==simulation.id)
-    for socialClass in query:
-        sales_stock:Class_stock=socialClass.sales_stock(db)
-        commodity:Commodity=sales_stock.commodity(db) # commodity that this owner supplies
-        db.add(commodity)
-        ns=sales_stock.size 
-        report(2,simulation.id,f'{socialClass.name} adds {ns:.0f} to the supply of {commodity.name}, which was previously {commodity.supply:.0f}',db)  
-        commodity.supply+=ns
-    db.commit()
+    report(1,simulation.id, "CALCULATING SUPPLY FROM INDUSTRIES AND SOCIAL CLASSES",db)
+    db.flush()
+    stocks=union_all(
+        select(Industry_stock.commodity_id, Industry_stock.size)
+        .where(Industry_stock.simulation_id==simulation.id, Industry_stock.usage_type=="Sales"),
+        select(Class_stock.commodity_id, Class_stock.size)
+        .where(Class_stock.simulation_id==simulation.id, Class_stock.usage_type=="Sales"),
+    ).subquery()
+    totals=dict(
+        db.execute(select(stocks.c.commodity_id, func.sum(stocks.c.size)).group_by(stocks.c.commodity_id)).all()
+    )
+    commodities=db.execute(select(Commodity.id, Commodity.name).where(Commodity.simulation_id==simulation.id)).all()
+    rows=[]
+    for commodity_id, name in commodities:
+        supply=totals.get(commodity_id) or 0
+        report(2,simulation.id,lambda: f'The supply of {name} is {supply:.0f}',db)
+        rows.append({"id": commodity_id, "supply": supply})
+    if rows:
+        db.execute(update(Commodity), rows)
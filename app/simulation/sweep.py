@@ -0,0 +1,202 @@
+"""Parameter sweeps: many runs of one template, each with different
+parameters, calculated in memory.
+
+The template is loaded once into a SimulationArrays (see engine.py) and
+initialised as a clone would be. Each combination of parameters is then
+applied to a copy of it and run for a number of periods. Small sweeps
+run in the process that handles the request; larger ones are spread
+over one pool of worker processes, shared by every sweep (see
+worker_pool()). Nothing is written to the database, unless 'save' is
+set, in which case each run is also stored as a new simulation of the
+user who asked for the sweep.
+
+A sweep may have at most settings.max_sweep_runs combinations, each run
+for at most settings.max_run_periods periods.
+
+A grid is a dictionary from parameter name to the list of values to try.
+Every combination of values is run. The parameters are:
+
+    periods_per_year:
+        a field of the Simulation
+    output_scale, output_growth_rate:
+        set for every Industry
+    population, consumption_ratio:
+        set for every SocialClass
+
+The circuit does not at present use the Simulation's investment_ratio or
+population_growth_rate, in either engine, so they cannot be swept: every
+run would be the same. Asking for them, or for any other field, raises
+ValueError.
+"""
+
+import copy
+import itertools
+import math
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from ..authorization.auth import User
+from ..config import settings
+from ..models import Industry, Simulation, SocialClass
+from .circuit import period_summary
+from .clone import clone_simulation
+from .engine import SimulationArrays
+from .history import record_history
+from .logging import report
+from .values import forget_unit_values
+
+SIMULATION_PARAMETERS = ["periods_per_year"]
+UNUSED_PARAMETERS = ["investment_ratio", "population_growth_rate"]  # fields of the Simulation that the circuit ignores
+INDUSTRY_PARAMETERS = ["output_scale", "output_growth_rate"]
+CLASS_PARAMETERS = ["population", "consumption_ratio"]
+PARAMETERS = SIMULATION_PARAMETERS + INDUSTRY_PARAMETERS + CLASS_PARAMETERS
+SERIAL_THRESHOLD = 1000  # runs times periods below which a sweep is done in-process (about 0.5ms each)
+
+def combinations(grid:dict[str, list[float]])->list[dict[str, float]]:
+    """Every combination of the values in grid, as one dictionary per run.
+
+    Raises ValueError if grid names a parameter that cannot be swept, or
+    has more than settings.max_sweep_runs combinations.
+    """
+    unused = [name for name in grid if name in UNUSED_PARAMETERS]
+    if unused:
+        raise ValueError(f"Cannot sweep {', '.join(unused)}: the circuit does not use them, so every run would be the same")
+    unknown = [name for name in grid if name not in PARAMETERS]
+    if unknown:
+        raise ValueError(f"Cannot sweep {', '.join(unknown)}. Parameters are {', '.join(PARAMETERS)}")
+    count = math.prod(len(values) for values in grid.values())
+    if count > settings.max_sweep_runs:
+        raise ValueError(f"The sweep has {count} combinations of parameters; at most {settings.max_sweep_runs} are allowed")
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+def initial_arrays(db:Session, template:Simulation)->SimulationArrays:
+    """The template, loaded and valued as initialise_clone() values a new clone."""
+    arrays = SimulationArrays.load(db, template)
+    arrays.revalue_commodities()
+    arrays.revalue_stocks()
+    arrays.calculate_initial_capitals()
+    arrays.calculate_current_capitals()
+    return arrays
+
+def apply_parameters(arrays:SimulationArrays, parameters:dict[str, float]):
+    for name, value in parameters.items():
+        if name == "periods_per_year":
+            arrays.periods_per_year = value
+        elif name in INDUSTRY_PARAMETERS:
+            arrays.industry[name][:] = value
+        elif name in CLASS_PARAMETERS:
+            arrays.social_class[name][:] = value
+
+def run_one(arrays:SimulationArrays, parameters:dict[str, float], periods:int)->tuple[list[dict], SimulationArrays]:
+    """Run one combination of parameters on arrays, which are changed.
+    Returns a summary of each period, and the arrays.
+
+    This is what the worker processes do, so it must not touch the database.
+    """
+    apply_parameters(arrays, parameters)
+    summaries = []
+    for period in range(1, periods+1):
+        arrays.circuit()
+        summaries.append(period_summary(
+            period,
+            arrays.commodity["total_value"].sum(),
+            arrays.commodity["total_price"].sum(),
+            arrays.industry["profit"].sum(),
+            arrays.industry["initial_capital"].sum(),
+        ))
+    return summaries, arrays
+
+_pool:ProcessPoolExecutor|None = None
+_pool_lock = threading.Lock()
+
+def worker_pool()->ProcessPoolExecutor:
+    """The pool of settings.sweep_workers processes used by every sweep,
+    started by the first sweep that needs it. Its size bounds the number
+    of processes however many sweeps are running at once."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=settings.sweep_workers)
+        return _pool
+
+def forget_worker_pool():
+    """Shut down the pool, for instance after one of its processes has died."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def sweep(
+    db:Session,
+    template:Simulation,
+    grid:dict[str, list[float]],
+    periods:int,
+    user:User|None=None,
+    save:bool=False,
+)->list[dict]:
+    """Run every combination of the parameters in grid on template for
+    'periods' periods, and return one row per run per period.
+
+    Each row contains the number of the run (from 1), the period, the
+    parameters of the run, and the summary of that period (see
+    circuit.period_summary).
+
+    If there is only one run, the number of runs times periods is below
+    SERIAL_THRESHOLD, or settings.sweep_workers is 1, everything happens
+    in this process. Otherwise the runs are spread over worker_pool().
+
+    If save is set, each run is also stored as a new simulation belonging
+    to user, in the state it reached at the end. The user's current
+    simulation is not changed. The caller must commit.
+
+    Raises ValueError if the grid cannot be swept (see combinations()) or
+    periods exceeds settings.max_run_periods.
+    """
+    if periods > settings.max_run_periods:
+        raise ValueError(f"A sweep may run for at most {settings.max_run_periods} periods")
+    runs = combinations(grid)
+    report(1, template.id, f"SWEEPING {len(runs)} COMBINATIONS OF PARAMETERS FOR {periods} PERIODS", db)
+    arrays = initial_arrays(db, template)
+    if len(runs) <= 1 or len(runs) * periods < SERIAL_THRESHOLD or settings.sweep_workers == 1:
+        results = [run_one(copy.deepcopy(arrays), parameters, periods) for parameters in runs]
+    else:
+        try:
+            results = list(worker_pool().map(run_one, itertools.repeat(arrays), runs, itertools.repeat(periods)))
+        except BrokenProcessPool:
+            forget_worker_pool() # so that the next sweep starts a new one
+            raise
+
+    table = []
+    for number, (parameters, (summaries, final)) in enumerate(zip(runs, results), start=1):
+        for summary in summaries:
+            table.append({"run": number, "parameters": parameters, **summary})
+        if save:
+            save_run(db, template, user, parameters, periods, final)
+    return table
+
+def save_run(db:Session, template:Simulation, user:User, parameters:dict[str, float], periods:int, final:SimulationArrays):
+    """Store the final state of one run as a new simulation for user,
+    without making it the user's current simulation. It keeps the
+    template's engine."""
+    simulation = clone_simulation(db, template, user, make_current=False)
+    for name in SIMULATION_PARAMETERS:
+        if name in parameters:
+            setattr(simulation, name, parameters[name])
+    for model, names in ((Industry, INDUSTRY_PARAMETERS), (SocialClass, CLASS_PARAMETERS)):
+        values = {name: parameters[name] for name in names if name in parameters}
+        if values:
+            db.execute(update(model).where(model.simulation_id == simulation.id).values(**values))
+    forget_unit_values(simulation.id)
+
+    # A clone has the same objects as its template, in the same order, so
+    # the final state can be written to it as it stands.
+    arrays = SimulationArrays.load(db, simulation)
+    arrays.commodity, arrays.industry, arrays.stock = final.commodity, final.industry, final.stock
+    arrays.flush(db)
+    simulation.time_stamp = (simulation.time_stamp or 0) + periods
+    record_history(db, simulation, arrays) # only the final period of the run is recorded
+    report(1, simulation.id, f"Stored the result of a sweep with parameters {parameters}", db)
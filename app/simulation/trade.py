@@ -1,7 +1,8 @@
 """This module contains functions used in handling the trade action."""
 
+from collections import defaultdict
 from sqlalchemy.orm import Session
-from ..models import Buyer, Class_stock, Industry_stock, Seller, Commodity, Simulation
+from ..models import Buyer, Class_stock, Industry, Industry_stock, Seller, SocialClass, Commodity, Simulation
 from .demand import report
 
 def constrain_demand(session,simulation):
@@ -13,33 +14,33 @@ def constrain_demand(session,simulation):
     for commodity in query:
         session.add(commodity)
         if (commodity.usage=="PRODUCTIVE".strip()) or (commodity.usage=="CONSUMPTION".strip()):
-            report(2,simulation.id,f'Demand for {commodity.name} is {commodity.demand} and supply is {commodity.supply}',session)
+            report(2,simulation.id,lambda: f'Demand for {commodity.name} is {commodity.demand} and supply is {commodity.supply}',session)
             if commodity.supply==0:
-                report(3,simulation.id,f"Zero Supply of {commodity.name}",session)
+                report(3,simulation.id,lambda: f"Zero Supply of {commodity.name}",session)
                 commodity.allocation_ratio=0
             elif commodity.demand<=commodity.supply:
-                report(3,simulation.id,f'Supply exceeds or equals demand; no constraint applied',session)
+                report(3,simulation.id,lambda: f'Supply exceeds or equals demand; no constraint applied',session)
                 commodity.allocation_ratio=1
             else:
-                report(3,simulation.id,f'Supply is less than demand; demand will be constrained',session)
+                report(3,simulation.id,lambda: f'Supply is less than demand; demand will be constrained',session)
                 commodity.allocation_ratio=commodity.supply/commodity.demand
                 commodity.demand*=commodity.allocation_ratio
-                report(3,simulation.id,f'Demand for {commodity.name} has been constrained by supply to {commodity.demand}',session)
-                report(3,simulation.id,f'Constraining stocks of {commodity.name} by a factor of {commodity.allocation_ratio}',session)
+                report(3,simulation.id,lambda: f'Demand for {commodity.name} has been constrained by supply to {commodity.demand}',session)
+                report(3,simulation.id,lambda: f'Constraining stocks of {commodity.name} by a factor of {commodity.allocation_ratio}',session)
 
 # Tell industry stocks the bad news.
                 stock_query=session.query(Industry_stock).where(Industry_stock.commodity_id==commodity.id)
                 for stock in stock_query:
                     session.add(stock)
                     stock.demand=stock.demand*commodity.allocation_ratio
-                    report(4,simulation.id, f"constraining stock {stock.id} demand to {stock.demand}",session)
+                    report(4,simulation.id, lambda: f"constraining stock {stock.id} demand to {stock.demand}",session)
 
 # Tell class stocks the bad news.
                 stock_query=session.query(Class_stock).where(Class_stock.commodity_id==commodity.id)
                 for stock in stock_query:
                     session.add(stock)
                     stock.demand=stock.demand*commodity.allocation_ratio
-                    report(4,simulation.id, f"constraining stock {stock.id} demand to {stock.demand}",session)
+                    report(4,simulation.id, lambda: f"constraining stock {stock.id} demand to {stock.demand}",session)
 
 def buy_and_sell(db:Session, simulation:Simulation):
     """Implements buying and selling.
@@ -55,85 +56,124 @@ def buy_and_sell(db:Session, simulation:Simulation):
     It contains the id fields of the underlying objects, on which this 
     function operates.
 
+    The market for each commodity is cleared separately. Buyers and sellers
+    are grouped by commodity, and every stock, commodity and owner they
+    refer to is loaded once at the start, so that the transfers themselves
+    take place in memory without further queries.
+
     TODO if demand is actually less than supply then we need some mechanism
     to oblige sellers to sell less. This can probably done within this 
     function - as indeed may be possible for the allocation of demand itself.
     """
 
     report(1, simulation.id, f"Starting trade with simulation {simulation.id}", db)
-    for seller in db.query(Seller).where(Seller.simulation_id == simulation.id):
-        sales_stock = seller.sales_stock(db)
-        report(2,simulation.id,
-            f"seller {seller.owner_name(db)} can sell {sales_stock.size} and is looking for buyers {sales_stock.name}",db,
-        )
-
-        for buyer in db.query(Buyer).where(
-            Buyer.simulation_id == simulation.id,
-            Buyer.commodity_id == seller.commodity_id,
-        ):
-            report(3,simulation.id,
-                f"buyer {buyer.owner_name(db)} will be asked to buy {buyer.purchase_stock(db).demand}",db,
+    market = Market(db, simulation)
+    for commodity_id, sellers in market.sellers.items():
+        for seller in sellers:
+            sales_stock = market.stock(seller.owner_type, seller.sales_stock_id)
+            report(2,simulation.id,
+                lambda: f"seller {market.owner_name(seller.owner_type, sales_stock)} can sell {sales_stock.size} and is looking for buyers {sales_stock.name}",db,
             )
-            buy(buyer, seller, simulation, db)
-    db.commit()
+            for buyer in market.buyers[commodity_id]:
+                purchase_stock = market.stock(buyer.owner_type, buyer.purchase_stock_id)
+                report(3,simulation.id,
+                    lambda: f"buyer {market.owner_name(buyer.owner_type, purchase_stock)} will be asked to buy {purchase_stock.demand}",db,
+                )
+                buy(buyer, seller, market, simulation, db)
+    db.flush()
+
+class Market:
+    """Everything that buy_and_sell needs to know about one simulation,
+    loaded with one query per table.
+
+    buyers and sellers are dictionaries, keyed by commodity id, of the
+    Buyer and Seller objects which trade in that commodity.
+    """
 
-def buy(buyer:Buyer, seller:Seller, simulation:Simulation, db:Session):
+    def __init__(self, db:Session, simulation:Simulation):
+        self.sellers:dict[int, list[Seller]] = defaultdict(list)
+        for seller in db.query(Seller).where(Seller.simulation_id == simulation.id).order_by(Seller.id):
+            self.sellers[seller.commodity_id].append(seller)
+        self.buyers:dict[int, list[Buyer]] = defaultdict(list)
+        for buyer in db.query(Buyer).where(Buyer.simulation_id == simulation.id).order_by(Buyer.id):
+            self.buyers[buyer.commodity_id].append(buyer)
+        self.stocks = {
+            "Industry": {stock.id: stock for stock in db.query(Industry_stock).where(Industry_stock.simulation_id == simulation.id)},
+            "Class": {stock.id: stock for stock in db.query(Class_stock).where(Class_stock.simulation_id == simulation.id)},
+        }
+        self.commodities = {c.id: c for c in db.query(Commodity).where(Commodity.simulation_id == simulation.id)}
+        self.owner_names = {
+            "Industry": dict(db.query(Industry.id, Industry.name).where(Industry.simulation_id == simulation.id).all()),
+            "Class": dict(db.query(SocialClass.id, SocialClass.name).where(SocialClass.simulation_id == simulation.id).all()),
+        }
+
+    def stock(self, owner_type:str, id:int)->Industry_stock|Class_stock:
+        """The stock with this id, which belongs to an owner of type owner_type."""
+        return self.stocks["Industry" if owner_type == "Industry" else "Class"][id]
+
+    def owner_name(self, owner_type:str, stock:Industry_stock|Class_stock)->str:  # Really just for diagnostic convenience
+        if owner_type == "Industry":
+            return self.owner_names["Industry"][stock.industry_id]
+        else:
+            return self.owner_names["Class"][stock.class_id]
+
+    def change_size(self, stock:Industry_stock|Class_stock, amount:float):
+        """Same as Industry_stock.change_size(), using the preloaded commodities."""
+        commodity = self.commodities[stock.commodity_id]
+        stock.size += amount
+        stock.price=stock.size*commodity.unit_value
+        stock.value=stock.size*commodity.unit_price
+
+def buy(buyer:Buyer, seller:Seller, market:Market, simulation:Simulation, db:Session):
     """Tell seller to sell whatever the buyer demands and collect the money."""
 
+    buyer_purchase_stock:Industry_stock|Class_stock = market.stock(buyer.owner_type, buyer.purchase_stock_id)
+    seller_sales_stock:Industry_stock|Class_stock = market.stock(seller.owner_type, seller.sales_stock_id)
+    buyer_money_stock:Industry_stock|Class_stock = market.stock(buyer.owner_type, buyer.money_stock_id)
+    seller_money_stock:Industry_stock|Class_stock = market.stock(seller.owner_type, seller.money_stock_id)
+    commodity:Commodity = market.commodities[seller.commodity_id]  # does not change yet
+    amount = buyer_purchase_stock.demand
+
     report(4,simulation.id,
-        f"buyer {buyer.owner_name(db)} is buying {buyer.purchase_stock(db).demand}",db,
+        lambda: f"buyer {market.owner_name(buyer.owner_type, buyer_purchase_stock)} is buying {amount}",db,
     )
 
-    buyer_purchase_stock:Industry_stock|Class_stock = buyer.purchase_stock(db)
-    seller_sales_stock:Industry_stock|Class_stock = seller.sales_stock(db)
-    buyer_money_stock:Industry_stock|Class_stock = buyer.money_stock(db)
-    seller_money_stock:Industry_stock|Class_stock = seller.money_stock(db)
-    commodity:Commodity = seller.commodity(db)  # does not change yet, so no need to add it to the session
-    amount = buyer_purchase_stock.demand
-
 # Very low level reporting - more for diagnostics than anything else
 # TODO user should be able to set the level at which diagnostic information is passsed on, or perhaps displayed
-    report(5,simulation.id,f"seller sales stock is {seller_sales_stock.name}",db)
-    report(5,simulation.id,f"buyer purchase stock is {buyer_purchase_stock.name}",db)
-    report(5,simulation.id,f"buyer money stock is {buyer_money_stock.name}",db)
-    report(5,simulation.id,f"seller money stock is {seller_money_stock.name}",db)
+    report(5,simulation.id,lambda: f"seller sales stock is {seller_sales_stock.name}",db)
+    report(5,simulation.id,lambda: f"buyer purchase stock is {buyer_purchase_stock.name}",db)
+    report(5,simulation.id,lambda: f"buyer money stock is {buyer_money_stock.name}",db)
+    report(5,simulation.id,lambda: f"seller money stock is {seller_money_stock.name}",db)
     report(4,simulation.id,
-        f"Buying {amount} at price {commodity.unit_price} and value {commodity.unit_value}",db,
+        lambda: f"Buying {amount} at price {commodity.unit_price} and value {commodity.unit_value}",db,
     )
 
 # Transfer the goods
 
-    db.add(buyer_purchase_stock)
-    db.add(seller_sales_stock)
-    buyer_purchase_stock.change_size(amount,db)
+    market.change_size(buyer_purchase_stock,amount)
     buyer_purchase_stock.demand -= amount
-    seller_sales_stock.change_size(-amount,db)
+    market.change_size(seller_sales_stock,-amount)
 
 # Pay for the goods
 
     report(4,simulation.id,"Now you must pay",db)
 
-    if buyer_money_stock == seller_money_stock:  
+    if buyer_money_stock is seller_money_stock:  
         # Internal trade to the sector
         report(4,simulation.id,"Internal transfer: no net payment effected",db,)
     else:
-        db.add(buyer_purchase_stock)
-        db.add(seller_sales_stock)
         # TODO account for MELT. Money can have a value different from its price
-        seller_money_stock.change_size(amount * commodity.unit_price,db)
-        buyer_money_stock.change_size(-amount * commodity.unit_price,db)
+        market.change_size(seller_money_stock,amount * commodity.unit_price)
+        market.change_size(buyer_money_stock,-amount * commodity.unit_price)
 
 # Report on the results of trade
 
 # Very low level reporting - more for diagnostics than anything else
 # TODO user should be able to set the level at which diagnostic information is passsed on, or perhaps displayed
     report(4,simulation.id, "Results after trade were as follows:",db)
-    report(5,simulation.id,f"seller sales stock size is {seller_sales_stock.size}",db)
-    report(5,simulation.id,f"buyer purchase stock size is {buyer_purchase_stock.size}",db)
-    report(5,simulation.id,f"buyer money stock size is {buyer_money_stock.size}",db)
-    report(5,simulation.id,f"seller money stock size is {seller_money_stock.size}",db)
+    report(5,simulation.id,lambda: f"seller sales stock size is {seller_sales_stock.size}",db)
+    report(5,simulation.id,lambda: f"buyer purchase stock size is {buyer_purchase_stock.size}",db)
+    report(5,simulation.id,lambda: f"buyer money stock size is {buyer_money_stock.size}",db)
+    report(5,simulation.id,lambda: f"seller money stock size is {seller_money_stock.size}",db)
 # report on the effect of trade on demand and supply.
-    report(5,simulation.id,f"buyer purchase stock demand is {buyer_purchase_stock.demand}",db)
-
-    # db.commit() # TODO verify that this is achieved by the final commit.
-
+    report(5,simulation.id,lambda: f"buyer purchase stock demand is {buyer_purchase_stock.demand}",db)
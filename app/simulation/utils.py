@@ -1,5 +1,6 @@
 from ..models import Class_stock, Commodity,Industry, Industry_stock, Simulation
 from .logging import report
+from sqlalchemy import func, select, union_all, update
 from sqlalchemy.orm import Session
 
 """Helper functions for use in all parts of the simulation."""
@@ -19,132 +20,117 @@ def revalue_commodities(db:Session, simulation:Simulation):
       if commodity.size>0:
         commodity.unit_price=commodity.total_price/commodity.size
         commodity.unit_value=commodity.total_price/commodity.size
-        report(2,simulation.id,f"Setting the value of commodity {commodity.name} to {commodity.total_value} and its price to {commodity.total_price}",db)
-        report(2,simulation.id,f"Setting the unit value of commodity {commodity.name} to {commodity.unit_value} and its unit price to {commodity.unit_price}",db)
+        report(2,simulation.id,lambda: f"Setting the value of commodity {commodity.name} to {commodity.total_value} and its price to {commodity.total_price}",db)
+        report(2,simulation.id,lambda: f"Setting the unit value of commodity {commodity.name} to {commodity.unit_value} and its unit price to {commodity.unit_price}",db)
 
 def recalculate_commodity_totals(db:Session, simulation:Simulation):
-  """Recalculate commodity sizes, values and prices from stocks."""
-  report(1,simulation.id,"CALCULATE NEW TOTAL VALUES AND PRICES",db)
-  commodities=db.query(Commodity).where(Commodity.simulation_id==simulation.id)
-  for commodity in commodities:
-      commodity.total_value=0
-      commodity.total_price=0
-      commodity.size=0
-      db.add(commodity)
-
-# Industry stocks
-            
-      istocks=db.query(Industry_stock).where(Industry_stock.commodity_id==commodity.id)
-      for stock in istocks:
-          commodity.total_value+=stock.value
-          commodity.total_price+=stock.price
-          commodity.size+=stock.size
-      db.commit() # TODO is this necessary at this time?
-
-# Class stocks
+  """Recalculate commodity sizes, values and prices from stocks.
 
-      cstocks=db.query(Class_stock).where(Class_stock.commodity_id==commodity.id)
-      for stock in cstocks:
-          commodity.total_value+=stock.value
-          commodity.total_price+=stock.price
-          commodity.size+=stock.size
-  db.commit()
+  The totals are summed over both stock tables by a single grouped query,
+  and written to the commodities with one bulk update.
+  """
+  report(1,simulation.id,"CALCULATE NEW TOTAL VALUES AND PRICES",db)
+  db.flush() # the query must see any changes to stocks made in this session
+  stocks=union_all(
+    select(Industry_stock.commodity_id, Industry_stock.value, Industry_stock.price, Industry_stock.size)
+    .where(Industry_stock.simulation_id==simulation.id),
+    select(Class_stock.commodity_id, Class_stock.value, Class_stock.price, Class_stock.size)
+    .where(Class_stock.simulation_id==simulation.id),
+  ).subquery()
+  totals={
+    commodity_id: (total_value, total_price, size)
+    for commodity_id, total_value, total_price, size in db.execute(
+      select(stocks.c.commodity_id, func.sum(stocks.c.value), func.sum(stocks.c.price), func.sum(stocks.c.size))
+      .group_by(stocks.c.commodity_id)
+    )
+  }
+  commodity_ids=db.scalars(select(Commodity.id).where(Commodity.simulation_id==simulation.id)).all()
+  rows=[]
+  for commodity_id in commodity_ids:
+      total_value, total_price, size = totals.get(commodity_id, (0, 0, 0))
+      rows.append({"id": commodity_id, "total_value": total_value, "total_price": total_price, "size": size})
+  if rows:
+      db.execute(update(Commodity), rows)
 
 def revalue_stocks(db:Session, simulation:Simulation):
-  """ Interrogate all stocks.
+  """ Revalue all stocks.
   Set value from unit value and size of their commodity
   Set price from unit price and size of their commodity
+
+  This is one UPDATE ... FROM per stock table, joining the stocks to
+  their commodities. Stocks already loaded into the session are brought
+  up to date by fetching the ids of the rows that were changed.
   """
   report(1,simulation.id,"RESETTING PRICES AND VALUES",db)
-
-# Industry stocks
-
-  istocks=db.query(Industry_stock).where(Industry_stock.simulation_id==simulation.id)
-  report(2,simulation.id,"Revaluing industry stocks",db)
-  for stock in istocks:
-      commodity=db.query(Commodity).where(Commodity.id == stock.commodity_id).first()
-      db.add(stock)
-      stock.value=stock.size*commodity.unit_value
-      stock.price=stock.size*commodity.unit_price
-      report(3,simulation.id,f"Setting the value of the stock [{stock.name}] to {stock.value} and its price to {stock.price}",db)
-  db.commit()
-
-# Class stocks
-
-  cstocks=db.query(Class_stock).where(Class_stock.simulation_id==simulation.id)
-  report(2,simulation.id,"Revaluing class stocks",db)
-  for stock in cstocks:
-      commodity=db.query(Commodity).where(Commodity.id == stock.commodity_id).first()
-      db.add(stock)
-      stock.value=stock.size*commodity.unit_value
-      stock.price=stock.size*commodity.unit_price
-      report(3,simulation.id,f"Setting the value of the stock [{stock.name}] to {stock.value} and its price to {stock.price}",db)
-  db.commit()
-
-def calculate_capital(db:Session, simulation:Simulation,industry:Industry)->float:
+  db.flush() # the update must see new unit values and stock sizes set in this session
+  for stock_model in (Industry_stock, Class_stock):
+      db.execute(
+        update(stock_model)
+        .where(stock_model.commodity_id==Commodity.id, stock_model.simulation_id==simulation.id)
+        .values(value=stock_model.size*Commodity.unit_value, price=stock_model.size*Commodity.unit_price)
+        .execution_options(synchronize_session="fetch")
+      )
+  commodities=db.execute(
+    select(Commodity.name, Commodity.unit_value, Commodity.unit_price).where(Commodity.simulation_id==simulation.id)
+  ).all()
+  for name, unit_value, unit_price in commodities:
+      report(2,simulation.id,lambda: f"Revalued stocks of {name} at unit value {unit_value} and unit price {unit_price}",db)
+
+def industry_capitals(db:Session, simulation:Simulation)->dict[int, tuple[str, float]]:
     """
-    Calculate the initial capital of the given industry and return it
-    This is equal to the sum of the prices of all its stocks
+    Calculate the capital of every industry in the simulation, using one
+    grouped query. Returns the name and capital of each industry, by id.
+    The capital is equal to the sum of the prices of all its stocks.
     Assumes that the price of all these stocks has been set
     """
-    report(2,simulation.id,f"Calculating the capital of {industry.name}",db)
-    result=0
-    istocks=db.query(Industry_stock).where(Industry_stock.industry_id==industry.id)
-    for stock in istocks:
-        report(3,simulation.id,f"Industry stock [{stock.name}] is adding {stock.price} to the capital of {industry.name}",db)
-        result+=stock.price
+    db.flush()
+    capitals=dict(
+      db.execute(
+        select(Industry_stock.industry_id, func.sum(Industry_stock.price))
+        .where(Industry_stock.simulation_id==simulation.id)
+        .group_by(Industry_stock.industry_id)
+      ).all()
+    )
+    industries=db.execute(select(Industry.id, Industry.name).where(Industry.simulation_id==simulation.id)).all()
+    result={industry_id: (name, capitals.get(industry_id, 0)) for industry_id, name in industries}
+    for name, capital in result.values():
+      report(2,simulation.id,lambda: f"The capital of {name} is {capital}",db)
     return result
 
 def calculate_initial_capitals(db:Session, simulation:Simulation):
     """
-    Calculate the initial capital of the given industry and return it
+    Calculate the initial capital of every industry in the simulation.
     This is equal to the sum of the prices of all its stocks
     Assumes that the price of all these stocks has been set correctly
     """
     report(1,simulation.id,f"CALCULATING INITIAL CAPITAL for simulation {simulation.id}",db)
-    industries=db.query(Industry).where(Industry.simulation_id==simulation.id)
-    for industry in industries:
-      report(2,simulation.id,f"Asking for the capital of {industry.name}",db)      
-      db.add(industry)
-      industry.initial_capital=calculate_capital(db,simulation,industry)
-    db.commit()
+    rows=[
+      {"id": industry_id, "initial_capital": capital}
+      for industry_id, (name, capital) in industry_capitals(db,simulation).items()
+    ]
+    if rows:
+      db.execute(update(Industry), rows)
 
 def calculate_current_capitals(db:Session, simulation:Simulation):
     """
     Calculate the current capital of all industries in the simulation.
     Set the profit and the profit rate of each industry.
+    The profit rate of an industry with no initial capital is zero.
     Assumes that the price of all stocks has been set correctly.
     """
     report(1,simulation.id,"CALCULATING CURRENT CAPITAL",db)
-    industries=db.query(Industry).where(Industry.simulation_id==simulation.id)
-    for industry in industries:
-      db.add(industry)
-      industry.current_capital=calculate_capital(db,simulation,industry)
-      industry.profit=industry.current_capital-industry.initial_capital
-      industry.profit_rate=industry.profit/industry.initial_capital
-    db.commit()
-
-def clone_model(model, session: Session, **kwargs):
-    """Clone an arbitrary sqlalchemy model object without its 
-    primary key values.
-
-    These primary keys are then added by the caller.
-
-    Returns the clone unless the call is illegal (eg null model).
-
-    Returns None if it can't be done.
-    """
-    try:
-        table = model.__table__
-        non_pk_columns = [
-            k for k in table.columns.keys() if k not in table.primary_key.columns.keys()
-        ]
-        data = {c: getattr(model, c) for c in non_pk_columns}
-        data.update(kwargs)
-        clone = model.__class__(**data)
-        session.add(clone)
-        session.commit()
-        return clone
-    except:
-        return None
-
+    capitals=industry_capitals(db,simulation)
+    initial_capitals=dict(
+      db.execute(select(Industry.id, Industry.initial_capital).where(Industry.simulation_id==simulation.id)).all()
+    )
+    rows=[]
+    for industry_id, (name, current_capital) in capitals.items():
+      profit=current_capital-initial_capitals[industry_id]
+      rows.append({
+        "id": industry_id,
+        "current_capital": current_capital,
+        "profit": profit,
+        "profit_rate": profit/initial_capitals[industry_id] if initial_capitals[industry_id] else 0.0,
+      })
+    if rows:
+      db.execute(update(Industry), rows)
@@ -0,0 +1,180 @@
+"""Unit values calculated directly from the input-output structure of a
+simulation, instead of by pushing values through production one period
+at a time.
+
+The unit value of a commodity is the value of the inputs used up to
+produce one unit of it: for each input, its requirement times its unit
+value, except that socially-produced inputs (Labour Power) add their
+magnitude, as in production.produce(). If several industries produce the
+same commodity, their coefficients are averaged, weighted by output_scale.
+Inputs which no industry produces keep their current unit value.
+
+For the produced commodities this gives the linear system
+
+    v = A v + l
+
+where A is the matrix of technical coefficients and l is the value added
+by labour and by unproduced inputs. It is solved either densely, with
+np.linalg.solve, or, for large models, iteratively: v = A v + l is
+repeated, with A held as coordinate (COO) arrays, until it stops changing.
+This is Jacobi iteration (the Neumann series of (I - A)^-1), not a direct
+sparse solver such as scipy's spsolve; scipy is not a dependency of the
+project. It converges if and only if the economy is productive, that is
+the spectral radius of A is below 1, and otherwise raises ValueError.
+
+Results are cached per simulation and method, and reused as long as the
+simulation's version is unchanged, without reading the coefficients
+again. The version is bumped by every action, and the functions that
+write output_scale (the investment stage, run_circuits and restoring a
+checkpoint) also call forget_unit_values(). Requirements are only
+written when a simulation is created.
+"""
+
+import numpy as np
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+from ..models import Commodity, Industry, Industry_stock, Simulation
+from .logging import report
+
+SPARSE_THRESHOLD = 200  # number of produced commodities above which "auto" uses the sparse solver
+TOLERANCE = 1e-12
+MAX_ITERATIONS = 100_000
+
+class InputOutput:
+    """The technical coefficients of one simulation.
+
+    'produced' holds the ids of the commodities that some industry sells.
+    Positions in the arrays below refer to positions in 'produced'.
+    The matrix A is held as coordinate arrays rows, cols, data, in which
+    repeated entries are added together.
+    """
+
+    def __init__(self, db:Session, simulation:Simulation):
+        commodities = db.execute(
+            select(Commodity.id, Commodity.unit_value, Commodity.origin)
+            .where(Commodity.simulation_id == simulation.id)
+            .order_by(Commodity.id)
+        ).all()
+        unit_value = {id: value or 0.0 for id, value, origin in commodities}
+        social = {id for id, value, origin in commodities if (origin or "").strip().upper() == "SOCIAL"}
+
+        output = {}  # the commodity sold by each industry, from its first sales stock
+        for industry_id, commodity_id in db.execute(
+            select(Industry_stock.industry_id, Industry_stock.commodity_id)
+            .where(Industry_stock.simulation_id == simulation.id, Industry_stock.usage_type == "Sales")
+            .order_by(Industry_stock.id)
+        ):
+            output.setdefault(industry_id, commodity_id)
+        scale = dict(db.execute(select(Industry.id, Industry.output_scale).where(Industry.simulation_id == simulation.id)).all())
+
+        self.produced = sorted({commodity_id for commodity_id in output.values()})
+        position = {commodity_id: i for i, commodity_id in enumerate(self.produced)}
+        total_scale = np.zeros(len(self.produced))
+        producers = np.zeros(len(self.produced))
+        for industry_id, commodity_id in output.items():
+            total_scale[position[commodity_id]] += scale.get(industry_id) or 0.0
+            producers[position[commodity_id]] += 1
+
+        def weight(industry_id:int)->float:
+            """Share of this industry in the output of its commodity; equal shares if none is producing."""
+            i = position[output[industry_id]]
+            if total_scale[i] > 0:
+                return (scale.get(industry_id) or 0.0) / total_scale[i]
+            return 1.0 / producers[i]
+
+        rows, cols, data = [], [], []
+        self.direct = np.zeros(len(self.produced))
+        for industry_id, commodity_id, requirement in db.execute(
+            select(Industry_stock.industry_id, Industry_stock.commodity_id, Industry_stock.requirement)
+            .where(Industry_stock.simulation_id == simulation.id, Industry_stock.usage_type == "Production")
+            .order_by(Industry_stock.id)
+        ):
+            if industry_id not in output:
+                continue
+            row = position[output[industry_id]]
+            coefficient = weight(industry_id) * (requirement or 0.0)
+            if commodity_id in social:
+                self.direct[row] += coefficient  # Labour Power adds its magnitude, not its value
+            elif commodity_id in position:
+                rows.append(row)
+                cols.append(position[commodity_id])
+                data.append(coefficient)
+            else:
+                self.direct[row] += coefficient * unit_value[commodity_id]
+        self.rows = np.array(rows, dtype=int)
+        self.cols = np.array(cols, dtype=int)
+        self.data = np.array(data, dtype=float)
+
+    def solve_dense(self)->np.ndarray:
+        """Solve (I - A) v = l with a dense matrix."""
+        n = len(self.produced)
+        matrix = np.eye(n)
+        np.add.at(matrix, (self.rows, self.cols), -self.data)
+        return np.linalg.solve(matrix, self.direct)
+
+    def solve_sparse(self)->np.ndarray:
+        """Solve (I - A) v = l iteratively, by repeating v = A v + l from
+        v = l, never forming A as a matrix. Each iteration costs one pass
+        over the non-zero coefficients.
+
+        Raises ValueError if this has not converged after MAX_ITERATIONS,
+        or diverges, which means that the economy cannot reproduce itself
+        with these coefficients.
+        """
+        n = len(self.produced)
+        values = self.direct.copy()
+        for _ in range(MAX_ITERATIONS):
+            with np.errstate(over="ignore", invalid="ignore"): # divergence is detected below
+                next_values = np.bincount(self.rows, weights=self.data * values[self.cols], minlength=n) + self.direct
+            if not np.all(np.isfinite(next_values)):
+                raise ValueError("Unit values diverge: the economy is not productive")
+            if np.max(np.abs(next_values - values), initial=0.0) <= TOLERANCE * (1.0 + np.max(np.abs(next_values), initial=0.0)):
+                return next_values
+            values = next_values
+        raise ValueError(f"Unit values did not converge after {MAX_ITERATIONS} iterations")
+
+_solutions:dict[tuple[int, str], tuple[int, dict[int, float]]] = {}  # (version, unit values) by (simulation id, method)
+
+def solve_unit_values(db:Session, simulation:Simulation, method:str="auto")->dict[int, float]:
+    """The unit value of every commodity produced by an industry, by id.
+
+    method is "dense", "sparse" or "auto", which chooses according to the
+    number of produced commodities (see SPARSE_THRESHOLD).
+
+    This only reads the simulation, and writes no trace, so that it can
+    serve read-only endpoints. Raises ValueError if the sparse solver
+    does not converge, and np.linalg.LinAlgError if the dense system is
+    singular.
+    """
+    if method not in ("auto", "dense", "sparse"):
+        raise ValueError(f"Unknown method {method}")
+    key = (simulation.id, method)
+    version = simulation.version or 0
+    cached = _solutions.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    db.flush()
+    io = InputOutput(db, simulation)
+    if method == "auto":
+        method = "sparse" if len(io.produced) > SPARSE_THRESHOLD else "dense"
+    values = io.solve_dense() if method == "dense" else io.solve_sparse()
+    result = dict(zip(io.produced, values.tolist()))
+    _solutions[key] = (version, result)
+    return result
+
+def apply_unit_values(db:Session, simulation:Simulation, method:str="auto"):
+    """Set the unit value of every commodity produced by an industry from
+    solve_unit_values(). Stocks are not revalued; callers should normally
+    call revalue_stocks() next."""
+    report(1, simulation.id, "CALCULATING UNIT VALUES FROM THE INPUT-OUTPUT STRUCTURE", db)
+    rows = [{"id": id, "unit_value": value} for id, value in solve_unit_values(db, simulation, method).items()]
+    report(2, simulation.id, f"Solved for the unit values of {len(rows)} commodities ({method})", db)
+    if rows:
+        db.execute(update(Commodity), rows)
+
+def forget_unit_values(simulation_id:int):
+    """Discard the cached solutions for this simulation. Call this after
+    changing the output_scale or requirements of any of its industries."""
+    for key in [key for key in _solutions if key[0] == simulation_id]:
+        del _solutions[key]
@@ -0,0 +1,145 @@
+"""Compare the time taken to copy the objects of a simulation in four ways:
+
+    rows:     the original implementation, which built and committed one
+              ORM object at a time
+    insert:   clone.copy_objects(), one INSERT ... SELECT per table, as
+              clone_simulation() does
+    snapshot: a TemplateSnapshot made from the source, then materialised
+              with one bulk insert per table, as clone_from_snapshot()
+              does the first time a template is cloned
+    cached:   materialising a snapshot that has already been made, as
+              clone_from_snapshot() does thereafter
+
+Only the copying is timed. The valuation that follows (initialise_clone)
+is the same whichever way the objects were copied.
+
+Run from the project root, with the usual .env in place:
+
+    python -m benchmarks.clone [commodities] [repeats]
+
+The source simulation has 'commodities' commodities (default 100), one
+industry producing each of them, with a production stock of every
+commodity, and two classes, with a consumption stock of every commodity.
+It is created in an in-memory SQLite database, so the project database
+is not touched.
+"""
+
+import sys
+import time
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import Session
+from app.authorization.auth import User
+from app.database import Base
+from app.models import Class_stock, Commodity, Industry, Industry_stock, Simulation, SocialClass
+from app.simulation.clone import TemplateSnapshot, copy_objects, new_simulation_from
+
+TABLES = [Commodity, Industry, SocialClass, Industry_stock, Class_stock]
+
+def fill(db:Session, commodities:int)->Simulation:
+    """Create the source simulation described above."""
+    user = User("benchmark", "benchmark")
+    db.add(user)
+    db.flush()
+    source = Simulation(name="source", state="DEMAND", periods_per_year=1.0, user_id=user.id, username=user.username)
+    db.add(source)
+    db.flush()
+    owned = {"simulation_id": source.id, "username": user.username}
+    numbers = {"size": 100.0, "total_value": 100.0, "total_price": 100.0, "unit_value": 1.0, "unit_price": 1.0}
+    commodity_ids = db.execute(insert(Commodity).returning(Commodity.id, sort_by_parameter_order=True), [
+        {**owned, **numbers, "name": f"commodity {i}", "origin": "INDUSTRIAL", "usage": "PRODUCTIVE"} for i in range(commodities)
+    ]).scalars().all()
+    industry_ids = db.execute(insert(Industry).returning(Industry.id, sort_by_parameter_order=True), [
+        {**owned, "name": f"industry {i}", "output": f"commodity {i}", "output_scale": 100.0, "initial_capital": 0.0}
+        for i in range(commodities)
+    ]).scalars().all()
+    class_ids = db.execute(insert(SocialClass).returning(SocialClass.id, sort_by_parameter_order=True), [
+        {**owned, "name": name, "population": 100.0, "consumption_ratio": 1.0} for name in ("Capitalists", "Workers")
+    ]).scalars().all()
+    stock = {**owned, "size": 10.0, "value": 10.0, "price": 10.0, "demand": 0.0}
+    db.execute(insert(Industry_stock), [
+        {**stock, "industry_id": industry_id, "commodity_id": commodity_id, "name": "stock", "usage_type": usage_type, "requirement": 0.1}
+        for i, industry_id in enumerate(industry_ids)
+        for commodity_id, usage_type in [(commodity_ids[i], "Sales"), *[(id, "Production") for id in commodity_ids]]
+    ])
+    db.execute(insert(Class_stock), [
+        {**stock, "class_id": class_id, "commodity_id": commodity_id, "name": "stock", "usage_type": "Consumption"}
+        for class_id in class_ids
+        for commodity_id in commodity_ids
+    ])
+    db.commit()
+    return source
+
+def copy_by_rows(db:Session, source:Simulation, new_simulation:Simulation, username:str):
+    """The original implementation: each object is built, added and
+    committed in turn, and each stock looks up its owner and commodity."""
+    def clone(original, **changes):
+        columns = [c.name for c in original.__table__.columns if c.name != "id"]
+        copy = original.__class__(**{**{c: getattr(original, c) for c in columns}, **changes})
+        db.add(copy)
+        db.commit()
+        return copy
+    successors = {}
+    for model in (Commodity, Industry, SocialClass):
+        for original in db.query(model).filter(model.simulation_id == source.id).order_by(model.id):
+            successors[model, original.id] = clone(original, simulation_id=new_simulation.id, username=username).id
+    for model, owner_model, owner_id in ((Industry_stock, Industry, "industry_id"), (Class_stock, SocialClass, "class_id")):
+        for original in db.query(model).filter(model.simulation_id == source.id).order_by(model.id):
+            owner = successors.get((owner_model, getattr(original, owner_id)))
+            commodity = successors.get((Commodity, original.commodity_id))
+            if owner is None or commodity is None:
+                continue
+            clone(original, simulation_id=new_simulation.id, username=username, commodity_id=commodity, **{owner_id: owner})
+
+def copy_by_insert(db:Session, source:Simulation, new_simulation:Simulation, username:str):
+    copy_objects(db, source, new_simulation, username)
+    db.commit()
+
+def copy_by_snapshot(db:Session, source:Simulation, new_simulation:Simulation, username:str):
+    TemplateSnapshot(db, source).materialise(db, new_simulation.id, username)
+    db.commit()
+
+def contents(db:Session, simulation:Simulation)->dict:
+    """The numbers held by every object of simulation, in id order, for checking that copies agree."""
+    result = {}
+    for model in TABLES:
+        columns = [c for c in model.__table__.columns if c.type.python_type is float]
+        result[model.__tablename__] = db.execute(
+            select(*columns).where(model.simulation_id == simulation.id).order_by(model.id)
+        ).all()
+    return result
+
+def best_of(repeats:int, db:Session, source:Simulation, user:User, function)->tuple[float, Simulation]:
+    best = float("inf")
+    for _ in range(repeats):
+        new_simulation = new_simulation_from(db, source, user, make_current=False)
+        db.commit()
+        start = time.perf_counter()
+        function(db, source, new_simulation, user.username)
+        best = min(best, time.perf_counter() - start)
+    return best, new_simulation
+
+def main(commodities:int=100, repeats:int=3):
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        source = fill(db, commodities)
+        user = db.get(User, source.user_id)
+        snapshot = TemplateSnapshot(db, source)
+        methods = {
+            "rows": copy_by_rows,
+            "insert": copy_by_insert,
+            "snapshot": copy_by_snapshot,
+            "cached": lambda db, source, new_simulation, username: (snapshot.materialise(db, new_simulation.id, username), db.commit()),
+        }
+        objects = sum(len(rows) for rows in contents(db, source).values())
+        expected = contents(db, source)
+        print(f"{'method':10}{'objects':>9}{'ms':>10}{'speedup':>9}")
+        baseline = None
+        for name, function in methods.items():
+            elapsed, copy = best_of(repeats, db, source, user, function)
+            assert contents(db, copy) == expected, f"{name}: the copy differs from the source"
+            baseline = baseline or elapsed
+            print(f"{name:10}{objects:>9}{elapsed*1000:>10.1f}{baseline/elapsed:>8.1f}x")
+
+if __name__ == "__main__":
+    main(*[int(argument) for argument in sys.argv[1:3]])
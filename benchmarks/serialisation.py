@@ -0,0 +1,85 @@
+"""Compare the time taken to produce the JSON for the bulk list endpoints
+(/commodities, /stocks/industry, /stocks/class, /trace) in two ways:
+
+    orm:    what FastAPI does with a query returned by the endpoint: build
+            an ORM object per row, validate each into the response_model
+            schema, then encode the result
+    orjson: serialisation.dump_rows(), as the endpoints now do
+
+Run from the project root, with the usual .env in place:
+
+    python -m benchmarks.serialisation [rows] [repeats]
+
+rows defaults to 10000. The tables are created in an in-memory SQLite
+database, so the project database is not touched.
+"""
+
+import json
+import sys
+import time
+from typing import List
+from pydantic import TypeAdapter
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+from app.authorization.auth import User  # defines the users table, to which simulations refer
+from app.database import Base
+from app.models import Class_stock, Commodity, Industry_stock, Trace
+from app.schemas import Class_stock_base, CommodityBase, Industry_stock_base, TraceOut
+from app.serialisation import dump_rows
+
+SIMULATION_ID = 1
+TABLES = [
+    ("commodities", Commodity, CommodityBase),
+    ("industry stocks", Industry_stock, Industry_stock_base),
+    ("class stocks", Class_stock, Class_stock_base),
+    ("trace", Trace, TraceOut),
+]
+
+def fill(db:Session, model, schema, rows:int):
+    """Insert rows objects of model with a plausible value in every field of schema."""
+    def value(name:str, annotation, i:int):
+        if name == "id":
+            return i + 1
+        if name == "simulation_id":
+            return SIMULATION_ID
+        if annotation is int:
+            return i % 7
+        if annotation is float:
+            return i * 1.25
+        return f"{name} {i}"
+    fields = schema.model_fields
+    db.execute(insert(model), [{name: value(name, field.annotation, i) for name, field in fields.items()} for i in range(rows)])
+
+def through_orm(db:Session, model, schema)->bytes:
+    adapter = TypeAdapter(List[schema])
+    objects = db.query(model).where(model.simulation_id == SIMULATION_ID)
+    validated = adapter.validate_python(objects, from_attributes=True)
+    return json.dumps(adapter.dump_python(validated, mode="json")).encode()
+
+def through_orjson(db:Session, model, schema)->bytes:
+    return dump_rows(db, model, schema, model.simulation_id == SIMULATION_ID)
+
+def best_of(repeats:int, function, *args)->tuple[float, bytes]:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main(rows:int=10_000, repeats:int=5):
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        for _, model, schema in TABLES:
+            fill(db, model, schema, rows)
+        db.commit()
+        print(f"{'endpoint':16}{'rows':>8}{'orm ms':>10}{'orjson ms':>11}{'speedup':>9}")
+        for name, model, schema in TABLES:
+            orm_time, orm_json = best_of(repeats, through_orm, db, model, schema)
+            fast_time, fast_json = best_of(repeats, through_orjson, db, model, schema)
+            assert json.loads(orm_json) == json.loads(fast_json), f"{name}: the two methods give different results"
+            print(f"{name:16}{rows:>8}{orm_time*1000:>10.1f}{fast_time*1000:>11.1f}{orm_time/fast_time:>8.1f}x")
+
+if __name__ == "__main__":
+    main(*[int(argument) for argument in sys.argv[1:3]])
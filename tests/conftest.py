@@ -0,0 +1,37 @@
+"""Shared fixtures. The app is pointed at a temporary SQLite database
+before it is imported, and the database is loaded from the fixtures in
+static/ once per test session."""
+
+import itertools
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ["SQLALCHEMY_DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db")
+os.chdir(ROOT)  # reload_table() reads static/ relative to the working directory
+sys.path.insert(0, ROOT)
+
+import pytest
+from fastapi.testclient import TestClient
+from app.main import interface
+
+TEMPLATES = [1, 2, 3, 4, 5, 6, 7, 8]
+_users = itertools.count(1)
+
+@pytest.fixture(scope="session")
+def client()->TestClient:
+    client = TestClient(interface)
+    client.get("/action/reset")
+    client.post("/auth/register", data={"username": "admin", "password": "insecure"})
+    return client
+
+@pytest.fixture
+def login(client):
+    """Register and log in a new user; returns the headers to send with its requests."""
+    def login()->dict:
+        username = f"user{next(_users)}"
+        client.post("/auth/register", data={"username": username, "password": "password"})
+        token = client.post("/auth/login", data={"username": username, "password": "password"}).json()["access_token"]
+        return {"Authorization": f"Bearer {token}"}
+    return login
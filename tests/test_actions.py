@@ -0,0 +1,16 @@
+"""The action endpoints (routers/actions.py)."""
+
+from app.config import settings
+
+def test_run_rejects_too_many_periods(client, login):
+    headers = login()
+    client.get("/users/clone/1", headers=headers)
+    assert client.get(f"/action/run?periods={settings.max_run_periods + 1}", headers=headers).status_code == 422
+
+def test_run_outside_the_demand_state_replies_409(client, login):
+    headers = login()
+    client.get("/users/clone/1", headers=headers)
+    client.get("/action/demand", headers=headers)
+    response = client.get("/action/run", headers=headers)
+    assert response.status_code == 409
+    assert "SUPPLY" in response.json()["detail"]
@@ -0,0 +1,20 @@
+"""Restoring and forking simulations (simulation/checkpoint.py)."""
+
+import pytest
+from .test_engine import ENDPOINTS
+
+def state(client, headers)->dict:
+    return {
+        name: [{field: value for field, value in row.items() if isinstance(value, float)} for row in sorted(client.get(url, headers=headers).json(), key=lambda row: row["id"])]
+        for name, url in ENDPOINTS.items()
+    }
+
+@pytest.mark.parametrize("template", [1, 7])
+def test_fork_copies_the_state_at_the_time_stamp(client, login, template):
+    headers = login()
+    client.get(f"/users/clone/{template}", headers=headers)
+    client.get("/action/run?periods=1", headers=headers)
+    expected = state(client, headers)
+    client.get("/action/run?periods=2", headers=headers)
+    assert client.get("/simulations/fork/1", headers=headers).status_code == 200  # the fork becomes the current simulation
+    assert state(client, headers) == expected
@@ -0,0 +1,70 @@
+"""The NUMPY engine (simulation/engine.py) must give the same results as
+the ORM implementation of the circuit."""
+
+import numpy as np
+import pytest
+from sqlalchemy import select, update
+from app.database import SessionLocal
+from app.models import Industry, Industry_stock, Simulation
+from app.simulation.engine import SimulationArrays
+from .conftest import TEMPLATES
+
+PERIODS = 3
+ENDPOINTS = {
+    "commodities": "/commodities/",
+    "industries": "/industries/",
+    "classes": "/classes/",
+    "industry_stocks": "/stocks/industry",
+    "class_stocks": "/stocks/class",
+}
+
+def run(client, headers, template:int, engine:str, periods:int, prepare=None)->dict:
+    """Clone template, run it with engine for 'periods' periods, and return its objects.
+    If given, prepare(simulation_id) is called on the clone before it is run."""
+    simulation_id = client.get(f"/users/clone/{template}", headers=headers).json()["simulation"]
+    if prepare is not None:
+        prepare(simulation_id)
+    client.get(f"/simulations/engine/{engine}", headers=headers)
+    assert len(client.get(f"/action/run?periods={periods}", headers=headers).json()) == periods
+    return {name: sorted(client.get(url, headers=headers).json(), key=lambda row: row["id"]) for name, url in ENDPOINTS.items()}
+
+def assert_same(orm:dict, numpy:dict):
+    for name in ENDPOINTS:
+        assert len(orm[name]) == len(numpy[name]), name
+        fields = [field for field, value in orm[name][0].items() if isinstance(value, float)] if orm[name] else []
+        for field in fields:
+            expected = np.array([row[field] for row in orm[name]])
+            actual = np.array([row[field] for row in numpy[name]])
+            assert np.allclose(expected, actual, rtol=1e-6, atol=1e-6), f"{name}.{field}"
+
+@pytest.mark.parametrize("template", TEMPLATES)
+def test_numpy_engine_matches_orm(client, login, template):
+    assert_same(run(client, login(), template, "ORM", PERIODS), run(client, login(), template, "NUMPY", PERIODS))
+
+def without_costs(simulation_id:int):
+    """Make the first industry of the simulation need no inputs."""
+    with SessionLocal() as db:
+        industry_id = db.execute(select(Industry.id).where(Industry.simulation_id == simulation_id).order_by(Industry.id)).scalars().first()
+        db.execute(update(Industry_stock).where(Industry_stock.industry_id == industry_id).values(requirement=0))
+        db.commit()
+
+def test_engines_agree_on_an_industry_without_costs(client, login):
+    orm = run(client, login(), 1, "ORM", PERIODS, without_costs)
+    numpy = run(client, login(), 1, "NUMPY", PERIODS, without_costs)
+    assert_same(orm, numpy)
+    assert all(np.isfinite(row["output_scale"]) for row in numpy["industries"])
+
+def test_profit_rate_is_zero_without_initial_capital(client):
+    with SessionLocal() as db:
+        arrays = SimulationArrays.load(db, db.get(Simulation, 1))
+    arrays.industry["initial_capital"][0] = 0
+    arrays.calculate_current_capitals()
+    assert arrays.industry["profit_rate"][0] == 0
+    assert np.all(np.isfinite(arrays.industry["profit_rate"]))
+
+def test_produce_raises_if_an_industry_has_no_sales_stock(client):
+    with SessionLocal() as db:
+        arrays = SimulationArrays.load(db, db.get(Simulation, 1))
+    arrays.industry_sales[0] = -1
+    with pytest.raises(Exception, match="HAS NO SALES STOCK"):
+        arrays.produce()
@@ -0,0 +1,45 @@
+"""The snapshots written to History (simulation/history.py)."""
+
+import numpy as np
+import pytest
+from sqlalchemy import func, select
+from app.database import SessionLocal
+from app.models import History, Simulation
+from app.simulation.engine import SimulationArrays
+from app.simulation.history import history_row, load_snapshot, save_history
+from .conftest import TEMPLATES
+
+@pytest.mark.parametrize("template", TEMPLATES)
+def test_load_snapshot_gives_the_same_row_as_a_full_load(client, template):
+    with SessionLocal() as db:
+        simulation = db.get(Simulation, template)
+        assert history_row(load_snapshot(db, simulation), 0) == history_row(SimulationArrays.load(db, simulation), 0)
+
+def test_save_history_replaces_a_snapshot_of_the_same_time_stamp(client):
+    with SessionLocal() as db:
+        simulation = db.get(Simulation, 1)
+        row = history_row(load_snapshot(db, simulation), 1000)
+        save_history(db, [row])
+        save_history(db, [{**row, "checkpoint": b""}])
+        recorded = db.execute(
+            select(func.count(), func.length(History.checkpoint))
+            .where(History.simulation_id == simulation.id, History.time_stamp == 1000)
+        ).one()
+        db.rollback()
+    assert tuple(recorded) == (1, 0)
+
+@pytest.mark.parametrize("stride, bucket", [(3, 1), (2, 2), (1, 4)])
+def test_stride_and_bucket_thin_out_the_full_series(client, login, stride, bucket):
+    headers = login()
+    client.get("/users/clone/1", headers=headers)
+    client.get("/action/run?periods=10", headers=headers)
+    full = client.get("/history/industries", headers=headers).json()
+    thinned = client.get(f"/history/industries?stride={stride}&bucket={bucket}", headers=headers).json()
+    time_stamps = full["time_stamp"][::stride]
+    assert thinned["id"] == full["id"]
+    assert thinned["time_stamp"] == time_stamps[::bucket]
+    for field, series in full["series"].items():
+        for expected, actual in zip(series, thinned["series"][field]):
+            strided = np.array(expected[::stride])
+            averages = [strided[i:i+bucket].mean() for i in range(0, len(strided), bucket)]
+            assert np.allclose(actual, averages), field
@@ -0,0 +1,32 @@
+"""The trace buffer (simulation/logging.py)."""
+
+import pytest
+from sqlalchemy import func, select
+from app.authorization import auth
+from app.database import SessionLocal
+from app.models import Trace
+from app.simulation.logging import report
+
+def test_rollback_discards_buffered_trace(client):
+    message = "reported in a transaction that was rolled back"
+    with SessionLocal() as db:
+        report(1, 1, message, db)
+        db.rollback()
+        db.commit()
+        written = db.execute(select(func.count()).where(Trace.message.contains(message))).scalar()
+    assert written == 0
+
+def test_failed_registration_is_traced(client, monkeypatch):
+    def fail(password):
+        raise RuntimeError("hashing failed")
+    monkeypatch.setattr(auth.pwd_context, "hash", fail)
+    client.post("/auth/register", data={"username": "unhashable", "password": "password"})
+    with SessionLocal() as db:
+        written = db.execute(select(func.count()).where(Trace.message.contains("Error trying to register user unhashable"))).scalar()
+    assert written == 1
+
+@pytest.mark.parametrize("level, status_code", [(0, 422), (1, 200), (5, 200), (6, 422)])
+def test_trace_level_must_be_between_1_and_5(client, login, level, status_code):
+    headers = login()
+    client.get("/users/clone/1", headers=headers)
+    assert client.get(f"/simulations/trace_level/{level}", headers=headers).status_code == status_code
@@ -0,0 +1,36 @@
+"""The read endpoints of the current simulation."""
+
+import pytest
+from sqlalchemy import update
+from app.database import SessionLocal
+from app.models import Industry
+from app.schemas import IndustryBase, SocialClassBase
+
+@pytest.mark.parametrize("url, schema", [("/industries/", IndustryBase), ("/classes/", SocialClassBase)])
+def test_list_has_the_fields_of_the_schema_in_order(client, login, url, schema):
+    headers = login()
+    client.get("/users/clone/1", headers=headers)
+    rows = client.get(url, headers=headers).json()
+    assert rows
+    for row in rows:
+        assert list(row) == list(schema.model_fields)
+        schema.model_validate(row)
+
+def test_cache_statistics_are_only_for_the_admin(client, login):
+    assert client.get("/simulations/cache").status_code == 401
+    assert client.get("/simulations/cache", headers={"Authorization": "Bearer nonsense"}).status_code == 401
+    assert client.get("/simulations/cache", headers=login()).status_code == 403
+    token = client.post("/auth/login", data={"username": "admin", "password": "insecure"}).json()["access_token"]
+    assert "hits" in client.get("/simulations/cache", headers={"Authorization": f"Bearer {token}"}).json()
+
+def test_nulls_in_required_fields_still_conform_to_the_schema(client, login):
+    headers = login()
+    simulation_id = client.get("/users/clone/1", headers=headers).json()["simulation"]
+    with SessionLocal() as db:
+        db.execute(update(Industry).where(Industry.simulation_id == simulation_id).values(username=None, profit=None))
+        db.commit()
+    rows = client.get("/industries/", headers=headers).json()
+    assert [row["id"] for row in rows] == sorted(row["id"] for row in rows)
+    for row in rows:
+        IndustryBase.model_validate(row)
+        assert row["username"] == "" and row["profit"] == 0.0
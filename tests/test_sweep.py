@@ -0,0 +1,63 @@
+"""Parameter sweeps (see simulation/sweep.py)."""
+
+import pytest
+from app.config import settings
+from app.simulation import sweep
+
+@pytest.mark.parametrize("parameter", ["investment_ratio", "population_growth_rate", "no_such_field"])
+def test_parameters_the_circuit_does_not_use_are_rejected(client, login, parameter):
+    response = client.post(
+        "/simulations/sweep",
+        json={"template_id": 1, "parameters": {parameter: [0.1, 0.2]}, "periods": 1},
+        headers=login(),
+    )
+    assert response.status_code == 422
+
+def test_saving_runs_does_not_change_the_current_simulation(client, login):
+    headers = login()
+    current = client.get("/users/clone/1", headers=headers).json()["simulation"]
+    response = client.post(
+        "/simulations/sweep",
+        json={"template_id": 1, "parameters": {"output_growth_rate": [0.1, 0.2]}, "periods": 2, "save": True},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    assert client.get("/simulations/snapshot", headers=headers).json()["simulation"]["id"] == current
+    saved = [s for s in client.get("/simulations/mine", headers=headers).json() if s["id"] != current]
+    assert len(saved) == 2
+    template = client.get("/simulations/by_id/1").json()
+    assert all(s["engine"] == template["engine"] and s["time_stamp"] == 2 for s in saved)
+
+@pytest.mark.parametrize("template", [6, 7])
+def test_templates_with_stocks_owned_outside_them_can_be_swept(client, login, template):
+    response = client.post(
+        "/simulations/sweep",
+        json={"template_id": template, "parameters": {}, "periods": 1},
+        headers=login(),
+    )
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+
+@pytest.mark.parametrize("parameters, periods", [
+    ({"output_growth_rate": [0.01] * 40, "consumption_ratio": [1.0] * 40}, 1),
+    ({"output_growth_rate": [0.1]}, settings.max_run_periods + 1),
+])
+def test_oversized_sweeps_are_rejected(client, login, parameters, periods):
+    response = client.post(
+        "/simulations/sweep",
+        json={"template_id": 1, "parameters": parameters, "periods": periods},
+        headers=login(),
+    )
+    assert response.status_code == 422
+
+def test_worker_pool_gives_the_same_results_and_is_shared(client, login, monkeypatch):
+    request = {"template_id": 1, "parameters": {"output_growth_rate": [0.1, 0.2, 0.3]}, "periods": 3}
+    headers = login()
+    serial = client.post("/simulations/sweep", json=request, headers=headers).json()
+    monkeypatch.setattr(sweep, "SERIAL_THRESHOLD", 0)
+    parallel = client.post("/simulations/sweep", json=request, headers=headers).json()
+    pool = sweep.worker_pool()
+    client.post("/simulations/sweep", json=request, headers=headers)
+    assert sweep.worker_pool() is pool
+    assert parallel == serial
+    sweep.forget_worker_pool()
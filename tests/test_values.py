@@ -0,0 +1,72 @@
+"""The dense and sparse (iterative) unit value solvers must agree."""
+
+import numpy as np
+import pytest
+from sqlalchemy import update
+from app.database import SessionLocal
+from app.models import Industry_stock
+from app.simulation.values import InputOutput, forget_unit_values
+from .conftest import TEMPLATES
+
+def random_economy(n:int, seed:int=1)->InputOutput:
+    """An InputOutput with random coefficients, each row of which sums to less than 1."""
+    rng = np.random.default_rng(seed)
+    io = InputOutput.__new__(InputOutput)
+    io.produced = list(range(n))
+    io.rows = rng.integers(0, n, 5 * n)
+    io.cols = rng.integers(0, n, 5 * n)
+    io.data = rng.random(5 * n)
+    io.data *= 0.9 / np.bincount(io.rows, weights=io.data, minlength=n)[io.rows]
+    io.direct = rng.random(n)
+    return io
+
+def test_dense_and_sparse_agree_on_a_random_economy():
+    io = random_economy(500)
+    assert np.allclose(io.solve_dense(), io.solve_sparse(), rtol=1e-9, atol=1e-9)
+
+def test_sparse_raises_if_the_economy_is_not_productive():
+    io = random_economy(50)
+    io.data *= 2
+    with pytest.raises(ValueError):
+        io.solve_sparse()
+
+@pytest.mark.parametrize("template", TEMPLATES)
+def test_dense_and_sparse_agree_on_templates(client, login, template):
+    headers = login()
+    client.get(f"/users/clone/{template}", headers=headers)
+    dense = client.get("/commodities/unit_values?method=dense", headers=headers).json()
+    sparse = client.get("/commodities/unit_values?method=sparse", headers=headers).json()
+    assert [row["id"] for row in dense] == [row["id"] for row in sparse]
+    for d, s in zip(dense, sparse):
+        assert (d["solved_unit_value"] is None) == (s["solved_unit_value"] is None)
+        if d["solved_unit_value"] is not None:
+            assert np.isclose(d["solved_unit_value"], s["solved_unit_value"], rtol=1e-9, atol=1e-9)
+
+def test_unit_values_reply_422_if_the_economy_is_not_productive(client, login):
+    headers = login()
+    simulation_id = client.get("/users/clone/1", headers=headers).json()["simulation"]
+    with SessionLocal() as db:
+        db.execute(update(Industry_stock).where(Industry_stock.simulation_id == simulation_id).values(requirement=Industry_stock.requirement * 100))
+        db.commit()
+    forget_unit_values(simulation_id)
+    response = client.get("/commodities/unit_values?method=sparse", headers=headers)
+    assert response.status_code == 422
+    assert "not productive" in response.json()["detail"]
+
+def test_singular_matrix_replies_422(client, login, monkeypatch):
+    def singular(io):
+        raise np.linalg.LinAlgError("Singular matrix")
+    monkeypatch.setattr(InputOutput, "solve_dense", singular)
+    headers = login()
+    client.get("/users/clone/1", headers=headers)
+    assert client.get("/commodities/unit_values?method=dense", headers=headers).status_code == 422
+    mine = len(client.get("/simulations/mine", headers=headers).json())
+    assert client.get("/users/clone/2?solve_values=true", headers=headers).status_code == 422
+    assert len(client.get("/simulations/mine", headers=headers).json()) == mine
+
+def test_unit_values_write_no_trace(client, login):
+    headers = login()
+    client.get("/users/clone/1", headers=headers)
+    trace = client.get("/trace/", headers=headers).json()
+    client.get("/commodities/unit_values", headers=headers)
+    assert client.get("/trace/", headers=headers).json() == trace